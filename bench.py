@@ -0,0 +1,1017 @@
+#!/usr/bin/env python3
+"""
+Бенчмарки сайта 'Нам полгода'
+Запуск: python bench.py <сценарий> [параметры]
+
+Каждый сценарий запускает website.py в отдельном процессе во временной
+папке с копией photos/, поэтому рабочие данные не затрагиваются.
+"""
+
+import argparse
+import hashlib
+import http.client
+import json
+import re
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from contextlib import contextmanager
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+    """Свободный TCP-порт на localhost"""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@contextmanager
+def run_server(*server_args, setup=None):
+    """Запуск website.py во временной папке, возвращает (порт, pid, папка)"""
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    shutil.copytree(os.path.join(ROOT, 'photos'), os.path.join(workdir, 'photos'))
+    port = free_port()
+    code = "import sys, website\n"
+    if setup:
+        code += setup + "\n"
+    code += "website.main(sys.argv[1:])\n"
+    proc = subprocess.Popen(
+        [sys.executable, '-c', code, '--port', str(port), *server_args],
+        cwd=workdir, env=dict(os.environ, PYTHONPATH=ROOT),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.time() + 10
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+                break
+            except OSError:
+                if time.time() > deadline or proc.poll() is not None:
+                    raise RuntimeError("сервер не запустился")
+                time.sleep(0.05)
+        yield port, proc.pid, workdir
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def request(port, method, path, body=None, headers=None, timeout=30):
+    """Один запрос на новом соединении, возвращает (статус, тело, заголовки)"""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        return response.status, response.read(), response
+    finally:
+        conn.close()
+
+
+def list_photos(port, limit=500):
+    """Все фото галереи: /api/photos по страницам"""
+    photos, cursor = [], None
+    while True:
+        path = f'/api/photos?limit={limit}'
+        if cursor:
+            path += '&cursor=' + urllib.parse.quote(cursor)
+        _, body, _ = request(port, 'GET', path)
+        page = json.loads(body)
+        photos += page['photos']
+        cursor = page['next_cursor']
+        if not cursor:
+            return photos
+
+
+def percentile(values, pct):
+    """Перцентиль по отсортированному списку"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def run_clients(port, paths, clients, duration, keepalive=False):
+    """Параллельные клиенты, каждый по кругу запрашивает paths
+
+    При keepalive=True клиент переиспользует одно соединение, иначе
+    открывает новое на каждый запрос.
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    stop_at = time.time() + duration
+
+    def client(offset):
+        i = offset
+        conn = None
+        while time.time() < stop_at:
+            path = paths[i % len(paths)]
+            i += 1
+            start = time.perf_counter()
+            try:
+                if keepalive:
+                    if conn is None:
+                        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+                    conn.request('GET', path)
+                    response = conn.getresponse()
+                    response.read()
+                    status = response.status
+                    if response.will_close:
+                        conn.close()
+                        conn = None
+                else:
+                    status, _, _ = request(port, 'GET', path, timeout=10)
+                ok = status == 200
+            except (OSError, http.client.HTTPException):
+                ok = False
+                if conn is not None:
+                    conn.close()
+                    conn = None
+            elapsed = time.perf_counter() - start
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors[0] += 1
+        if conn is not None:
+            conn.close()
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, errors[0]
+
+
+def slow_upload(port, stop, size=5 * 1024 * 1024, chunk=16 * 1024, delay=0.05):
+    """Медленная загрузка фото, как с телефона на плохой сети"""
+    boundary = 'benchboundary'
+    head = (f'--{boundary}\r\nContent-Disposition: form-data; name="photo"; '
+            f'filename="slow.jpg"\r\nContent-Type: image/jpeg\r\n\r\n').encode()
+    tail = f'\r\n--{boundary}--\r\n'.encode()
+    body = head + b'\xff' * size + tail
+    try:
+        sock = socket.create_connection(('127.0.0.1', port), timeout=30)
+        sock.sendall((f'POST /api/upload HTTP/1.1\r\nHost: localhost\r\n'
+                      f'Content-Type: multipart/form-data; boundary={boundary}\r\n'
+                      f'Content-Length: {len(body)}\r\n\r\n').encode())
+        for i in range(0, len(body), chunk):
+            if stop.is_set():
+                break
+            sock.sendall(body[i:i + chunk])
+            time.sleep(delay)
+        sock.close()
+    except OSError:
+        pass
+
+
+def report(title, latencies, errors, duration):
+    """Печать строки результатов"""
+    rps = len(latencies) / duration
+    print(f"{title:<28} {rps:>9.1f} {percentile(latencies, 50) * 1000:>9.1f} "
+          f"{percentile(latencies, 99) * 1000:>9.1f} {errors:>7}")
+
+
+def report_header():
+    print(f"{'режим':<28} {'req/s':>9} {'p50, мс':>9} {'p99, мс':>9} {'ошибки':>7}")
+
+
+def bench_concurrency(args):
+    """Сравнение single и threaded под нагрузкой с медленной загрузкой"""
+    paths = ['/api/time', '/', '/gallery',
+             '/photos/photo_1_2025-11-11_16-56-37.jpg']
+    report_header()
+    for mode in ('single', 'threaded'):
+        with run_server('--mode', mode) as (port, _, _):
+            latencies, errors = run_clients(port, paths, args.clients, args.duration)
+            report(f"{mode}", latencies, errors, args.duration)
+
+            stop = threading.Event()
+            uploader = threading.Thread(target=slow_upload, args=(port, stop))
+            uploader.start()
+            time.sleep(0.2)
+            latencies, errors = run_clients(port, paths, args.clients, args.duration)
+            stop.set()
+            uploader.join()
+            report(f"{mode} + медленная загрузка", latencies, errors, args.duration)
+
+
+def open_idle_connections(port, count):
+    """Соединения, которые ничего не отправляют (медленные мобильные клиенты)"""
+    sockets = []
+    for _ in range(count):
+        try:
+            sockets.append(socket.create_connection(('127.0.0.1', port), timeout=5))
+        except OSError:
+            break
+    return sockets
+
+
+def bench_idle(args):
+    """Обслуживание запросов при тысяче простаивающих соединений"""
+    paths = ['/api/time', '/', '/gallery']
+    report_header()
+    for mode in ('threaded', 'async'):
+        with run_server('--mode', mode, '--timeout', '60') as (port, _, _):
+            idle = open_idle_connections(port, args.idle)
+            time.sleep(0.5)
+            latencies, errors = run_clients(port, paths, args.clients, args.duration)
+            report(f"{mode} + {len(idle)} простаивающих", latencies, errors, args.duration)
+            for sock in idle:
+                sock.close()
+
+
+def bench_keepalive(args):
+    """Запросы в секунду с переиспользованием соединений и без"""
+    paths = ['/api/time', '/api/photos', '/',
+             '/photos/photo_2_2025-11-11_16-59-42.jpg']
+    report_header()
+    for mode in ('threaded', 'async'):
+        with run_server('--mode', mode) as (port, _, _):
+            for keepalive in (False, True):
+                latencies, errors = run_clients(port, paths, args.clients,
+                                                args.duration, keepalive=keepalive)
+                title = f"{mode} {'keep-alive' if keepalive else 'новое соединение'}"
+                report(title, latencies, errors, args.duration)
+    # Простаивающих keep-alive клиентов больше, чем рабочих потоков
+    # (несколько браузеров по 6 соединений): новый запрос не должен ждать
+    workers = 4
+    print()
+    for mode in ('threaded', 'async'):
+        with run_server('--mode', mode, '--workers', str(workers)) as (port, _, _):
+            idle = open_keepalive_connections(port, 3 * workers)
+            try:
+                start = time.perf_counter()
+                status, _, _ = request(port, 'GET', '/api/time')
+                elapsed = time.perf_counter() - start
+            finally:
+                for conn in idle:
+                    conn.close()
+            print(f"{mode}: {len(idle)} простаивающих keep-alive при {workers} потоках, "
+                  f"новый запрос {elapsed * 1000:.1f} мс (статус {status})")
+
+
+def open_keepalive_connections(port, count):
+    """Keep-alive соединения, сделавшие по запросу и оставленные открытыми"""
+    connections = []
+    for _ in range(count):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        conn.request('GET', '/api/time')
+        conn.getresponse().read()
+        connections.append(conn)
+    return connections
+
+
+def burst_connect(port, count):
+    """Одновременные подключения, возвращает время самого долгого connect"""
+    worst = [0.0]
+    lock = threading.Lock()
+    barrier = threading.Barrier(count)
+    sockets = []
+
+    def connect():
+        barrier.wait()
+        start = time.perf_counter()
+        try:
+            sock = socket.create_connection(('127.0.0.1', port), timeout=10)
+        except OSError:
+            return
+        elapsed = time.perf_counter() - start
+        with lock:
+            sockets.append(sock)
+            worst[0] = max(worst[0], elapsed)
+
+    threads = [threading.Thread(target=connect) for _ in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for sock in sockets:
+        sock.close()
+    return worst[0]
+
+
+def bench_prefork(args):
+    """Рендеринг галереи в одном и нескольких процессах, всплеск подключений"""
+    processes = os.cpu_count() or 1
+    report_header()
+    for count in sorted({1, processes, max(2, processes)}):
+        with run_server('--processes', str(count)) as (port, _, _):
+            latencies, errors = run_clients(port, ['/gallery'], args.clients,
+                                            args.duration, keepalive=True)
+            report(f"/gallery, процессов: {count}", latencies, errors, args.duration)
+    print()
+    for backlog in (5, 1024):
+        with run_server('--mode', 'single', '--backlog', str(backlog)) as (port, _, _):
+            worst = burst_connect(port, 500)
+            print(f"500 подключений разом, backlog {backlog:>4}: "
+                  f"самый долгий connect {worst * 1000:.0f} мс")
+
+
+def process_stats(pid):
+    """Пиковая память (VmHWM, КБ) и процессорное время (с) процесса"""
+    peak_kb = 0
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                peak_kb = int(line.split()[1])
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    return peak_kb, cpu
+
+
+def process_tree_cpu(pid):
+    """Процессорное время (с) процесса и его дочерних процессов"""
+    children = []
+    for task in os.listdir(f'/proc/{pid}/task'):
+        with open(f'/proc/{pid}/task/{task}/children') as f:
+            children += [int(child) for child in f.read().split()]
+    return process_stats(pid)[1] + sum(process_tree_cpu(child) for child in children)
+
+
+def download_all(port, paths, clients, rounds):
+    """Параллельное скачивание файлов, возвращает число байт"""
+    total = [0]
+    lock = threading.Lock()
+
+    def client(offset):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        received = 0
+        for i in range(rounds * len(paths)):
+            conn.request('GET', paths[(i + offset) % len(paths)])
+            response = conn.getresponse()
+            while True:
+                chunk = response.read(256 * 1024)
+                if not chunk:
+                    break
+                received += len(chunk)
+        conn.close()
+        with lock:
+            total[0] += received
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return total[0]
+
+
+# Способы отдачи файлов для сравнения: исходный f.read() целиком,
+# копирование блоками и sendfile
+FILE_DELIVERY = {
+    'read() целиком': "website.WebsiteHandler.use_sendfile = False\n"
+                      "website.WebsiteHandler.COPY_CHUNK_SIZE = 1 << 30",
+    'копирование блоками': "website.WebsiteHandler.use_sendfile = False",
+    'sendfile': None,
+}
+
+
+def bench_sendfile(args):
+    """Скорость отдачи файлов из photos/ и память сервера"""
+    paths = ['/photos/' + urllib.parse.quote(name)
+             for name in sorted(os.listdir(os.path.join(ROOT, 'photos')))]
+    print(f"{'способ':<22} {'МБ/с':>8} {'пик RSS, МБ':>12} {'CPU, мс/МБ':>11}")
+    for title, setup in FILE_DELIVERY.items():
+        with run_server('--mode', 'threaded', setup=setup) as (port, pid, _):
+            _, cpu_before = process_stats(pid)
+            start = time.perf_counter()
+            received = download_all(port, paths, args.clients, args.rounds)
+            elapsed = time.perf_counter() - start
+            peak_kb, cpu_after = process_stats(pid)
+            megabytes = received / (1024 * 1024)
+            print(f"{title:<22} {megabytes / elapsed:>8.1f} {peak_kb / 1024:>12.1f} "
+                  f"{(cpu_after - cpu_before) * 1000 / megabytes:>11.2f}")
+    # Движок asyncio: одновременные скачивания видео не должны держать
+    # в памяти сервера по копии файла на клиента
+    videos = [path for path in paths if path.endswith('.mp4')] or paths
+    clients = 16
+    with run_server('--mode', 'async') as (port, pid, _):
+        _, cpu_before = process_stats(pid)
+        start = time.perf_counter()
+        received = download_all(port, videos, clients, args.rounds)
+        elapsed = time.perf_counter() - start
+        peak_kb, cpu_after = process_stats(pid)
+        megabytes = received / (1024 * 1024)
+        title = f'async, видео x{clients}'
+        print(f"{title:<22} {megabytes / elapsed:>8.1f} {peak_kb / 1024:>12.1f} "
+              f"{(cpu_after - cpu_before) * 1000 / megabytes:>11.2f}")
+
+
+def bench_photo_cache(args):
+    """Отдача трех последних фото (как на главной) с кэшем в памяти и без"""
+    report_header()
+    for cache_mb in ('0', '64'):
+        with run_server('--photo-cache-mb', cache_mb) as (port, _, _):
+            _, body, _ = request(port, 'GET', '/api/photos')
+            paths = [photo['url'] for photo in json.loads(body)['photos'][:3]]
+            latencies, errors = run_clients(port, paths, args.clients,
+                                            args.duration, keepalive=True)
+            report(f"кэш {cache_mb} МБ", latencies, errors, args.duration)
+            _, body, _ = request(port, 'GET', '/api/cache-stats')
+            print(f"    {json.loads(body)}")
+
+
+def bench_compression(args):
+    """Байты на проводе по маршрутам без сжатия, с gzip и brotli"""
+    routes = ['/', '/gallery', '/upload', '/about', '/contact', '/api/photos', '/api/time']
+    encodings = ['identity', 'gzip', 'br']
+    print(f"{'маршрут':<14}" + ''.join(f"{name:>12}" for name in encodings) + f"{'экономия':>10}")
+    totals = dict.fromkeys(encodings, 0)
+    with run_server() as (port, _, _):
+        for route in routes:
+            sizes = {}
+            for encoding in encodings:
+                _, body, response = request(port, 'GET', route,
+                                            headers={'Accept-Encoding': encoding})
+                used = response.getheader('Content-Encoding') or 'identity'
+                sizes[encoding] = len(body) if used == encoding else None
+            best = min(size for size in sizes.values() if size is not None)
+            for encoding in encodings:
+                totals[encoding] += sizes[encoding] or sizes['identity']
+            print(f"{route:<14}" + ''.join(
+                f"{size if size is not None else '-':>12}" for size in sizes.values())
+                + f"{100 - best * 100 / sizes['identity']:>9.0f}%")
+    print(f"{'всего':<14}" + ''.join(f"{totals[name]:>12}" for name in encodings))
+
+
+def wait_for_processing(port):
+    """Ожидание завершения фоновой обработки всех фото"""
+    while True:
+        _, body, _ = request(port, 'GET', '/api/jobs')
+        if not json.loads(body).get('active'):
+            return
+        time.sleep(0.05)
+
+
+def upload_photo(port, filename, data):
+    """Загрузка фото через форму, возвращает (задержка, ответ)"""
+    boundary = 'benchboundary'
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="photo"; '
+            f'filename="{filename}"\r\nContent-Type: image/jpeg\r\n\r\n').encode()
+    body += data + f'\r\n--{boundary}--\r\n'.encode()
+    started = time.perf_counter()
+    _, response, _ = request(port, 'POST', '/api/upload', body=body, headers={
+        'Content-Type': f'multipart/form-data; boundary={boundary}'})
+    return time.perf_counter() - started, json.loads(response)
+
+
+def bench_upload(args):
+    """Задержка загрузки фото: обработка сразу против фонового пула"""
+    photos_dir = os.path.join(ROOT, 'photos')
+    largest = max((name for name in os.listdir(photos_dir) if name.lower().endswith('.jpg')),
+                  key=lambda name: os.path.getsize(os.path.join(photos_dir, name)))
+    with open(os.path.join(photos_dir, largest), 'rb') as f:
+        data = f.read()
+    uploads = 10
+    print(f"{uploads} загрузок {largest} ({len(data) // 1024} КБ)")
+    print(f"{'обработка':<16}{'p50, мс':>10}{'p99, мс':>10}{'все готово, с':>16}")
+    for label, workers in (('сразу', '0'), ('фоновый пул', str(os.cpu_count() or 1))):
+        with run_server('--processing-workers', workers) as (port, _, _):
+            started = time.perf_counter()
+            latencies = [upload_photo(port, f'bench{i}.jpg', data)[0] for i in range(uploads)]
+            wait_for_processing(port)
+            total = time.perf_counter() - started
+        print(f"{label:<16}{percentile(latencies, 50) * 1000:>10.1f}"
+              f"{percentile(latencies, 99) * 1000:>10.1f}{total:>16.2f}")
+
+
+def bench_resize(args):
+    """Уменьшенные копии: первый запрос, повторный и одновременные первые"""
+    with run_server() as (port, _, _):
+        paths = [photo['url'] for photo in list_photos(port) if photo['type'] == 'photo']
+        print(f"{'запросы':<26}{'p50, мс':>10}{'p99, мс':>10}{'байт':>12}")
+        for label in ('первый (уменьшение)', 'повторный (с диска)'):
+            latencies, total = [], 0
+            for path in paths:
+                started = time.perf_counter()
+                _, body, _ = request(port, 'GET', path + '?w=640')
+                latencies.append(time.perf_counter() - started)
+                total += len(body)
+            print(f"{label:<26}{percentile(latencies, 50) * 1000:>10.1f}"
+                  f"{percentile(latencies, 99) * 1000:>10.1f}{total:>12}")
+        originals = sum(len(request(port, 'GET', path)[1]) for path in paths)
+        print(f"{'оригиналы':<26}{'':>20}{originals:>12}")
+        threads = [threading.Thread(target=request, args=(port, 'GET', paths[0] + '?w=320'))
+                   for _ in range(args.clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        _, body, _ = request(port, 'GET', '/api/cache-stats')
+        renders = json.loads(body)['derived_renders']
+        print(f"{args.clients} одновременных первых запросов одной копии: "
+              f"уменьшений всего {renders - len(paths)}")
+
+
+def bench_formats(args):
+    """WebP/AVIF: экономия байт по фото и скорость кодирования"""
+    accepts = {
+        'jpeg': 'image/jpeg,*/*',
+        'webp': 'image/webp,*/*',
+        'avif': 'image/avif,image/webp,*/*',
+    }
+    with run_server('--backfill') as (port, _, _):
+        wait_for_processing(port)
+        photos = [photo for photo in list_photos(port) if photo['type'] == 'photo']
+        print(f"{'фото':<34}" + ''.join(f"{name:>10}" for name in accepts) + f"{'экономия':>10}")
+        totals = dict.fromkeys(accepts, 0)
+        encode = {'webp': [0, 0.0], 'avif': [0, 0.0]}
+        for photo in photos:
+            sizes = {}
+            for name, accept in accepts.items():
+                _, data, response = request(port, 'GET', photo['url'], headers={'Accept': accept})
+                sizes[name] = len(data)
+                totals[name] += len(data)
+            best = min(sizes.values())
+            print(f"{photo['name'][:33]:<34}" + ''.join(f"{size:>10}" for size in sizes.values())
+                  + f"{100 - best * 100 / sizes['jpeg']:>9.0f}%")
+            _, body, _ = request(port, 'GET', '/api/jobs/' + urllib.parse.quote(photo['name']))
+            result = json.loads(body)['jobs'].get('modern_formats', {}).get('result') or {}
+            for name in encode:
+                if name in result:
+                    encode[name][0] += result['pixels']
+                    encode[name][1] += result[name]['seconds']
+        best = min(totals.values())
+        print(f"{'всего':<34}" + ''.join(f"{size:>10}" for size in totals.values())
+              + f"{100 - best * 100 / totals['jpeg']:>9.0f}%")
+        for name, (pixels, seconds) in encode.items():
+            if seconds:
+                print(f"кодирование {name}: {pixels / seconds / 1e6:.1f} Мпикс/с "
+                      f"({seconds / len(photos) * 1000:.0f} мс на фото)")
+
+
+def bench_placeholders(args):
+    """Цена заглушек плиток: размер страницы галереи и время ее сборки"""
+    with run_server('--backfill') as (port, _, _):
+        wait_for_processing(port)
+        _, page, _ = request(port, 'GET', '/gallery')
+        placeholders = re.findall(r'url\((data:[^)]+)\)', page.decode())
+        _, compressed, _ = request(port, 'GET', '/gallery', headers={'Accept-Encoding': 'br'})
+        print(f"плиток с заглушкой: {len(placeholders)}, средняя заглушка: "
+              f"{sum(map(len, placeholders)) // max(1, len(placeholders))} байт")
+        stripped = re.sub(r'\s*style="background: center / cover url\(data:[^)]+\)"', '',
+                          page.decode()).encode()
+        print(f"страница галереи: {len(page)} байт ({len(compressed)} с brotli), "
+              f"без заглушек {len(stripped)} байт")
+        latencies, errors = run_clients(port, ['/gallery'], 1, args.duration, keepalive=True)
+        report_header()
+        report("сборка /gallery", latencies, errors, args.duration)
+
+
+def copy_photos_setup(count):
+    """Код для run_server: размножить фото до count файлов перед запуском"""
+    return ("import os, shutil\n"
+            "names = sorted(n for n in os.listdir('photos') if n.endswith('.jpg'))\n"
+            f"for i in range({count}):\n"
+            "    name = names[i % len(names)]\n"
+            "    shutil.copy(os.path.join('photos', name), os.path.join('photos', f'copy{i}_{name}'))\n")
+
+
+def link_photos_setup(count):
+    """Код для run_server: count жестких ссылок на фото (большая галерея без
+    расхода места)"""
+    return ("import os\n"
+            "names = sorted(n for n in os.listdir('photos') if n.endswith('.jpg'))\n"
+            f"for i in range({count}):\n"
+            "    name = names[i % len(names)]\n"
+            "    os.link(os.path.join('photos', name), os.path.join('photos', f'link{i}_{name}'))\n")
+
+
+# Сервер без индекса фото: список собирается чтением папки
+WITHOUT_PHOTO_INDEX = """
+create_server = website.create_server
+def create_server_without_index(*args, **kwargs):
+    server = create_server(*args, **kwargs)
+    website.WebsiteHandler.photo_index = None
+    return server
+website.create_server = create_server_without_index
+"""
+
+
+def bench_listing(args):
+    """Главная страница и /api/photos на больших галереях: папка против индекса"""
+    print(f"{'фото':>8}  {'список':<8}{'/ p50, мс':>12}{'/api/photos p50, мс':>22}")
+    # /api/photos отдает первую страницу
+    for count in (100, 1000, 10000):
+        for label, setup in (('папка', WITHOUT_PHOTO_INDEX), ('индекс', '')):
+            with run_server('--processing-workers', '0',
+                            setup=link_photos_setup(count) + setup) as (port, _, _):
+                home, _ = run_clients(port, ['/'], 1, args.duration, keepalive=True)
+                api, _ = run_clients(port, ['/api/photos'], 1, args.duration, keepalive=True)
+            print(f"{count:>8}  {label:<8}{percentile(home, 50) * 1000:>12.2f}"
+                  f"{percentile(api, 50) * 1000:>22.2f}")
+
+
+def churn_photos(photos_dir, stop, batch=200):
+    """Добавление и удаление файлов в обход сайта до stop, возвращает число операций"""
+    names = sorted(n for n in os.listdir(photos_dir) if n.endswith('.jpg'))
+    added = []
+    operations = 0
+    while not stop.is_set():
+        for _ in range(batch):
+            name = names[operations % len(names)]
+            target = os.path.join(photos_dir, f'churn{operations}_{name}')
+            os.link(os.path.join(photos_dir, name), target)
+            added.append(target)
+            operations += 1
+        # Половину добавленного сразу удаляем
+        for target in added[:batch // 2]:
+            os.remove(target)
+            operations += 1
+        del added[:batch // 2]
+    return operations
+
+
+# Измеряется только список фото: фоновая обработка тысяч добавленных
+# файлов заняла бы все время сценария
+WITHOUT_ADDED_PROCESSING = ("website.WebsiteHandler.process_added_photos = "
+                            "classmethod(lambda cls, names: None)")
+
+
+def bench_watch(args):
+    """Стресс: тысячи файлов добавляются и удаляются в обход сайта под нагрузкой"""
+    print(f"{'наблюдение':<12}{'операций':>10}{'/ p50, мс':>12}{'/ p99, мс':>12}"
+          f"{'ошибок':>8}{'догнал за, с':>14}{'совпадает':>11}{'CPU, с':>8}")
+    # В pre-fork за папкой должен следить один процесс из четырех
+    for title, mode, extra in (('inotify', 'inotify', ()), ('poll', 'poll', ()),
+                               ('inotify x4', 'inotify', ('--processes', '4'))):
+        with run_server('--processing-workers', '0', '--photos-watch', mode,
+                        *extra, setup=WITHOUT_ADDED_PROCESSING) as (port, pid, workdir):
+            photos_dir = os.path.join(workdir, 'photos')
+            cpu_before = process_tree_cpu(pid)
+            stop = threading.Event()
+            operations = []
+            churn = threading.Thread(
+                target=lambda: operations.append(churn_photos(photos_dir, stop)))
+            churn.start()
+            latencies, errors = run_clients(port, ['/'], args.clients, args.duration,
+                                            keepalive=True)
+            stop.set()
+            churn.join()
+            expected = sorted(n for n in os.listdir(photos_dir) if n.endswith(('.jpg', '.mp4')))
+            started = time.perf_counter()
+            while True:
+                # Несколько запросов подряд: в pre-fork они попадают в разные процессы
+                listed = [sorted(photo['name'] for photo in list_photos(port))
+                          for _ in range(8)]
+                matches = all(names == expected for names in listed)
+                if matches or time.perf_counter() - started > 30:
+                    break
+                time.sleep(0.05)
+            caught_up = time.perf_counter() - started
+            cpu = process_tree_cpu(pid) - cpu_before
+            print(f"{title:<12}{operations[0]:>10}{percentile(latencies, 50) * 1000:>12.2f}"
+                  f"{percentile(latencies, 99) * 1000:>12.2f}{errors:>8}"
+                  f"{caught_up:>14.2f}{'да' if matches else 'нет':>11}{cpu:>8.1f}")
+
+
+def bench_pagination(args):
+    """Галерея и /api/photos по страницам: время ответа от размера галереи"""
+    print(f"{'фото':>8}{'/gallery, мс':>14}{'байт':>10}{'1-я стр. API, мс':>18}"
+          f"{'стр. в середине, мс':>21}{'все стр., с':>13}")
+    for count in (100, 1000, 10000):
+        with run_server('--processing-workers', '0',
+                        setup=link_photos_setup(count)) as (port, _, _):
+            _, page, _ = request(port, 'GET', '/gallery')
+            gallery, _ = run_clients(port, ['/gallery'], 1, args.duration, keepalive=True)
+            first, _ = run_clients(port, ['/api/photos?limit=48'], 1, args.duration,
+                                   keepalive=True)
+            # Проход по всем страницам, как при прокрутке до конца
+            started = time.perf_counter()
+            cursors, path = [], '/api/photos?limit=48'
+            while True:
+                cursor = json.loads(request(port, 'GET', path)[1])['next_cursor']
+                if cursor is None:
+                    break
+                cursors.append(cursor)
+                path = '/api/photos?limit=48&cursor=' + cursor
+            walk = time.perf_counter() - started
+            middle = '/api/photos?limit=48&cursor=' + cursors[len(cursors) // 2]
+            deep, _ = run_clients(port, [middle], 1, args.duration, keepalive=True)
+        print(f"{count + 17:>8}{percentile(gallery, 50) * 1000:>14.2f}{len(page):>10}"
+              f"{percentile(first, 50) * 1000:>18.2f}{percentile(deep, 50) * 1000:>21.2f}"
+              f"{walk:>13.2f}")
+
+
+def render_page(handler_class, method, memoize=True):
+    """Сборка страницы обработчиком без сокета, возвращает HTML"""
+    handler = handler_class.__new__(handler_class)
+    handler.headers = {}
+    handler.memo = {}
+    if not memoize:
+        handler.memoized = lambda key, compute, *args: compute(*args)
+    pages = []
+    handler.send_html_response = lambda html_content, status=200, validators=None: \
+        pages.append(html_content)
+    getattr(handler, method)()
+    return pages[0]
+
+
+def time_call(func, rounds, budget=0.5):
+    """Среднее время вызова: rounds раз, но не дольше budget секунд (минимум один)"""
+    started = time.perf_counter()
+    calls = 0
+    while calls < rounds and (calls == 0 or time.perf_counter() - started < budget):
+        func()
+        calls += 1
+    return (time.perf_counter() - started) / calls
+
+
+def bench_home(args):
+    """Микробенчмарк: сборка главной страницы от числа фото (10 - 100 тыс.)"""
+    sys.path.insert(0, ROOT)
+    import website
+    handler = website.WebsiteHandler
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    handler.PHOTOS_DIR = os.path.join(workdir, 'photos')
+    os.makedirs(handler.PHOTOS_DIR)
+    index = website.PhotoIndex(os.path.join(workdir, 'photos.sqlite3'))
+    variants = ('папка без memo', 'папка', 'индекс', 'память')
+    print(f"{'фото':>8}" + ''.join(f"{label + ', мс':>20}" for label in variants))
+    created = 0
+    try:
+        for count in (10, 100, 1000, 10000, 100000):
+            # Пустые файлы с временем съемки в имени и записи индекса для них
+            items = []
+            for i in range(created, count):
+                taken = 1700000000 + i * 60
+                name = time.strftime('%Y-%m-%d_%H-%M-%S', time.localtime(taken)) + f'_{i}.jpg'
+                open(os.path.join(handler.PHOTOS_DIR, name), 'wb').close()
+                items.append((name, {'modified': taken, 'captured': taken, 'width': 1280,
+                                     'height': 960, 'orientation': 1, 'camera': None}))
+            index.update_many(items)
+            created = count
+            listing = website.PhotoListing(index, handler.PHOTOS_DIR, handler.PHOTO_EXTENSIONS)
+            timings = []
+            for label in variants:
+                handler.photo_index = index if label in ('индекс', 'память') else None
+                handler.photo_listing = listing if label == 'память' else None
+                timings.append(time_call(
+                    lambda: render_page(handler, 'send_home_page', label != 'папка без memo'),
+                    args.rounds * 20))
+            print(f"{count:>8}" + ''.join(f"{elapsed * 1000:>20.2f}" for elapsed in timings))
+    finally:
+        index.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def bench_metadata(args):
+    """Список фото до и после индексации метаданных, скорость --reindex"""
+    count = 2000
+    with run_server(setup=copy_photos_setup(count)) as (port, _, workdir):
+        report_header()
+        latencies, errors = run_clients(port, ['/api/photos'], 1, args.duration, keepalive=True)
+        report("/api/photos, без индекса", latencies, errors, args.duration)
+        started = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, '-c', "import sys, website; website.main(sys.argv[1:])",
+             '--reindex'], cwd=workdir, env=dict(os.environ, PYTHONPATH=ROOT),
+            capture_output=True, text=True).stdout.strip()
+        reindex_time = time.perf_counter() - started
+        latencies, errors = run_clients(port, ['/api/photos'], 1, args.duration, keepalive=True)
+        report("/api/photos, с индексом", latencies, errors, args.duration)
+        print(output)
+        print(f"--reindex вместе с запуском интерпретатора: {reindex_time:.2f} с")
+
+
+def bench_dimensions(args):
+    """Размеры фото: разбор заголовков против полного декодирования, разметка"""
+    sys.path.insert(0, ROOT)
+    import website
+    photos_dir = os.path.join(ROOT, 'photos')
+    paths = [os.path.join(photos_dir, name) for name in sorted(os.listdir(photos_dir))
+             if name.lower().endswith(website.WebsiteHandler.PHOTO_EXTENSIONS)]
+    readers = {'заголовки (индекс)': lambda path: website.extract_metadata(path)['width']}
+    if website.Image is not None:
+        def decode(path):
+            with website.Image.open(path) as image:
+                image.load()
+                return image.width
+        readers['декодирование Pillow'] = decode
+    print(f"{'способ':<24}{'мкс на фото':>14}")
+    for label, reader in readers.items():
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            for path in paths:
+                reader(path)
+        elapsed = (time.perf_counter() - started) / args.rounds / len(paths)
+        print(f"{label:<24}{elapsed * 1e6:>14.0f}")
+    with run_server('--backfill') as (port, _, _):
+        wait_for_processing(port)
+        _, page, _ = request(port, 'GET', '/gallery')
+        tiles = re.findall(r'<img src="/photos/[^>]*>', page.decode())
+        sized = [tile for tile in tiles if 'width="' in tile and 'height="' in tile]
+        print(f"плиток галереи с width/height: {len(sized)} из {len(tiles)}")
+
+
+def bench_optimize(args):
+    """Оптимизация JPEG при загрузке: уменьшение каждого файла и трафика оригиналов"""
+    with run_server('--backfill') as (port, _, _):
+        wait_for_processing(port)
+        photos = [photo for photo in list_photos(port) if photo['type'] == 'photo']
+        print(f"{'фото':<34}{'было':>10}{'стало':>10}{'экономия':>10}")
+        before = after = served = 0
+        for photo in photos:
+            _, body, _ = request(port, 'GET', '/api/jobs/' + urllib.parse.quote(photo['name']))
+            result = json.loads(body)['jobs'].get('optimize', {}).get('result')
+            if not result:
+                continue
+            before += result['original']
+            after += result['optimized']
+            saved = result['original'] - result['optimized']
+            print(f"{photo['name'][:33]:<34}{result['original']:>10}{result['optimized']:>10}"
+                  f"{saved * 100 / result['original']:>9.1f}%")
+            served += len(request(port, 'GET', photo['url'], headers={'Accept': 'image/jpeg'})[1])
+        if before:
+            print(f"{'всего (' + result['tool'] + ')':<34}{before:>10}{after:>10}"
+                  f"{(before - after) * 100 / before:>9.1f}%")
+            print(f"serve_photo: {served} байт на просмотр всех оригиналов, "
+                  f"экономия {before - after} байт на каждый просмотр")
+
+
+def directory_size(path):
+    """Суммарный размер файлов папки"""
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def bench_dedupe(args):
+    """Повторная загрузка тех же фото: трафик и место на диске"""
+    photos_dir = os.path.join(ROOT, 'photos')
+    files = {name: open(os.path.join(photos_dir, name), 'rb').read()
+             for name in sorted(os.listdir(photos_dir)) if name.lower().endswith('.jpg')}
+    print(f"{'загрузка':<34}{'передано, байт':>16}{'рост папки, байт':>18}{'дублей':>8}")
+    with run_server('--processing-workers', '0') as (port, _, workdir):
+        photos = os.path.join(workdir, 'photos')
+        # Лежащие в photos/ копии не проиндексированы (нет --backfill),
+        # поэтому первая загрузка сохраняет все файлы
+        for label, precheck in (('первая загрузка', False),
+                                ('повтор с /api/has-hash', True),
+                                ('повтор без проверки хэша', False)):
+            before = directory_size(photos)
+            sent = duplicates = 0
+            for name, data in files.items():
+                if precheck:
+                    digest = hashlib.sha256(data).hexdigest()
+                    _, body, _ = request(port, 'GET', '/api/has-hash/' + digest)
+                    sent += len('/api/has-hash/' + digest)
+                    if json.loads(body)['exists']:
+                        duplicates += 1
+                        continue
+                _, result = upload_photo(port, name, data)
+                sent += len(data)
+                duplicates += bool(result.get('duplicate'))
+            print(f"{label:<34}{sent:>16}{directory_size(photos) - before:>18}{duplicates:>8}")
+
+
+BURST_SETUP = """
+import os
+from PIL import Image
+for name in sorted(os.listdir('photos')):
+    if not name.endswith('.jpg'):
+        continue
+    stem = os.path.join('photos', name[:-4])
+    with Image.open(stem + '.jpg') as image:
+        # Соседние кадры серии: пересжатый уменьшенный и чуть обрезанный
+        image.resize((image.width * 9 // 10, image.height * 9 // 10)).save(
+            stem + '_b1.jpg', quality=70)
+        dx, dy = image.width // 50, image.height // 50
+        image.crop((dx, dy, image.width - dx, image.height - dy)).save(
+            stem + '_b2.jpg', quality=85)
+"""
+
+
+def random_hashes(count, seed=1):
+    """Случайные 64-битные хэши, у каждого двадцатого есть близкий двойник"""
+    import random
+    generator = random.Random(seed)
+    hashes = {}
+    for i in range(count - count // 20):
+        value = generator.getrandbits(64)
+        hashes[f'photo{i}'] = value
+        if i % 19 == 0 and len(hashes) < count:
+            for bit in generator.sample(range(64), generator.randint(0, 6)):
+                value ^= 1 << bit
+            hashes[f'photo{i}_burst'] = value
+    return hashes
+
+
+def bench_duplicates(args):
+    """Похожие фото: поиск по перцептивным хэшам и сворачивание серий"""
+    sys.path.insert(0, ROOT)
+    import website
+    backends = {'numpy': website.numpy} if website.numpy is not None else {}
+    backends['python'] = None
+    print(f"{'хэшей':>8}{'поиск':>8}{'одно фото, мс':>16}{'все группы, мс':>16}{'групп':>8}")
+    for count in (1000, 10000, 50000):
+        hashes = random_hashes(count)
+        query = hashes['photo0']
+        for label, module in backends.items():
+            website.numpy = module
+            index = website.HammingIndex(hashes)
+            started = time.perf_counter()
+            for _ in range(args.rounds):
+                index.near(query, website.DEFAULT_DUPLICATE_DISTANCE)
+            near_time = (time.perf_counter() - started) / args.rounds
+            started = time.perf_counter()
+            clusters = index.clusters(website.DEFAULT_DUPLICATE_DISTANCE)
+            print(f"{len(hashes):>8}{label:>8}{near_time * 1000:>16.2f}"
+                  f"{(time.perf_counter() - started) * 1000:>16.0f}{len(clusters):>8}")
+    website.numpy = backends.get('numpy')
+    with run_server('--backfill', '--collapse-bursts', setup=BURST_SETUP) as (port, _, _):
+        wait_for_processing(port)
+        _, body, _ = request(port, 'GET', '/api/duplicates')
+        result = json.loads(body)
+        print(f"фото с хэшем: {result['hashed']}, групп похожих: {len(result['clusters'])}, "
+              f"в них фото: {sum(cluster['size'] for cluster in result['clusters'])}")
+        _, page, _ = request(port, 'GET', '/gallery')
+        tiles = re.findall(r'<div class="photo-item"([^>]*)>', page.decode())
+        print(f"плиток галереи: {len(tiles)}, видно сразу: "
+              f"{sum(1 for attributes in tiles if ' hidden' not in attributes)}")
+
+
+def pick_candidate(srcset, width):
+    """Кандидат из srcset, который выбрал бы браузер для нужной ширины в пикселях"""
+    candidates = sorted((int(w), url) for url, w in re.findall(r'(\S+) (\d+)w', srcset))
+    for candidate_width, url in candidates:
+        if candidate_width >= width:
+            return url
+    return candidates[-1][1]
+
+
+def bench_thumbnails(args):
+    """Байты изображений для загрузки галереи: оригиналы против srcset"""
+    tile_width = 400
+    with run_server('--backfill') as (port, _, _):
+        wait_for_processing(port)
+        _, page, _ = request(port, 'GET', '/gallery')
+        images = re.findall(r'<img src="([^"]+)"\s*(?:srcset="([^"]+)")?', page.decode())
+        print(f"фото в галерее: {len(images)}, с миниатюрами: {sum(1 for _, s in images if s)}")
+        print(f"{'вариант':<22}{'байт':>12}{'экономия':>10}")
+        totals = {}
+        for label, dpr in (('оригиналы', None), ('srcset, DPR 1', 1), ('srcset, DPR 2', 2)):
+            total = 0
+            for src, srcset in images:
+                url = pick_candidate(srcset, tile_width * dpr) if dpr and srcset else src
+                _, body, _ = request(port, 'GET', url)
+                total += len(body)
+            totals[label] = total
+            print(f"{label:<22}{total:>12}{100 - total * 100 / totals['оригиналы']:>9.0f}%")
+
+
+SCENARIOS = {
+    'compression': bench_compression,
+    'concurrency': bench_concurrency,
+    'dedupe': bench_dedupe,
+    'dimensions': bench_dimensions,
+    'duplicates': bench_duplicates,
+    'formats': bench_formats,
+    'home': bench_home,
+    'idle': bench_idle,
+    'keepalive': bench_keepalive,
+    'listing': bench_listing,
+    'metadata': bench_metadata,
+    'optimize': bench_optimize,
+    'pagination': bench_pagination,
+    'photo-cache': bench_photo_cache,
+    'placeholders': bench_placeholders,
+    'prefork': bench_prefork,
+    'resize': bench_resize,
+    'sendfile': bench_sendfile,
+    'thumbnails': bench_thumbnails,
+    'upload': bench_upload,
+    'watch': bench_watch,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарки сайта")
+    parser.add_argument('scenario', choices=sorted(SCENARIOS))
+    parser.add_argument('--clients', type=int, default=8,
+                        help="количество параллельных клиентов")
+    parser.add_argument('--duration', type=float, default=5.0,
+                        help="длительность замера в секундах")
+    parser.add_argument('--rounds', type=int, default=5,
+                        help="сколько раз каждый клиент скачивает набор файлов")
+    parser.add_argument('--idle', type=int, default=1000,
+                        help="количество простаивающих соединений (idle)")
+    args = parser.parse_args(argv)
+    SCENARIOS[args.scenario](args)
+
+
+if __name__ == '__main__':
+    main()
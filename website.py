@@ -11,12 +11,2255 @@ import json
 from datetime import datetime
 import os
 import base64
+import bisect
+import ctypes
+import ctypes.util
 import mimetypes
+import argparse
+import asyncio
+import email.utils
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
+import math
+import multiprocessing
+import queue
+import re
+import select
+import selectors
+import shutil
+import signal
+import socket
+import sqlite3
+import struct
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+try:
+    import brotli
+except ImportError:  # brotli необязателен, без него сжимаем только gzip
+    brotli = None
+
+try:
+    import numpy
+except ImportError:  # numpy необязателен, без него похожие фото ищутся медленнее
+    numpy = None
+
+try:
+    import fcntl
+except ImportError:  # не Unix: одновременную обработку согласуем только между потоками
+    fcntl = None
+
+try:
+    from PIL import Image, ImageOps, features as image_features
+except ImportError:  # Pillow необязателен, без него галерея показывает оригиналы
+    Image = ImageOps = image_features = None
+
+# Настройки пула обработчиков по умолчанию
+DEFAULT_WORKERS = 16
+DEFAULT_QUEUE_SIZE = 64
+DEFAULT_TIMEOUT = 30
+# Очередь непринятых соединений в ядре (у socketserver по умолчанию всего 5)
+DEFAULT_BACKLOG = 1024
+
+def _source_version():
+    """Хэш и время изменения кода сайта - от них зависят все страницы"""
+    try:
+        with open(__file__, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()[:12]
+        return digest, os.stat(__file__).st_mtime
+    except OSError:
+        return '0', 0
+
+
+SITE_VERSION, SITE_MTIME = _source_version()
+
+# Контейнеры MP4, внутри которых лежат таблицы смещений чанков (stco/co64)
+MP4_CONTAINER_BOXES = {b'moov', b'trak', b'mdia', b'minf', b'stbl'}
+
+
+def _read_mp4_boxes(f, start, end):
+    """Список боксов MP4 (тип, начало, размер, размер заголовка) в диапазоне файла"""
+    boxes = []
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        size, box_type = struct.unpack('>I4s', f.read(8))
+        header_size = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size or offset + size > end:
+            raise ValueError(f"повреждённый бокс {box_type!r} на позиции {offset}")
+        boxes.append((box_type, offset, size, header_size))
+        offset += size
+    return boxes
+
+
+def _shift_chunk_offsets(moov, shift_from, shift_to, delta):
+    """Сдвиг смещений чанков в stco/co64 внутри moov на delta байт
+
+    Сдвигаются только смещения, попадающие в [shift_from, shift_to).
+    """
+    def walk(start, end):
+        offset = start
+        while offset + 8 <= end:
+            size, box_type = struct.unpack_from('>I4s', moov, offset)
+            header_size = 8
+            if size == 1:
+                size = struct.unpack_from('>Q', moov, offset + 8)[0]
+                header_size = 16
+            elif size == 0:
+                size = end - offset
+            if size < header_size or offset + size > end:
+                raise ValueError("повреждённый бокс внутри moov")
+            body = offset + header_size
+            if box_type == b'cmov':
+                raise ValueError("сжатый moov не поддерживается")
+            if box_type in MP4_CONTAINER_BOXES:
+                walk(body, offset + size)
+            elif box_type in (b'stco', b'co64'):
+                count = struct.unpack_from('>I', moov, body + 4)[0]
+                item_format, item_size = ('>I', 4) if box_type == b'stco' else ('>Q', 8)
+                for i in range(count):
+                    position = body + 8 + i * item_size
+                    value = struct.unpack_from(item_format, moov, position)[0]
+                    if shift_from <= value < shift_to:
+                        value += delta
+                        if box_type == b'stco' and value > 0xFFFFFFFF:
+                            raise ValueError("смещение не помещается в stco")
+                        struct.pack_into(item_format, moov, position, value)
+            offset += size
+
+    walk(0, len(moov))
+
+
+def make_mp4_faststart(filepath):
+    """Перенос бокса moov в начало MP4 (fast start)
+
+    Без этого браузер должен скачать весь файл, прежде чем узнает, как его
+    воспроизводить. Файл переписывается через временную копию и заменяется
+    атомарно. Возвращает True, если файл был изменён.
+    """
+    with open(filepath, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        boxes = _read_mp4_boxes(f, 0, file_size)
+        types = [box[0] for box in boxes]
+        if b'moov' not in types or b'mdat' not in types or b'moof' in types:
+            return False
+        moov_index = types.index(b'moov')
+        mdat_index = types.index(b'mdat')
+        if moov_index < mdat_index:
+            return False
+
+        _, moov_offset, moov_size, _ = boxes[moov_index]
+        f.seek(moov_offset)
+        moov = bytearray(f.read(moov_size))
+        # Все, что лежало между первым mdat и moov, сдвинется на размер moov
+        _shift_chunk_offsets(moov, boxes[mdat_index][1], moov_offset, moov_size)
+
+        order = boxes[:mdat_index] + [boxes[moov_index]] + \
+            [box for box in boxes[mdat_index:] if box[0] != b'moov']
+        tmp_path = filepath + '.faststart.tmp'
+        try:
+            with open(tmp_path, 'wb') as out:
+                for box_type, offset, size, _ in order:
+                    if box_type == b'moov':
+                        out.write(moov)
+                        continue
+                    f.seek(offset)
+                    remaining = size
+                    while remaining:
+                        chunk = f.read(min(1024 * 1024, remaining))
+                        if not chunk:
+                            raise ValueError("файл укоротился во время обработки")
+                        out.write(chunk)
+                        remaining -= len(chunk)
+            shutil.copymode(filepath, tmp_path)
+            os.replace(tmp_path, filepath)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    return True
+
+
+# Метаданные фото читаются из EXIF без Pillow и без декодирования:
+# нужные теги TIFF -> (IFD, имя)
+EXIF_TAGS = {
+    0x010F: 'make',
+    0x0110: 'model',
+    0x0112: 'orientation',
+    0x0132: 'datetime',
+    0x8769: 'exif_ifd',
+    0x9003: 'datetime_original',
+}
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8}
+# Маркеры JPEG с размерами кадра (SOF), кроме DHT, JPG и DAC
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def _parse_tiff_tags(data):
+    """Нужные теги EXIF из блока TIFF (IFD0 и Exif IFD)"""
+    if data[:2] == b'II':
+        order = '<'
+    elif data[:2] == b'MM':
+        order = '>'
+    else:
+        raise ValueError("нет заголовка TIFF")
+    tags = {}
+    pending = [struct.unpack(order + 'I', data[4:8])[0]]
+    visited = set()
+    while pending:
+        offset = pending.pop()
+        if offset in visited or offset + 2 > len(data):
+            continue
+        visited.add(offset)
+        count = struct.unpack(order + 'H', data[offset:offset + 2])[0]
+        for index in range(count):
+            entry = offset + 2 + index * 12
+            if entry + 12 > len(data):
+                break
+            tag, value_type, value_count = struct.unpack(order + 'HHI', data[entry:entry + 8])
+            name = EXIF_TAGS.get(tag)
+            size = TIFF_TYPE_SIZES.get(value_type)
+            if name is None or size is None:
+                continue
+            value = data[entry + 8:entry + 12]
+            if size * value_count > 4:
+                value_offset = struct.unpack(order + 'I', value)[0]
+                value = data[value_offset:value_offset + size * value_count]
+            if value_type == 2:
+                tags[name] = value.split(b'\0', 1)[0].decode('ascii', 'replace').strip()
+            elif value_type == 3:
+                tags[name] = struct.unpack(order + 'H', value[:2])[0]
+            elif value_type == 4:
+                tags[name] = struct.unpack(order + 'I', value[:4])[0]
+        if 'exif_ifd' in tags:
+            pending.append(tags.pop('exif_ifd'))
+    return tags
+
+
+def _read_jpeg_segments(f):
+    """EXIF (блок TIFF) и размер кадра из заголовков JPEG"""
+    exif, size = None, None
+    f.seek(2)
+    while size is None:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            break
+        if marker[1] == 0xFF:  # заполняющий байт
+            f.seek(-1, os.SEEK_CUR)
+            continue
+        if marker[1] in (0xD8, 0x01) or 0xD0 <= marker[1] <= 0xD7:
+            continue
+        if marker[1] in (0xD9, 0xDA):  # конец файла или начало данных
+            break
+        length = struct.unpack('>H', f.read(2))[0]
+        if marker[1] == 0xE1 and exif is None:
+            segment = f.read(length - 2)
+            if segment.startswith(b'Exif\0\0'):
+                exif = segment[6:]
+            continue
+        if marker[1] in JPEG_SOF_MARKERS:
+            height, width = struct.unpack('>xHH', f.read(5))
+            size = (width, height)
+            break
+        f.seek(length - 2, os.SEEK_CUR)
+    return exif, size
+
+
+def _read_image_size(f, head):
+    """Размеры PNG, GIF или WebP по первым байтам файла (head) или None"""
+    if head.startswith(b'\x89PNG\r\n\x1a\n') and head[12:16] == b'IHDR':
+        return struct.unpack('>II', head[16:24])
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return struct.unpack('<HH', head[6:10])
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        chunk = head[12:16]
+        if chunk == b'VP8 ':  # с потерями: 14 бит на размер после сигнатуры кадра
+            width, height = struct.unpack('<HH', head[26:30])
+            return width & 0x3FFF, height & 0x3FFF
+        if chunk == b'VP8L':  # без потерь: 14 + 14 бит (размер минус один)
+            bits = int.from_bytes(head[21:25], 'little')
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b'VP8X':  # расширенный: холст 24 + 24 бита (минус один)
+            return (int.from_bytes(head[24:27], 'little') + 1,
+                    int.from_bytes(head[27:30], 'little') + 1)
+    return None
+
+
+def _parse_exif_time(value):
+    """Время съемки EXIF (местное, 'ГГГГ:ММ:ДД ЧЧ:ММ:СС') в timestamp"""
+    try:
+        return datetime.strptime(value[:19], '%Y:%m:%d %H:%M:%S').timestamp()
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+# Дата в имени файла: экспорт из мессенджеров и камер не сохраняет EXIF,
+# но пишет время съемки в имя (photo_2025-11-11_16-56-37.jpg)
+NAME_TIME = re.compile(r'(\d{4})-?(\d{2})-?(\d{2})[_ T-](\d{2})[-:.]?(\d{2})[-:.]?(\d{2})')
+# Префикс, который добавляет handle_photo_upload (время загрузки, а не съемки)
+UPLOAD_PREFIX = re.compile(r'^\d{8}_\d{6}_')
+
+
+def capture_time_from_name(filename):
+    """Время съемки из имени файла или None"""
+    original_name = UPLOAD_PREFIX.sub('', filename)
+    match = NAME_TIME.search(original_name)
+    if match is None:
+        return None
+    try:
+        return datetime(*map(int, match.groups())).timestamp()
+    except (ValueError, OverflowError):
+        return None
+
+
+def extract_metadata(filepath):
+    """Метаданные фото для индекса: время съемки, размеры, ориентация, камера
+    
+    Читаются только заголовки файла: размеры - из JPEG, PNG, GIF и WebP.
+    Без EXIF время съемки берется из имени файла, остальные поля, которые
+    не удалось прочитать, равны None.
+    """
+    stat = os.stat(filepath)
+    exif, size = None, None
+    with open(filepath, 'rb') as f:
+        head = f.read(32)
+        try:
+            if head.startswith(b'\xff\xd8'):
+                exif, size = _read_jpeg_segments(f)
+            else:
+                size = _read_image_size(f, head)
+        except struct.error:
+            pass
+    tags = {}
+    if exif:
+        try:
+            tags = _parse_tiff_tags(exif)
+        except (ValueError, struct.error):
+            tags = {}
+    camera = ' '.join(part for part in (tags.get('make'), tags.get('model')) if part)
+    captured = _parse_exif_time(tags.get('datetime_original') or tags.get('datetime'))
+    return {
+        'modified': stat.st_mtime,
+        'captured': captured or capture_time_from_name(os.path.basename(filepath)),
+        'width': size[0] if size else None,
+        'height': size[1] if size else None,
+        'orientation': tags.get('orientation') or 1,
+        'camera': camera or None,
+    }
+
+
+def extract_metadata_safe(filepath):
+    """extract_metadata для пакетной обработки: (метаданные, ошибка)"""
+    try:
+        return extract_metadata(filepath), None
+    except OSError as e:
+        return None, str(e)
+
+
+# Оптимизация JPEG при загрузке. С jpegtran ориентация поворачивается без
+# потерь и таблицы Хаффмана оптимизируются; без него только удаляются
+# лишние метаданные, а ориентация остается в EXIF.
+JPEGTRAN = shutil.which('jpegtran')
+JPEGTRAN_TRANSFORMS = {
+    2: ['-flip', 'horizontal'],
+    3: ['-rotate', '180'],
+    4: ['-flip', 'vertical'],
+    5: ['-transpose'],
+    6: ['-rotate', '90'],
+    7: ['-transverse'],
+    8: ['-rotate', '270'],
+}
+# Сегменты APPn, которые нужны для правильных цветов: JFIF, ICC и Adobe
+JPEG_KEPT_APP_SEGMENTS = {0xE0: b'JFIF\0', 0xE2: b'ICC_PROFILE\0', 0xEE: b'Adobe'}
+
+
+def build_exif_segment(captured=None, orientation=1):
+    """Минимальный сегмент APP1 с EXIF: время съемки и ориентация"""
+    entries = []  # (тег, тип, количество, значение или данные)
+    if orientation and orientation != 1:
+        entries.append((0x0112, 3, 1, struct.pack('<HH', orientation, 0)))
+    if captured:
+        entries.append((0x8769, 4, 1, None))
+    if not entries:
+        return b''
+    ifd0_size = 2 + 12 * len(entries) + 4
+    exif_ifd_offset = 8 + ifd0_size
+    tiff = b'II*\x00' + struct.pack('<I', 8) + struct.pack('<H', len(entries))
+    for tag, value_type, count, value in entries:
+        if value is None:
+            value = struct.pack('<I', exif_ifd_offset)
+        tiff += struct.pack('<HHI', tag, value_type, count) + value
+    tiff += b'\x00\x00\x00\x00'
+    if captured:
+        date = captured.encode('ascii')[:19] + b'\x00'
+        date_offset = exif_ifd_offset + 2 + 12 + 4
+        tiff += (struct.pack('<H', 1)
+                 + struct.pack('<HHII', 0x9003, 2, len(date), date_offset)
+                 + b'\x00\x00\x00\x00' + date)
+    payload = b'Exif\x00\x00' + tiff
+    return b'\xff\xe1' + struct.pack('>H', len(payload) + 2) + payload
+
+
+def strip_jpeg_metadata(data, exif_segment=b''):
+    """JPEG без EXIF, XMP, комментариев и превью; exif_segment ставится после SOI"""
+    if not data.startswith(b'\xff\xd8'):
+        raise ValueError("не JPEG")
+    output = [b'\xff\xd8', exif_segment]
+    position = 2
+    while position + 4 <= len(data):
+        if data[position] != 0xFF:
+            raise ValueError(f"поврежденный маркер на позиции {position}")
+        marker = data[position + 1]
+        if marker == 0xFF:
+            position += 1
+            continue
+        if marker == 0xDA:  # дальше сжатые данные - копируем как есть
+            output.append(data[position:])
+            return b''.join(output)
+        length = struct.unpack('>H', data[position + 2:position + 4])[0]
+        segment = data[position:position + 2 + length]
+        metadata = 0xE0 <= marker <= 0xEF or marker == 0xFE
+        if not metadata or segment[4:].startswith(JPEG_KEPT_APP_SEGMENTS.get(marker, b'\xff')):
+            output.append(segment)
+        position += 2 + length
+    raise ValueError("нет данных изображения")
+
+
+def optimize_jpeg(filepath, archive_dir):
+    """Оптимизация JPEG на месте, оригинал переносится в archive_dir
+    
+    Сохраняются только время съемки, ICC-профиль (и ориентация, если ее
+    нельзя применить без потерь). Файл не меняется, если это ничего не
+    дает. Время изменения у нового файла свое: по Last-Modified клиенты
+    отличают его от оригинала (If-Range, If-Modified-Since).
+    """
+    with open(filepath, 'rb') as f:
+        data = f.read()
+        f.seek(2)
+        exif, _ = _read_jpeg_segments(f)
+    tags = {}
+    if exif:
+        try:
+            tags = _parse_tiff_tags(exif)
+        except (ValueError, struct.error):
+            tags = {}
+    orientation = tags.get('orientation') or 1
+    captured = tags.get('datetime_original') or tags.get('datetime')
+    
+    optimized, baked = None, False
+    if JPEGTRAN:
+        transform = JPEGTRAN_TRANSFORMS.get(orientation, [])
+        for extra in ([*transform, '-perfect'], []) if transform else ([],):
+            process = subprocess.run(
+                [JPEGTRAN, '-copy', 'icc', '-optimize', '-progressive', *extra],
+                input=data, capture_output=True)
+            if process.returncode == 0 and process.stdout:
+                optimized, baked = process.stdout, bool(extra)
+                break
+    exif_segment = build_exif_segment(captured, 1 if baked else orientation)
+    optimized = strip_jpeg_metadata(optimized or data, exif_segment)
+    
+    result = {'original': len(data), 'optimized': len(data), 'orientation_baked': False,
+              'tool': 'jpegtran' if JPEGTRAN else 'strip'}
+    if len(optimized) >= len(data) and not baked:
+        return result
+    os.makedirs(archive_dir, exist_ok=True)
+    archived = os.path.join(archive_dir, os.path.basename(filepath))
+    tmp_path = f"{filepath}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(optimized)
+    try:
+        os.link(filepath, archived)
+    except FileExistsError:
+        pass
+    except OSError:
+        shutil.copy2(filepath, archived)
+    os.replace(tmp_path, filepath)
+    result.update(optimized=len(optimized), orientation_baked=baked)
+    return result
+
+
+def remove_archived(name, archive_dir):
+    """Удаление оригинала удаленного фото из архива"""
+    try:
+        os.remove(os.path.join(archive_dir, name))
+    except FileNotFoundError:
+        pass
+
+
+# Миниатюры: имя файла <фото>.<ширина>w.jpg в одной папке, чтобы
+# список всех миниатюр читался одним listdir
+THUMBNAIL_NAME = re.compile(r'^(.+)\.(\d+)w\.jpg$')
+THUMBNAIL_QUALITY = 80
+
+
+def thumbnail_name(name, width):
+    """Имя файла миниатюры фото заданной ширины"""
+    return f"{name}.{width}w.jpg"
+
+
+def flatten_for_jpeg(image):
+    """Изображение без прозрачности (она заливается белым) для сохранения в JPEG"""
+    if image.mode in ('RGB', 'L'):
+        return image
+    rgba = image.convert('RGBA')
+    background = Image.new('RGB', image.size, 'white')
+    background.paste(rgba, mask=rgba.getchannel('A'))
+    return background
+
+
+def generate_thumbnails(filepath, thumbs_dir, widths):
+    """Создание миниатюр фото нескольких ширин
+
+    Миниатюры шире оригинала не создаются. Ориентация из EXIF
+    применяется сразу, так как в миниатюрах EXIF нет. Возвращает
+    список ширин созданных миниатюр.
+    """
+    if Image is None:
+        return []
+    os.makedirs(thumbs_dir, exist_ok=True)
+    name = os.path.basename(filepath)
+    created = []
+    with Image.open(filepath) as original:
+        image = flatten_for_jpeg(ImageOps.exif_transpose(original))
+        # От большей ширины к меньшей: каждую следующую уменьшаем из предыдущей
+        for width in sorted(widths, reverse=True):
+            if width >= image.width:
+                continue
+            height = max(1, round(image.height * width / image.width))
+            image = image.resize((width, height), Image.LANCZOS, reducing_gap=3.0)
+            target = os.path.join(thumbs_dir, thumbnail_name(name, width))
+            tmp_path = f"{target}.{os.getpid()}.tmp"
+            image.save(tmp_path, 'JPEG', quality=THUMBNAIL_QUALITY,
+                       optimize=True, progressive=True)
+            os.replace(tmp_path, target)
+            created.append(width)
+    return sorted(created)
+
+
+# Заглушка плитки, пока грузится фото: крошечная копия прямо в HTML
+PLACEHOLDER_WIDTH = 16
+
+
+def generate_placeholder(filepath, width=PLACEHOLDER_WIDTH):
+    """Крошечная копия фото в виде data URI (WebP, без поддержки - JPEG)"""
+    with Image.open(filepath) as original:
+        original.draft('RGB', (width * 8, width * 8))  # JPEG: декодируем сразу уменьшенным
+        image = flatten_for_jpeg(ImageOps.exif_transpose(original))
+        height = max(1, round(image.height * width / image.width))
+        image = image.resize((width, height), Image.LANCZOS)
+    buffer = io.BytesIO()
+    if image_features.check('webp'):
+        image.save(buffer, 'WEBP', quality=50)
+        mime_type = 'image/webp'
+    else:
+        image.save(buffer, 'JPEG', quality=50, optimize=True)
+        mime_type = 'image/jpeg'
+    return {'placeholder': f"data:{mime_type};base64,"
+                           f"{base64.b64encode(buffer.getvalue()).decode('ascii')}"}
+
+
+def remove_thumbnails(name, thumbs_dir, widths):
+    """Удаление всех миниатюр фото"""
+    for width in widths:
+        try:
+            os.remove(os.path.join(thumbs_dir, thumbnail_name(name, width)))
+        except FileNotFoundError:
+            pass
+
+
+# Современные форматы в порядке предпочтения: расширение -> (формат
+# Pillow, MIME-тип, параметры сохранения). Используются только те, что
+# поддерживает установленный Pillow.
+MODERN_FORMATS = OrderedDict([
+    ('.avif', ('AVIF', 'image/avif', {'quality': 60, 'speed': 6})),
+    ('.webp', ('WEBP', 'image/webp', {'quality': 80, 'method': 4})),
+])
+
+
+def available_modern_formats():
+    """Расширения современных форматов, которые умеет сохранять Pillow"""
+    if image_features is None:
+        return []
+    return [extension for extension, (image_format, _, _) in MODERN_FORMATS.items()
+            if image_features.check(image_format.lower())]
+
+
+def generate_modern_formats(filepath, formats_dir, extensions):
+    """Копии фото в современных форматах того же размера
+    
+    Копия, которая не меньше оригинала, удаляется - тогда отдается
+    оригинал. Возвращает размеры и время кодирования для оценки выгоды.
+    """
+    os.makedirs(formats_dir, exist_ok=True)
+    name = os.path.basename(filepath)
+    original_size = os.path.getsize(filepath)
+    with Image.open(filepath) as original:
+        image = ImageOps.exif_transpose(original)
+        icc_profile = original.info.get('icc_profile')
+        result = {'original': original_size, 'pixels': image.width * image.height}
+        for extension in extensions:
+            image_format, _, options = MODERN_FORMATS[extension]
+            target = os.path.join(formats_dir, name + extension)
+            tmp_path = f"{target}.{os.getpid()}.tmp"
+            started = time.perf_counter()
+            image.save(tmp_path, image_format, icc_profile=icc_profile, **options)
+            seconds = time.perf_counter() - started
+            size = os.path.getsize(tmp_path)
+            if size < original_size:
+                os.replace(tmp_path, target)
+            else:
+                os.remove(tmp_path)
+                try:
+                    os.remove(target)
+                except FileNotFoundError:
+                    pass
+            result[extension.lstrip('.')] = {'bytes': size, 'seconds': round(seconds, 4),
+                                             'kept': size < original_size}
+    return result
+
+
+def remove_modern_formats(name, formats_dir):
+    """Удаление копий фото в современных форматах"""
+    for extension in MODERN_FORMATS:
+        try:
+            os.remove(os.path.join(formats_dir, name + extension))
+        except FileNotFoundError:
+            pass
+
+
+def file_sha256(filepath):
+    """SHA-256 содержимого файла"""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Перцептивные хэши (64 бита): у похожих кадров (серия снимков,
+# пересжатая или уменьшенная копия) отличаются немногие биты
+PERCEPTUAL_HASHES = ('phash', 'dhash')
+PHASH_SIZE = 32
+PHASH_BITS = 8
+# Первые коэффициенты DCT-II по каждой оси (низкие частоты кадра)
+PHASH_COSINES = [[math.cos(math.pi * (2 * x + 1) * u / (2 * PHASH_SIZE))
+                  for x in range(PHASH_SIZE)] for u in range(PHASH_BITS)]
+DEFAULT_DUPLICATE_DISTANCE = 10
+
+
+def _grayscale_pixels(image, width, height):
+    """Яркости пикселей уменьшенной копии построчно"""
+    return image.resize((width, height), Image.LANCZOS).tobytes()
+
+
+def perceptual_hashes(filepath):
+    """pHash (низкие частоты DCT) и dHash (перепады яркости) в hex"""
+    with Image.open(filepath) as original:
+        original.draft('L', (PHASH_SIZE * 8, PHASH_SIZE * 8))  # JPEG: декодируем уменьшенным
+        image = ImageOps.exif_transpose(original).convert('L')
+    # dHash: ярче ли пиксель соседа справа в копии 9x8
+    pixels = _grayscale_pixels(image, 9, 8)
+    dhash = 0
+    for y in range(8):
+        for x in range(8):
+            dhash = dhash << 1 | (pixels[y * 9 + x] > pixels[y * 9 + x + 1])
+    # pHash: коэффициенты DCT 8x8 копии 32x32 больше медианы (без постоянной
+    # составляющей); DCT раздельная - сначала по строкам, потом по столбцам
+    pixels = _grayscale_pixels(image, PHASH_SIZE, PHASH_SIZE)
+    rows = [[sum(c * p for c, p in zip(cosines, pixels[y * PHASH_SIZE:(y + 1) * PHASH_SIZE]))
+             for cosines in PHASH_COSINES] for y in range(PHASH_SIZE)]
+    coefficients = [sum(PHASH_COSINES[v][y] * rows[y][u] for y in range(PHASH_SIZE))
+                    for v in range(PHASH_BITS) for u in range(PHASH_BITS)]
+    median = sorted(coefficients[1:])[(len(coefficients) - 1) // 2]
+    phash = 0
+    for coefficient in coefficients:
+        phash = phash << 1 | (coefficient > median)
+    return {'phash': f'{phash:016x}', 'dhash': f'{dhash:016x}'}
+
+
+popcount = getattr(int, 'bit_count', None) or (lambda value: bin(value).count('1'))
+
+if numpy is not None:
+    POPCOUNT_BYTES = numpy.array([popcount(i) for i in range(256)], dtype=numpy.uint8)
+
+
+def numpy_popcount(values):
+    """Число единичных битов в каждом элементе массива uint64"""
+    if hasattr(numpy, 'bitwise_count'):  # numpy 2.0+
+        return numpy.bitwise_count(values)
+    return POPCOUNT_BYTES[values.view(numpy.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+class HammingIndex:
+    """Поиск близких перцептивных хэшей по расстоянию Хэмминга
+    
+    С numpy расстояния до всех хэшей считаются одной векторной операцией.
+    Без numpy пары для кластеров ищутся по совпадающим частям хэша: если
+    хэши отличаются не больше чем в d битах, то хотя бы одна из d + 1
+    частей у них совпадает, и остальные пары можно не сравнивать.
+    
+    С numpy для большого числа хэшей части крупнее: хэш делится на
+    PROBE_PARTS частей по 16 бит, и у близкой пары хотя бы одна часть
+    отличается не больше чем на свой радиус (радиусы в сумме с числом
+    частей больше d). Для каждого хэша перебираются значения части в
+    пределах радиуса, а хэши с таким значением берутся из таблицы всех
+    2^16 значений, все это - векторными операциями по блокам хэшей.
+    """
+    
+    PROBE_PARTS = 4
+    # Перебор значений части дешевле попарного сравнения, когда хэшей
+    # больше, чем PROBE_COST * (число перебираемых значений)
+    PROBE_COST = 40
+    
+    def __init__(self, hashes):
+        self.hashes = dict(hashes)
+        self.photos = list(hashes)
+        self.values = [hashes[photo] for photo in self.photos]
+        self._array = None
+        if numpy is not None:
+            self._array = numpy.array(self.values, dtype=numpy.uint64)
+    
+    def __len__(self):
+        return len(self.photos)
+    
+    def distances(self, value, start=0):
+        """Расстояния от value до хэшей, начиная с позиции start"""
+        if self._array is not None:
+            return numpy_popcount(self._array[start:] ^ numpy.uint64(value))
+        return [popcount(value ^ other) for other in self.values[start:]]
+    
+    def near(self, value, max_distance):
+        """Фото с хэшем не дальше max_distance: (фото, расстояние), ближние первыми"""
+        distances = self.distances(value)
+        if self._array is not None:
+            found = [(self.photos[i], int(distances[i]))
+                     for i in numpy.flatnonzero(distances <= max_distance)]
+        else:
+            found = [(photo, distance) for photo, distance in zip(self.photos, distances)
+                     if distance <= max_distance]
+        found.sort(key=lambda item: (item[1], item[0]))
+        return found
+    
+    def pairs(self, max_distance):
+        """Пары позиций (i, j), i < j, с расстоянием не больше max_distance"""
+        if self._array is not None:
+            masks = self._probe_masks(max_distance)
+            if len(self.values) > self.PROBE_COST * sum(map(len, masks)):
+                for code in self._probe_pairs(max_distance, masks):
+                    yield divmod(int(code), len(self.values))
+                return
+            for i, value in enumerate(self.values[:-1]):
+                for j in numpy.flatnonzero(self.distances(value, i + 1) <= max_distance):
+                    yield i, i + 1 + int(j)
+            return
+        found = set()
+        parts = min(64, max_distance + 1)
+        for part in range(parts):
+            shift, width = 64 * part // parts, 64 * (part + 1) // parts - 64 * part // parts
+            mask = (1 << width) - 1
+            buckets = {}
+            for i, value in enumerate(self.values):
+                buckets.setdefault(value >> shift & mask, []).append(i)
+            for members in buckets.values():
+                for position, i in enumerate(members):
+                    for j in members[position + 1:]:
+                        if (i, j) not in found and \
+                                popcount(self.values[i] ^ self.values[j]) <= max_distance:
+                            found.add((i, j))
+                            yield i, j
+    
+    def _probe_masks(self, max_distance):
+        """Для каждой части хэша - маски значений в пределах ее радиуса"""
+        width = 64 // self.PROBE_PARTS
+        base, extra = divmod(max_distance + 1, self.PROBE_PARTS)
+        radii = [base if part < extra else base - 1 for part in range(self.PROBE_PARTS)]
+        return [numpy.array([sum(1 << bit for bit in bits) for k in range(radius + 1)
+                             for bits in itertools.combinations(range(width), k)],
+                            dtype=numpy.int32)
+                for radius in radii]
+    
+    def _probe_pairs(self, max_distance, masks_by_part):
+        """Пары для pairs перебором значений частей: отсортированные
+        коды i * n + j, i < j"""
+        values, count = self._array, len(self.values)
+        width = 64 // self.PROBE_PARTS
+        found = []
+        for part, masks in enumerate(masks_by_part):
+            if not len(masks):
+                continue
+            keys = ((values >> numpy.uint64(width * part))
+                    & numpy.uint64((1 << width) - 1)).astype(numpy.int32)
+            # Хэши, упорядоченные по значению части, и начало каждого
+            # значения в этом порядке
+            order = numpy.argsort(keys, kind='stable').astype(numpy.int32)
+            sizes = numpy.bincount(keys, minlength=1 << width)
+            occupied = sizes > 0
+            starts = numpy.zeros((1 << width) + 1, dtype=numpy.int32)
+            numpy.cumsum(sizes, out=starts[1:])
+            # Блок в ~2^17 значений помещается в кэш процессора
+            block = max(1, (1 << 17) // len(masks))
+            for begin in range(0, count, block):
+                block_keys = keys[begin:begin + block, None]
+                probes = block_keys ^ masks
+                # Пара с разными значениями части находится с обеих
+                # сторон, оставляем сторону с меньшим значением
+                found_here = occupied[probes]
+                found_here &= probes >= block_keys
+                positions = numpy.flatnonzero(found_here)
+                probes = probes.ravel()[positions]
+                first = starts[probes]
+                sizes = starts[probes + 1] - first
+                owners = positions // len(masks) + begin
+                same = positions % len(masks) == 0  # маска 0: то же значение части
+                # slot-й хэш с нужным значением части у всех владельцев сразу
+                slot = 0
+                while len(owners):
+                    others = order[first + slot]
+                    close = numpy_popcount(values[owners] ^ values[others]) <= max_distance
+                    close &= ~same | (owners < others)
+                    a, b = owners[close], others[close]
+                    found.append(numpy.minimum(a, b).astype(numpy.int64) * count
+                                 + numpy.maximum(a, b))
+                    slot += 1
+                    more = sizes > slot
+                    owners, first, sizes, same = owners[more], first[more], sizes[more], same[more]
+        if not found:
+            return []
+        # Одна пара может найтись по нескольким частям
+        return numpy.unique(numpy.concatenate(found))
+    
+    def clusters(self, max_distance):
+        """Группы похожих фото (от двух штук), каждая в порядке добавления"""
+        parent = list(range(len(self.values)))
+        
+        def root(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+        
+        for i, j in self.pairs(max_distance):
+            a, b = root(i), root(j)
+            if a != b:
+                parent[max(a, b)] = min(a, b)
+        groups = OrderedDict()
+        for i in range(len(self.values)):
+            groups.setdefault(root(i), []).append(self.photos[i])
+        return [group for group in groups.values() if len(group) > 1]
+
+
+# Форматы Pillow, в которых сохраняются уменьшенные копии; GIF не
+# уменьшаем, чтобы не потерять анимацию
+DERIVED_FORMATS = {'.jpg': 'JPEG', '.jpeg': 'JPEG', '.png': 'PNG', '.webp': 'WEBP'}
+
+
+def render_derivative(source, target, width, quality, image_format):
+    """Уменьшенная копия фото; шире оригинала не увеличивается"""
+    with Image.open(source) as original:
+        image = ImageOps.exif_transpose(original)
+        if width < image.width:
+            height = max(1, round(image.height * width / image.width))
+            image = image.resize((width, height), Image.LANCZOS, reducing_gap=3.0)
+        options = {'quality': quality}
+        if image_format == 'JPEG':
+            image = flatten_for_jpeg(image)
+            options.update(optimize=True, progressive=True)
+        elif image_format == 'PNG':
+            options = {'optimize': True}
+        elif image_format == 'AVIF':
+            options['speed'] = MODERN_FORMATS['.avif'][2]['speed']
+        tmp_path = f"{target}.{os.getpid()}.tmp"
+        image.save(tmp_path, image_format, **options)
+        os.replace(tmp_path, target)
+    return os.path.getsize(target)
+
+
+class DerivativeCache:
+    """Дисковый кэш уменьшенных копий фото
+    
+    Файл копии называется по SHA-256 исходника и параметрам, поэтому
+    замененное фото с тем же именем не получит старую копию. Первые
+    одновременные запросы одной копии ждут друг друга: внутри процесса
+    на блокировке ключа, между процессами pre-fork - на flock файла
+    блокировки в папке копии, так что уменьшение выполняется один раз.
+    """
+    
+    def __init__(self, directory):
+        self.directory = directory
+        self.renders = 0
+        self._hashes = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+    
+    def source_hash(self, filepath, stat):
+        """Хэш исходника, пересчитывается только при изменении файла"""
+        with self._lock:
+            entry = self._hashes.get(filepath)
+        if entry is not None and entry[:2] == (stat.st_mtime_ns, stat.st_size):
+            return entry[2]
+        digest = file_sha256(filepath)
+        with self._lock:
+            self._hashes[filepath] = (stat.st_mtime_ns, stat.st_size, digest)
+        return digest
+    
+    def path(self, digest, width, quality, extension):
+        return os.path.join(self.directory, digest[:2],
+                            f"{digest}.w{width}.q{quality}{extension}")
+    
+    def get(self, filepath, width, quality, extension, render):
+        """Путь к копии; отсутствующая создается вызовом render(source, target)"""
+        digest = self.source_hash(filepath, os.stat(filepath))
+        target = self.path(digest, width, quality, extension)
+        if os.path.exists(target):
+            return target
+        with self._lock:
+            entry = self._key_locks.setdefault(target, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                if not os.path.exists(target):
+                    self._render_locked(filepath, target, render)
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._key_locks[target]
+        return target
+    
+    def _render_locked(self, filepath, target, render):
+        directory = os.path.dirname(target)
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, '.lock'), 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # Пока ждали блокировку, копию мог сделать другой процесс
+                if not os.path.exists(target):
+                    render(filepath, target)
+                    with self._lock:
+                        self.renders += 1
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+    
+    def remove(self, filepath):
+        """Удаление всех копий фото (до удаления самого фото)"""
+        try:
+            digest = self.source_hash(filepath, os.stat(filepath))
+        except OSError:
+            return
+        with self._lock:
+            self._hashes.pop(filepath, None)
+        directory = os.path.join(self.directory, digest[:2])
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return
+        for name in names:
+            if name.startswith(digest + '.'):
+                try:
+                    os.remove(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
+
+
+# Сжатие ответов: ответы меньше порога не сжимаем, выигрыш не окупается
+MIN_COMPRESS_SIZE = 1024
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript',
+                      'image/svg+xml')
+# Объем кэша сжатых вариантов страниц и статических файлов
+COMPRESSION_CACHE_BYTES = 16 * 1024 * 1024
+
+# Настройки постоянных соединений (HTTP/1.1 keep-alive)
+DEFAULT_KEEPALIVE_TIMEOUT = 5
+DEFAULT_MAX_KEEPALIVE_REQUESTS = 100
+
+class FileCache:
+    """Ограниченный по объему LRU-кэш содержимого файлов
+    
+    Запись действительна, пока у файла те же размер и время изменения,
+    поэтому кэш не отдает устаревшие данные, даже если файл изменил
+    другой процесс. Файлы больше max_file_bytes не кэшируются.
+    """
+    
+    def __init__(self, max_bytes, max_file_bytes):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = min(max_file_bytes, max_bytes)
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def accepts(self, size):
+        """Поместится ли файл такого размера в кэш"""
+        return 0 < size <= self.max_file_bytes
+    
+    def get(self, path, stat):
+        """Содержимое файла из кэша или None"""
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[:2] == (stat.st_mtime_ns, stat.st_size):
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry[2]
+            if entry is not None:
+                self._remove(path)
+            self.misses += 1
+            return None
+    
+    def put(self, path, stat, data):
+        """Сохранение содержимого файла с вытеснением давно не нужных"""
+        if not self.accepts(len(data)):
+            return
+        with self._lock:
+            if path in self._entries:
+                self._remove(path)
+            self._entries[path] = (stat.st_mtime_ns, stat.st_size, data)
+            self.current_bytes += len(data)
+            while self.current_bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+    
+    def invalidate(self, path):
+        """Удаление файла из кэша (после загрузки или удаления)"""
+        with self._lock:
+            if path in self._entries:
+                self._remove(path)
+    
+    def _remove(self, path):
+        entry = self._entries.pop(path)
+        self.current_bytes -= len(entry[2])
+    
+    def stats(self):
+        """Счетчики для подбора размера кэша"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'max_file_bytes': self.max_file_bytes,
+            }
+
+
+class CompressionCache:
+    """LRU-кэш сжатых вариантов ответов по ключу (ETag, кодировка)
+    
+    ETag меняется вместе с содержимым, поэтому записи не нужно проверять:
+    устаревшие просто вытесняются.
+    """
+    
+    def __init__(self, max_bytes=COMPRESSION_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+            return data
+    
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= len(self._entries.pop(key))
+            self._entries[key] = data
+            self.current_bytes += len(data)
+            while self.current_bytes > self.max_bytes:
+                _, oldest = self._entries.popitem(last=False)
+                self.current_bytes -= len(oldest)
+
+
+def compress_body(body, encoding, best=False):
+    """Сжатие тела ответа; best - максимальная степень для кэшируемых вариантов"""
+    if encoding == 'br':
+        return brotli.compress(body, quality=11 if best else 5)
+    return gzip.compress(body, compresslevel=9 if best else 6, mtime=0)
+
+
+def is_compressible(content_type):
+    """Имеет ли смысл сжимать ответ такого типа"""
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def watch_parent_process(parent_pid, interval=1.0):
+    """Завершение процесса пула вместе с сервером, даже убитым по SIGKILL"""
+    def watch():
+        while os.getppid() == parent_pid:
+            time.sleep(interval)
+        os._exit(0)
+    threading.Thread(target=watch, name="parent-watch", daemon=True).start()
+
+
+def open_database(path):
+    """Соединение с общей базой сервера (WAL: чтение не ждет записи)"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    db = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    return db
+
+
+class JobStore:
+    """Состояние обработки загруженных фото в SQLite
+    
+    Строка на пару (фото, обработчик) со статусом pending, running, done
+    или failed. База в режиме WAL общая для всех процессов сервера,
+    поэтому незавершенные задачи переживают перезапуск. У задачи в
+    running записан pid процесса, который ее выполняет (owner), чтобы
+    задачи упавшего процесса pre-fork можно было вернуть в очередь.
+    """
+    
+    def __init__(self, path):
+        self._db = open_database(path)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    photo TEXT NOT NULL,
+                    processor TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    updated REAL NOT NULL,
+                    owner INTEGER,
+                    PRIMARY KEY (photo, processor)
+                )""")
+            # Базы, созданные до появления owner
+            columns = {row[1] for row in self._db.execute("PRAGMA table_info(jobs)")}
+            if 'owner' not in columns:
+                self._db.execute("ALTER TABLE jobs ADD COLUMN owner INTEGER")
+    
+    def add(self, photo, processors, status='pending'):
+        """Новые задачи для фото (повторная загрузка сбрасывает старые)"""
+        now = time.time()
+        owner = os.getpid() if status == 'running' else None
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO jobs (photo, processor, status, updated, owner) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(photo, processor, status, now, owner) for processor in processors])
+    
+    def add_missing(self, photo, processors):
+        """Задачи для фото, которое раньше не обрабатывалось этими обработчиками"""
+        now = time.time()
+        with self._lock:
+            before = self._db.total_changes
+            self._db.executemany(
+                "INSERT OR IGNORE INTO jobs (photo, processor, status, updated) "
+                "VALUES (?, ?, 'pending', ?)",
+                [(photo, processor, now) for processor in processors])
+            return self._db.total_changes - before
+    
+    def claim_pending(self):
+        """Забрать все ожидающие задачи; каждую получает только один процесс"""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._db.execute(
+                    "SELECT photo, processor FROM jobs WHERE status = 'pending'").fetchall()
+                self._db.execute(
+                    "UPDATE jobs SET status = 'running', updated = ?, owner = ? "
+                    "WHERE status = 'pending'", (time.time(), os.getpid()))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return rows
+    
+    def requeue_running(self, owner=None):
+        """Задачи, прерванные на середине, снова ждут выполнения: все
+        (после перезапуска сервера) или только процесса owner"""
+        query = "UPDATE jobs SET status = 'pending', updated = ?, owner = NULL " \
+                "WHERE status = 'running'"
+        params = [time.time()]
+        if owner is not None:
+            query += " AND owner = ?"
+            params.append(owner)
+        with self._lock:
+            return self._db.execute(query, params).rowcount
+    
+    def finish(self, photo, processor, result=None, error=None):
+        """Результат задачи; у удаленного тем временем фото строки уже нет"""
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, updated = ? "
+                "WHERE photo = ? AND processor = ?",
+                ('failed' if error else 'done', json.dumps(result), error, time.time(),
+                 photo, processor))
+    
+    def remove(self, photo):
+        """Удаление задач удаленного фото"""
+        with self._lock:
+            self._db.execute("DELETE FROM jobs WHERE photo = ?", (photo,))
+    
+    def status(self, photo):
+        """Задачи одного фото: обработчик -> статус, результат, ошибка"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT processor, status, result, error, updated FROM jobs "
+                "WHERE photo = ? ORDER BY processor", (photo,)).fetchall()
+        return {processor: {'status': status,
+                            'result': json.loads(result) if result else None,
+                            'error': error,
+                            'updated': updated}
+                for processor, status, result, error, updated in rows}
+    
+    def results(self, processor, photos=None):
+        """Результаты обработчика по всем фото (или только photos), где он
+        завершился успешно"""
+        query = "SELECT photo, result FROM jobs WHERE processor = ? AND status = 'done'"
+        with self._lock:
+            if photos is None:
+                rows = self._db.execute(query, (processor,)).fetchall()
+            else:
+                photos, rows = list(photos), []
+                # Не больше 999 параметров в запросе у старых SQLite
+                for start in range(0, len(photos), 500):
+                    chunk = photos[start:start + 500]
+                    rows += self._db.execute(
+                        f"{query} AND photo IN ({', '.join('?' * len(chunk))})",
+                        (processor, *chunk)).fetchall()
+        return {photo: json.loads(result) for photo, result in rows if result}
+    
+    def last_update(self):
+        """Время последнего изменения задач (для версии страниц с результатами)"""
+        with self._lock:
+            return self._db.execute("SELECT MAX(updated) FROM jobs").fetchone()[0] or 0
+    
+    def summary(self):
+        """Количество задач по статусам и фото с незавершенными задачами"""
+        with self._lock:
+            counts = dict(self._db.execute(
+                "SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+            active = [photo for (photo,) in self._db.execute(
+                "SELECT DISTINCT photo FROM jobs WHERE status IN ('pending', 'running') "
+                "ORDER BY photo")]
+            failed = [photo for (photo,) in self._db.execute(
+                "SELECT DISTINCT photo FROM jobs WHERE status = 'failed' ORDER BY photo")]
+        return {'counts': counts, 'active': active, 'failed': failed}
+    
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class PhotoIndex:
+    """Индекс метаданных фото в SQLite
+    
+    Заполняется фоновой обработкой (или командой --reindex), поэтому
+    список фото сортируется по времени съемки без чтения файлов.
+    taken - время съемки, а если оно неизвестно - время изменения файла.
+    Время последнего изменения таблиц (changed) ведут триггеры, поэтому
+    оно одно для всех процессов сервера и переживает перезапуск. Они же
+    пишут каждое изменение photos в журнал photo_log с номерами по
+    порядку: по нему другие процессы обновляют список фото в памяти, не
+    загружая его заново (changes_since).
+    """
+    
+    COLUMNS = ('modified', 'captured', 'width', 'height', 'orientation', 'camera')
+    # Столбцы журнала в порядке строк listing; у удаления taken - NULL
+    LOG_COLUMNS = ('photo', 'modified', 'taken', 'width', 'height', 'orientation')
+    # Сколько последних изменений хранит журнал; отставший сильнее
+    # процесс загружает список целиком
+    LOG_SIZE = 10000
+    # Время в нс по часам SQLite; не меньше предыдущего значения плюс один,
+    # чтобы каждое изменение давало новое значение
+    CHANGED_NOW = ("max(changed + 1, CAST((julianday('now') - 2440587.5) * 86400e9 "
+                   "AS INTEGER))")
+    
+    def __init__(self, path):
+        self._db = open_database(path)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS photos (
+                    photo TEXT PRIMARY KEY,
+                    taken REAL NOT NULL,
+                    modified REAL NOT NULL,
+                    captured REAL,
+                    width INTEGER,
+                    height INTEGER,
+                    orientation INTEGER,
+                    camera TEXT
+                )""")
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS photos_taken ON photos (taken DESC, photo DESC)")
+            # SHA-256 содержимого -> фото: загруженного файла и файла после
+            # оптимизации, чтобы повторная загрузка любого из них не дублировала фото
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS content_hashes (
+                    sha256 TEXT PRIMARY KEY,
+                    photo TEXT NOT NULL
+                )""")
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS content_hashes_photo ON content_hashes (photo)")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS perceptual_hashes (
+                    photo TEXT PRIMARY KEY,
+                    phash TEXT NOT NULL,
+                    dhash TEXT NOT NULL
+                )""")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS changes (
+                    name TEXT PRIMARY KEY,
+                    changed INTEGER NOT NULL
+                )""")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS photo_log (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    photo TEXT NOT NULL,
+                    modified REAL,
+                    taken REAL,
+                    width INTEGER,
+                    height INTEGER,
+                    orientation INTEGER
+                )""")
+            self._track_changes('photos')
+            self._track_changes('perceptual_hashes')
+            self._log_changes()
+    
+    def _track_changes(self, table):
+        """Триггеры, обновляющие время изменения таблицы"""
+        self._db.execute("INSERT OR IGNORE INTO changes (name, changed) VALUES (?, 0)",
+                         (table,))
+        self._db.execute(f"UPDATE changes SET changed = {self.CHANGED_NOW} "
+                         f"WHERE name = ? AND changed = 0", (table,))
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            self._db.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_changed
+                AFTER {event} ON {table} BEGIN
+                    UPDATE changes SET changed = {self.CHANGED_NOW} WHERE name = '{table}';
+                END""")
+    
+    def _log_changes(self):
+        """Триггеры, записывающие изменения photos в photo_log"""
+        columns = ', '.join(self.LOG_COLUMNS)
+        values = ', '.join(f'NEW.{column}' for column in self.LOG_COLUMNS)
+        for event in ('INSERT', 'UPDATE'):
+            self._db.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS photos_{event.lower()}_logged
+                AFTER {event} ON photos BEGIN
+                    INSERT INTO photo_log ({columns}) VALUES ({values});
+                END""")
+        self._db.execute("""
+            CREATE TRIGGER IF NOT EXISTS photos_delete_logged
+            AFTER DELETE ON photos BEGIN
+                INSERT INTO photo_log (photo) VALUES (OLD.photo);
+            END""")
+    
+    def log_position(self):
+        """Номер последнего изменения в журнале photo_log"""
+        with self._lock:
+            return self._log_position()
+    
+    def _log_position(self):
+        return self._db.execute("SELECT COALESCE(MAX(seq), 0) FROM photo_log").fetchone()[0]
+    
+    def changes_since(self, position):
+        """Изменения photos после номера position: (номер, имя, modified,
+        taken, ширина, высота, ориентация), у удаленных фото taken - None;
+        None - журнал уже обрезан, и часть изменений потеряна"""
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT seq, {', '.join(self.LOG_COLUMNS)} FROM photo_log "
+                f"WHERE seq > ? ORDER BY seq", (position,)).fetchall()
+            if rows and rows[0][0] != position + 1:
+                # Номера идут подряд: пропуск - обрезанная часть журнала
+                first = self._db.execute("SELECT MIN(seq) FROM photo_log").fetchone()[0]
+                if first > position + 1:
+                    return None
+        return rows
+    
+    def changed(self, table='photos'):
+        """Время последнего изменения таблицы, нс"""
+        with self._lock:
+            return self._changed(table)
+    
+    def _changed(self, table):
+        return self._db.execute("SELECT changed FROM changes WHERE name = ?",
+                                (table,)).fetchone()[0]
+    
+    def find_by_hash(self, digest):
+        """Имя фото с таким содержимым или None"""
+        with self._lock:
+            row = self._db.execute("SELECT photo FROM content_hashes WHERE sha256 = ?",
+                                   (digest,)).fetchone()
+        return row[0] if row else None
+    
+    def claim_hash(self, digest, photo, replace=False):
+        """Привязка хэша к фото; возвращает фото, за которым хэш закреплен
+        
+        Если хэш уже занят другим фото (одновременная загрузка того же
+        файла в другом потоке или процессе), возвращается это фото.
+        replace - перезакрепить хэш, например за фото, которого больше нет.
+        """
+        with self._lock:
+            self._db.execute(
+                f"INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO content_hashes "
+                f"(sha256, photo) VALUES (?, ?)", (digest, photo))
+            return self._db.execute("SELECT photo FROM content_hashes WHERE sha256 = ?",
+                                    (digest,)).fetchone()[0]
+    
+    @staticmethod
+    def taken(metadata):
+        """Время, по которому сортируется список фото"""
+        return metadata['captured'] or metadata['modified']
+    
+    def update(self, photo, metadata):
+        """Сохранение метаданных одного фото"""
+        return self.update_many([(photo, metadata)])
+    
+    def update_many(self, items):
+        """Сохранение метаданных пачки фото одной транзакцией
+        
+        Возвращает номер последнего изменения в журнале до и после записи.
+        """
+        rows = [(photo, self.taken(metadata), *(metadata[column] for column in self.COLUMNS))
+                for photo, metadata in items]
+        return self._write_photos(
+            f"INSERT OR REPLACE INTO photos (photo, taken, {', '.join(self.COLUMNS)}) "
+            f"VALUES (?, ?, {', '.join('?' * len(self.COLUMNS))})", rows)
+    
+    def _write_photos(self, query, rows, tables=('photos',)):
+        """Запись в таблицы фото одной транзакцией; возвращает номер
+        последнего изменения в журнале photo_log до и после нее"""
+        with self._lock:
+            # IMMEDIATE: между чтением номера и записью не вклинится
+            # другой процесс
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                before = self._log_position()
+                for table in tables:
+                    self._db.executemany(query.format(table=table), rows)
+                after = self._log_position()
+                self._db.execute("DELETE FROM photo_log WHERE seq <= ?",
+                                 (after - self.LOG_SIZE,))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return before, after
+    
+    def set_perceptual_hashes(self, photo, hashes):
+        """Сохранение перцептивных хэшей фото (результат perceptual_hashes)"""
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO perceptual_hashes (photo, phash, dhash) "
+                "VALUES (?, ?, ?)", (photo, hashes['phash'], hashes['dhash']))
+    
+    def perceptual_hashes(self, kind='phash'):
+        """Перцептивные хэши одного вида: имя фото -> число"""
+        if kind not in PERCEPTUAL_HASHES:
+            raise ValueError(f"unknown perceptual hash: {kind}")
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT photo, {kind} FROM perceptual_hashes ORDER BY photo").fetchall()
+        return {photo: int(value, 16) for photo, value in rows}
+    
+    def remove(self, photo):
+        return self.remove_many([photo])
+    
+    def remove_many(self, photos):
+        """Удаление всех записей о фото (как update_many, возвращает номер
+        последнего изменения в журнале до и после)"""
+        return self._write_photos("DELETE FROM {table} WHERE photo = ?",
+                                  [(photo,) for photo in photos],
+                                  ('photos', 'content_hashes', 'perceptual_hashes'))
+    
+    def prune(self, existing):
+        """Удаление записей о файлах, которых больше нет (из всех таблиц,
+        одной транзакцией remove_many); возвращает число таких файлов"""
+        with self._lock:
+            indexed = {photo for table in ('photos', 'content_hashes', 'perceptual_hashes')
+                       for (photo,) in self._db.execute(f"SELECT DISTINCT photo FROM {table}")}
+        missing = sorted(indexed.difference(existing))
+        if missing:
+            self.remove_many(missing)
+        return len(missing)
+    
+    def names(self):
+        """Имена всех проиндексированных фото"""
+        with self._lock:
+            return {photo for (photo,) in self._db.execute("SELECT photo FROM photos")}
+    
+    def count(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM photos").fetchone()[0]
+    
+    def listing(self, limit=None, after=None):
+        """Фото для показа, новые сначала: (имя, modified, taken, ширина, высота,
+        ориентация); порядок и LIMIT обслуживает индекс photos_taken
+        
+        after - ключ (taken, имя) последнего фото предыдущей страницы.
+        """
+        query = "SELECT photo, modified, taken, width, height, orientation FROM photos"
+        params = []
+        if after is not None:
+            query += " WHERE (taken, photo) < (?, ?)"
+            params += after
+        query += " ORDER BY taken DESC, photo DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        with self._lock:
+            return self._db.execute(query, params).fetchall()
+    
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+IN_CREATE, IN_CLOSE_WRITE, IN_DELETE = 0x100, 0x8, 0x200
+IN_MOVED_FROM, IN_MOVED_TO = 0x40, 0x80
+IN_DELETE_SELF, IN_MOVE_SELF, IN_Q_OVERFLOW, IN_IGNORED = 0x400, 0x800, 0x4000, 0x8000
+IN_ISDIR = 0x40000000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class InotifyWatcher:
+    """Изменения файлов папки через inotify (Linux, вызовы libc через ctypes)
+    
+    on_change(имена) получает измененные за одно чтение файлы, а при
+    переполнении очереди событий - None (нужно сверить всю папку).
+    """
+    
+    MASK = (IN_CREATE | IN_CLOSE_WRITE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+            | IN_DELETE_SELF | IN_MOVE_SELF)
+    
+    def __init__(self, path, on_change):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError("inotify недоступен")
+        self.on_change = on_change
+        self._fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        if libc.inotify_add_watch(self._fd, os.fsencode(path), self.MASK) < 0:
+            error = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(error, f"inotify_add_watch {path}")
+        threading.Thread(target=self._run, name='inotify', daemon=True).start()
+    
+    def _run(self):
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except OSError:
+                return
+            names, resync, stop = set(), False, False
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    resync = True
+                elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    resync = stop = True
+                elif name and not mask & IN_ISDIR:
+                    names.add(os.fsdecode(name))
+            try:
+                self.on_change(None if resync else names)
+            except Exception as e:
+                print(f"⚠️  Не удалось учесть изменения в папке: {e}", flush=True)
+            if stop:
+                os.close(self._fd)
+                return
+
+
+class PollingWatcher:
+    """Изменения папки по времени ее изменения (без inotify)
+    
+    Время меняется при добавлении, удалении и переименовании файлов;
+    тогда on_change(None) сверяет папку целиком.
+    """
+    
+    def __init__(self, path, on_change, interval=1.0):
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+        self._mtime = self._directory_mtime()
+        threading.Thread(target=self._run, name='poll-photos', daemon=True).start()
+    
+    def _directory_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+    
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            mtime = self._directory_mtime()
+            if mtime == self._mtime:
+                continue
+            self._mtime = mtime
+            try:
+                self.on_change(None)
+            except Exception as e:
+                print(f"⚠️  Не удалось учесть изменения в папке: {e}", flush=True)
+
+
+def watch_directory(path, on_change, mode='auto'):
+    """Наблюдатель за папкой: inotify, а где его нет - опрос (mode: auto,
+    inotify или poll)"""
+    if mode != 'poll':
+        try:
+            return InotifyWatcher(path, on_change)
+        except (OSError, AttributeError) as e:
+            if mode == 'inotify':
+                raise
+            print(f"⚠️  inotify недоступен ({e}), папка {path} проверяется опросом",
+                  flush=True)
+    return PollingWatcher(path, on_change)
+
+
+def watch_directory_once(path, on_change, mode, lock_path):
+    """Наблюдатель за папкой только в одном процессе сервера (pre-fork)
+    
+    Наблюдает процесс, получивший flock на lock_path: он один учитывает
+    изменения в папке и пишет их в индекс, остальные получают их из
+    журнала индекса и ждут блокировку в фоновом потоке. Если наблюдавший
+    процесс завершится, ее получит один из них, сверит папку целиком и
+    продолжит наблюдение.
+    """
+    if fcntl is None:
+        return watch_directory(path, on_change, mode)
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    lock_file = open(lock_path, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        def take_over():
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                on_change(None)
+            except Exception as e:
+                print(f"⚠️  Не удалось сверить папку {path}: {e}", flush=True)
+            watch_directory(path, on_change, mode).lock_file = lock_file
+        threading.Thread(target=take_over, name='watch-lock', daemon=True).start()
+        return None
+    watcher = watch_directory(path, on_change, mode)
+    # Блокировка держится, пока открыт файл
+    watcher.lock_file = lock_file
+    return watcher
+
+
+class PhotoListing:
+    """Список фото в памяти поверх индекса фото
+    
+    Запросы читают только память. Изменения с сайта (загрузка, удаление,
+    фоновая обработка) записываются сразу и в индекс, и сюда, а файлы,
+    скопированные в папку или удаленные из нее в обход сайта, приходят
+    через refresh от наблюдателя за папкой. Изменения, сделанные другими
+    процессами сервера, фоновый поток (start_sync) раз в SYNC_INTERVAL
+    берет из журнала индекса; список целиком загружается заново, только
+    если журнал успели обрезать.
+    
+    on_added(имена) и on_removed(имена) получают файлы, появившиеся в
+    папке и исчезнувшие из нее в обход сайта (например, для фоновой
+    обработки).
+    """
+    
+    SYNC_INTERVAL = 0.2
+    # Новый файл моложе этого (с) учитывается позже: загрузку сайт
+    # запишет в индекс сам, а копирование в обход сайта успеет закончиться
+    SETTLE_TIME = 2.0
+    
+    def __init__(self, index, photos_dir, extensions, on_added=None, on_removed=None):
+        self.index = index
+        self.photos_dir = photos_dir
+        self.extensions = tuple(extensions)
+        self.on_added = on_added
+        self.on_removed = on_removed
+        self._lock = threading.Lock()
+        self._entries = {}  # имя -> (modified, taken, ширина, высота, ориентация)
+        self._order = []  # (taken, имя) по возрастанию
+        # Номер изменения в журнале индекса, которому соответствует список
+        self.position = None
+        self.load()
+    
+    def load(self):
+        """Загрузка всего списка из индекса"""
+        # Номер читается до строк: изменения между ними sync применит
+        # повторно, а это ничего не меняет
+        position = self.index.log_position()
+        rows = self.index.listing()
+        with self._lock:
+            self._entries = {row[0]: row[1:] for row in rows}
+            self._order = sorted((row[2], row[0]) for row in rows)
+            self.position = position
+    
+    def sync(self):
+        """Изменения индекса, сделанные другими процессами"""
+        with self._lock:
+            position = self.position
+        changes = self.index.changes_since(position)
+        if changes is None:
+            self.load()
+            return
+        with self._lock:
+            for seq, photo, *entry in changes:
+                # Свои записи этот процесс уже применил (_advance)
+                if seq <= self.position:
+                    continue
+                self._discard(photo)
+                if entry[1] is not None:
+                    self._entries[photo] = tuple(entry)
+                    bisect.insort(self._order, (entry[1], photo))
+                self.position = seq
+    
+    def start_sync(self):
+        """Фоновый поток sync: запросы не обращаются к индексу"""
+        threading.Thread(target=self._sync_forever, name='photo-listing',
+                         daemon=True).start()
+    
+    def _sync_forever(self):
+        while True:
+            time.sleep(self.SYNC_INTERVAL)
+            try:
+                self.sync()
+            except sqlite3.Error as e:
+                print(f"⚠️  Не удалось обновить список фото из индекса: {e}", flush=True)
+    
+    def count(self):
+        with self._lock:
+            return len(self._entries)
+    
+    def latest(self, limit=None, after=None):
+        """Фото новые сначала, в том же виде и с теми же параметрами, что
+        PhotoIndex.listing"""
+        with self._lock:
+            end = len(self._order) if after is None else bisect.bisect_left(self._order, after)
+            keys = self._order[0 if limit is None else max(0, end - limit):end]
+            return [(name, *self._entries[name]) for _, name in reversed(keys)]
+    
+    def update(self, photo, metadata):
+        self.update_many([(photo, metadata)])
+    
+    def update_many(self, items):
+        """Сохранение метаданных фото в индексе и в памяти"""
+        changed = self.index.update_many(items)
+        with self._lock:
+            for photo, metadata in items:
+                self._discard(photo)
+                entry = (metadata['modified'], self.index.taken(metadata), metadata['width'],
+                         metadata['height'], metadata['orientation'])
+                self._entries[photo] = entry
+                bisect.insort(self._order, (entry[1], photo))
+            self._advance(*changed)
+    
+    def remove(self, photo):
+        self.remove_many([photo])
+    
+    def remove_many(self, photos):
+        changed = self.index.remove_many(photos)
+        with self._lock:
+            for photo in photos:
+                self._discard(photo)
+            self._advance(*changed)
+    
+    def _advance(self, before, after):
+        # Если до записи список совпадал с индексом, то совпадает и после;
+        # иначе индекс менял кто-то еще, и sync применит изменения из журнала
+        if self.position == before:
+            self.position = after
+    
+    def _discard(self, photo):
+        entry = self._entries.pop(photo, None)
+        if entry is not None:
+            position = bisect.bisect_left(self._order, (entry[1], photo))
+            del self._order[position]
+    
+    def refresh(self, names=None):
+        """Учет изменений в папке, сделанных в обход сайта
+        
+        names - имена измененных файлов, None - сверить всю папку (только
+        имена: появившиеся файлы индексируются, исчезнувшие удаляются).
+        Файлы, которые уже есть в списке с тем же временем изменения
+        (например, загруженные через сайт), не перечитываются.
+        """
+        added, removed = self._refresh(names)
+        if removed and self.on_removed is not None:
+            self.on_removed(removed)
+        if added and self.on_added is not None:
+            self.on_added(added)
+    
+    def _refresh(self, names):
+        """Учет изменений в списке и индексе; возвращает (новые, удаленные)"""
+        # Загрузки и удаления в других процессах могли еще не дойти до списка
+        self.sync()
+        if names is None:
+            on_disk = {name for name in os.listdir(self.photos_dir)
+                       if name.lower().endswith(self.extensions)}
+            with self._lock:
+                names = on_disk.symmetric_difference(self._entries)
+        updated, added, removed, unsettled = [], [], [], []
+        for name in names:
+            if not name.lower().endswith(self.extensions):
+                continue
+            filepath = os.path.join(self.photos_dir, name)
+            metadata = None
+            if os.path.isfile(filepath):
+                with self._lock:
+                    entry = self._entries.get(name)
+                try:
+                    modified = os.stat(filepath).st_mtime
+                except OSError:
+                    continue
+                if entry is not None and entry[0] == modified:
+                    continue
+                if entry is None and time.time() - modified < self.SETTLE_TIME:
+                    unsettled.append(name)
+                    continue
+                metadata, _ = extract_metadata_safe(filepath)
+            if metadata is not None:
+                updated.append((name, metadata))
+                if entry is None:
+                    added.append(name)
+            elif not os.path.exists(filepath):
+                with self._lock:
+                    if name in self._entries:
+                        removed.append(name)
+        if unsettled:
+            timer = threading.Timer(self.SETTLE_TIME, self._refresh_later, (unsettled,))
+            timer.daemon = True
+            timer.start()
+        if updated:
+            self.update_many(updated)
+        if removed:
+            self.remove_many(removed)
+        return added, removed
+    
+    def _refresh_later(self, names):
+        try:
+            self.refresh(names)
+        except Exception as e:
+            print(f"⚠️  Не удалось учесть изменения в папке: {e}", flush=True)
+
+
+class ProcessingStage:
+    """Фоновая обработка загруженных файлов в пуле процессов
+    
+    Обработчики регистрируются по имени с расширениями файлов, к которым
+    они применимы. Функция обработчика получает путь к файлу и выполняется
+    в отдельном процессе, поэтому должна быть функцией модуля (или partial
+    от нее). cleanup получает имя фото и убирает производные файлы, когда
+    фото удалено. Обработчики с first=True изменяют сам файл и выполняются
+    до всех остальных. С workers=0 обработка идет сразу в вызывающем потоке.
+    Для call, которого ждет запрос пользователя, есть отдельный пул из
+    call_workers процессов (по умолчанию половина workers), чтобы он не
+    стоял в очереди за фоновыми задачами.
+    
+    Если процесс пула погиб (OOM, падение кодека), пул заменяется новым,
+    а прерванные задачи повторяются до MAX_ATTEMPTS раз и потом
+    считаются неудачными.
+    """
+    
+    MAX_ATTEMPTS = 2
+    
+    def __init__(self, store, photos_dir, workers, call_workers=None):
+        self.store = store
+        self.photos_dir = photos_dir
+        self.workers = workers
+        self.call_workers = call_workers or max(1, workers // 2)
+        self.processors = OrderedDict()
+        self.first = set()
+        self._pool_lock = threading.Lock()
+        self._attempts = {}  # (фото, обработчик) -> запусков, прерванных гибелью пула
+        self._executor = self._call_executor = None
+        if workers > 0:
+            self._executor = self._new_executor(workers)
+            self._call_executor = self._new_executor(self.call_workers)
+    
+    @staticmethod
+    def _new_executor(workers):
+        # spawn: сервер многопоточный, а fork копирует захваченные
+        # другими потоками блокировки
+        return ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context('spawn'),
+            initializer=watch_parent_process, initargs=(os.getpid(),))
+    
+    def _replace_broken(self, attribute, broken):
+        """Новый пул вместо сломанного broken (если его еще не заменили)"""
+        with self._pool_lock:
+            if getattr(self, attribute) is broken:
+                print("⚠️  Процесс пула обработки завершился аварийно, пул перезапущен",
+                      flush=True)
+                broken.shutdown(wait=False, cancel_futures=True)
+                workers = self.workers if attribute == '_executor' else self.call_workers
+                setattr(self, attribute, self._new_executor(workers))
+            return getattr(self, attribute)
+    
+    def register(self, name, func, extensions, cleanup=None, on_result=None, first=False):
+        """Регистрация обработчика
+        
+        on_result(фото, результат) вызывается в процессе сервера после
+        успешной обработки, например чтобы записать результат в индекс.
+        """
+        self.processors[name] = (func, tuple(extensions), cleanup, on_result)
+        if first:
+            self.first.add(name)
+    
+    def applicable(self, photo):
+        """Имена обработчиков, применимых к файлу"""
+        extension = os.path.splitext(photo)[1].lower()
+        return [name for name, (_, extensions, _, _) in self.processors.items()
+                if extension in extensions]
+    
+    def submit(self, filepath):
+        """Постановка нового файла в обработку, возвращает имена обработчиков"""
+        photo = os.path.basename(filepath)
+        names = self.applicable(photo)
+        self.store.add(photo, names, status='running')
+        self._start(photo, names)
+        return names
+    
+    def enqueue_existing(self):
+        """Задачи для файлов, появившихся до регистрации обработчиков"""
+        added = 0
+        for photo in sorted(os.listdir(self.photos_dir)):
+            names = self.applicable(photo)
+            if names and os.path.isfile(os.path.join(self.photos_dir, photo)):
+                added += self.store.add_missing(photo, names)
+        return added
+    
+    def resume(self):
+        """Запуск задач, не выполненных до перезапуска сервера"""
+        # Сначала быстрые обработчики всех фото (в порядке регистрации),
+        # чтобы миниатюры и заглушки не ждали кодирования в AVIF
+        order = {name: index for index, name in enumerate(self.processors)}
+        jobs = sorted(((photo, name) for photo, name in self.store.claim_pending()
+                       if name in order), key=lambda job: order[job[1]])
+        by_photo = OrderedDict()
+        for photo, name in jobs:
+            by_photo.setdefault(photo, []).append(name)
+        for photo, names in by_photo.items():
+            self._start(photo, names)
+        return len(jobs)
+    
+    def call(self, func, *args):
+        """Выполнение функции в отдельном пуле (вне очереди фоновых задач)
+        с ожиданием результата"""
+        if self._call_executor is None:
+            return func(*args)
+        executor = self._call_executor
+        try:
+            return executor.submit(func, *args).result()
+        except BrokenProcessPool:
+            # Один повтор в новом пуле; если процесс убила сама функция,
+            # ошибка дойдет до запроса
+            executor = self._replace_broken('_call_executor', executor)
+            return executor.submit(func, *args).result()
+    
+    def forget(self, photo):
+        """Фото удалено: задачи и производные файлы больше не нужны"""
+        self.store.remove(photo)
+        for name in self.applicable(photo):
+            self._cleanup(photo, name)
+    
+    def _start(self, photo, names):
+        """Запуск задач фото: сначала (по одному) обработчики first, затем остальные"""
+        first = next((name for name in names if name in self.first), None)
+        if first is None:
+            for name in names:
+                self._run(photo, name)
+        else:
+            self._run(photo, first, then=[name for name in names if name != first])
+    
+    def _run(self, photo, name, then=()):
+        func = self.processors[name][0]
+        filepath = os.path.join(self.photos_dir, photo)
+        if self._executor is None:
+            try:
+                result, error = func(filepath), None
+            except Exception as e:
+                result, error = None, f"{type(e).__name__}: {e}"
+            self._finished(photo, name, result, error, then)
+            return
+        executor = self._executor
+        try:
+            try:
+                future = executor.submit(func, filepath)
+            except BrokenProcessPool:
+                executor = self._replace_broken('_executor', executor)
+                future = executor.submit(func, filepath)
+        except Exception as e:
+            # Задача не запустилась: она не должна остаться в running
+            self._finished(photo, name, None, f"{type(e).__name__}: {e}", then)
+            return
+        future.add_done_callback(partial(self._future_done, photo, name, then, executor))
+    
+    def _future_done(self, photo, name, then, executor, future):
+        try:
+            result, error = future.result(), None
+        except BrokenProcessPool as e:
+            # Погиб процесс пула, эту ошибку получают все его задачи
+            self._replace_broken('_executor', executor)
+            with self._pool_lock:
+                attempts = self._attempts[photo, name] = self._attempts.get((photo, name), 0) + 1
+            if attempts < self.MAX_ATTEMPTS:
+                self._run(photo, name, then)
+                return
+            result, error = None, f"{type(e).__name__}: {e}"
+        except Exception as e:
+            result, error = None, f"{type(e).__name__}: {e}"
+        with self._pool_lock:
+            self._attempts.pop((photo, name), None)
+        try:
+            self._finished(photo, name, result, error, then)
+        except Exception as e:
+            print(f"❌ Не удалось сохранить результат {name} для {photo}: {e}", flush=True)
+    
+    def _finished(self, photo, name, result, error, then=()):
+        if error:
+            print(f"⚠️  {name} для {photo}: {error}", flush=True)
+        self.store.finish(photo, name, result, error)
+        # Фото удалили, пока шла обработка: убираем то, что успели создать
+        if not os.path.exists(os.path.join(self.photos_dir, photo)):
+            self._cleanup(photo, name)
+            return
+        if not error and self.processors[name][3] is not None:
+            self.processors[name][3](photo, result)
+            # Удаление могло пройти между проверкой и записью результата:
+            # его cleanup уже выполнен, поэтому убираем записанное сами
+            if not os.path.exists(os.path.join(self.photos_dir, photo)):
+                self._cleanup(photo, name)
+                return
+        # Остальные обработчики работают и с неизмененным файлом
+        if then:
+            self._start(photo, then)
+    
+    def _cleanup(self, photo, name):
+        cleanup = self.processors[name][2]
+        if cleanup is not None:
+            try:
+                cleanup(photo)
+            except OSError as e:
+                print(f"⚠️  Не удалось убрать результаты {name} для {photo}: {e}", flush=True)
+    
+    def shutdown(self):
+        """Остановка пулов; текущие задачи дорабатывают"""
+        for executor in (self._executor, self._call_executor):
+            if executor is not None:
+                executor.shutdown(wait=True)
+
 
 class WebsiteHandler(SimpleHTTPRequestHandler):
     
     # Папка для хранения фотографий
     PHOTOS_DIR = "photos"
+    # Оригиналы фото, замененные оптимизированными при загрузке
+    ARCHIVE_DIR = "archive"
+    
+    # Производные файлы (миниатюры и т.п.), их можно удалить в любой момент
+    CACHE_DIR = "cache"
+    THUMBS_DIR = os.path.join(CACHE_DIR, "thumbs")
+    THUMBNAIL_WIDTHS = (320, 640, 960)
+    # Ширина плитки галереи для выбора миниатюры браузером
+    THUMBNAIL_SIZES = "(max-width: 600px) 100vw, 400px"
+    # Уменьшенные копии /photos/<имя>?w=<ширина>&q=<качество>: только
+    # разрешенные ширины и качества, чтобы кэш на диске не разрастался
+    DERIVED_DIR = os.path.join(CACHE_DIR, "derived")
+    RESIZE_WIDTHS = (320, 640, 960, 1280, 1920)
+    RESIZE_QUALITIES = (50, 60, 70, 80, 90)
+    DEFAULT_RESIZE_QUALITY = 80
+    derivative_cache = DerivativeCache(DERIVED_DIR)
+    # Копии фото в WebP/AVIF, выбираются по заголовку Accept
+    FORMATS_DIR = os.path.join(CACHE_DIR, "formats")
+    MODERN_SOURCE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+    modern_formats = available_modern_formats()
+    # Состояние фоновой обработки (и другие сведения о фото)
+    DATABASE_PATH = os.path.join(CACHE_DIR, "photos.sqlite3")
+    
+    # Статические файлы; общие CSS и JS собираются сюда при запуске
+    STATIC_DIR = "static"
+    static_assets = {}
+    FINGERPRINTED_NAME = re.compile(r'\.[0-9a-f]{12}\.(css|js)$')
+    
+    # Поддерживаемые форматы: фото и видео показываются в галерее вместе
+    PHOTO_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+    VIDEO_EXTENSIONS = ('.mp4',)
+    
+    # Постоянные соединения: сколько ждать следующего запроса и
+    # сколько запросов обслужить на одном соединении
+    protocol_version = "HTTP/1.1"
+    keepalive_timeout = DEFAULT_KEEPALIVE_TIMEOUT
+    max_keepalive_requests = DEFAULT_MAX_KEEPALIVE_REQUESTS
+    # Сколько секунд рабочий поток ждет следующего запроса сам, прежде
+    # чем отдать простаивающее соединение серверу (PooledHTTPServer)
+    IDLE_GRACE = 0.002
+    # Заголовки и тело уходят отдельными записями, без TCP_NODELAY
+    # алгоритм Нейгла задерживает ответы на keep-alive соединении
+    disable_nagle_algorithm = True
+    
+    # Файлы отдаются через sendfile, без sendfile - блоками такого размера
+    use_sendfile = True
+    COPY_CHUNK_SIZE = 64 * 1024
+    # Больше диапазонов в одном Range не обслуживаем - отдаем файл целиком
+    MAX_RANGES = 16
+    
+    # Кэш содержимого фото в памяти (FileCache), по умолчанию выключен
+    photo_cache = None
+    
+    # Фоновая обработка загруженных файлов (ProcessingStage)
+    processing = None
+    # Индекс метаданных фото (PhotoIndex) и список фото в памяти поверх
+    # него (PhotoListing), который следит за папкой: auto, inotify или poll
+    photo_index = None
+    photo_listing = None
+    photos_watch = 'auto'
+    # За папкой из всех процессов pre-fork следит тот, кто держит этот flock
+    PHOTOS_WATCH_LOCK = os.path.join(CACHE_DIR, "photos.watch.lock")
+    
+    # Страницы /api/photos и галереи; остальное галерея подгружает при прокрутке
+    API_PAGE_SIZE = 48
+    MAX_PAGE_SIZE = 500
+    GALLERY_PAGE_SIZE = 24
+    
+    # Похожие фото по перцептивным хэшам: порог расстояния Хэмминга и
+    # промежуток между кадрами серии, которую галерея сворачивает в одну
+    # плитку (--collapse-bursts)
+    DUPLICATE_DISTANCE = DEFAULT_DUPLICATE_DISTANCE
+    BURST_INTERVAL = 60
+    collapse_bursts = False
+    # Вид хэша -> (время изменения таблицы хэшей, HammingIndex, кэш
+    # кластеров по порогу); общий для потоков, меняется под hamming_lock
+    hamming_indexes = {}
+    hamming_lock = threading.Lock()
+    
+    # Значения, посчитанные за текущий запрос (список фото, версия набора
+    # фото), см. memoized; сбрасывается перед каждым запросом
+    memo = None
+    
+    # Сжатие gzip/brotli и кэш уже сжатых вариантов
+    compress_responses = True
+    compression_cache = CompressionCache()
+    # Статические файлы больше этого размера отдаются без сжатия через sendfile
+    MAX_COMPRESS_FILE_SIZE = 1024 * 1024
+    
+    def handle(self):
+        """Обработка нескольких запросов на одном соединении
+        
+        Если сервер умеет держать простаивающие соединения вне рабочих
+        потоков (parks_idle_connections), соединение без следующего
+        запроса отдается ему (idle = True), а поток свободен для других.
+        """
+        self.close_connection = True
+        self.idle = False
+        self.requests_handled = 0
+        if getattr(self.server, 'parks_idle_connections', False):
+            self.requests_handled = self.server.resume_count(self.connection)
+        while True:
+            self.requests_handled += 1
+            self.headers = None
+            self.body_consumed = False
+            self.vary = None
+            self.memo = {}
+            self.handle_one_request()
+            if self.close_connection or not self.wait_for_next_request():
+                break
+    
+    def wait_for_next_request(self):
+        """Ожидание следующего запроса не дольше keepalive_timeout"""
+        if getattr(self.server, 'parks_idle_connections', False):
+            return self.next_request_buffered()
+        try:
+            self.connection.settimeout(self.keepalive_timeout)
+            ready = bool(self.rfile.peek(1))
+        except OSError:
+            ready = False
+        finally:
+            try:
+                self.connection.settimeout(self.timeout)
+            except OSError:
+                pass
+        return ready
+    
+    def next_request_buffered(self):
+        """Пришел ли уже следующий запрос, без ожидания; если нет и клиент
+        не закрыл соединение - оно помечается простаивающим (idle)"""
+        try:
+            self.connection.settimeout(0)
+            # Запрос мог целиком попасть в буфер rfile вместе с предыдущим
+            if self.rfile.peek(1):
+                return True
+            if self.IDLE_GRACE and hasattr(select, 'poll'):
+                # Клиент, шлющий запросы подряд, обычно успевает прислать
+                # следующий за это время - без передачи соединения серверу
+                poller = select.poll()
+                poller.register(self.connection, select.POLLIN)
+                poller.poll(self.IDLE_GRACE * 1000)
+            # Пусто и в буфере, и в сокете: b'' - клиент закрыл соединение
+            return bool(self.connection.recv(1, socket.MSG_PEEK))
+        except BlockingIOError:
+            self.idle = True
+            return False
+        except OSError:
+            return False
+        finally:
+            try:
+                self.connection.settimeout(self.timeout)
+            except OSError:
+                pass
+    
+    def handle_expect_100(self):
+        """Промежуточный ответ 100 Continue не управляет соединением"""
+        self.sending_interim = True
+        try:
+            return super().handle_expect_100()
+        finally:
+            self.sending_interim = False
+    
+    def end_headers(self):
+        """Заголовок Connection для корректного завершения соединения"""
+        if not self.close_connection and not getattr(self, 'sending_interim', False):
+            if (getattr(self, 'requests_handled', 1) >= self.max_keepalive_requests
+                    or self.has_unread_body()):
+                self.send_header('Connection', 'close')
+            elif self.request_version == 'HTTP/1.0':
+                self.send_header('Connection', 'keep-alive')
+        super().end_headers()
+    
+    def has_unread_body(self):
+        """Осталось ли в соединении непрочитанное тело запроса"""
+        if getattr(self, 'body_consumed', False) or getattr(self, 'headers', None) is None:
+            return False
+        try:
+            return int(self.headers.get('Content-Length') or 0) > 0
+        except ValueError:
+            return True
+    
+    def read_request_body(self):
+        """Чтение тела запроса целиком"""
+        content_length = int(self.headers['Content-Length'])
+        self.body_consumed = True
+        return self.rfile.read(content_length)
     
     def do_GET(self):
         """Обработка GET запросов"""
@@ -32,10 +2275,20 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
             self.send_upload_page()
         elif self.path == '/api/time':
             self.send_api_time()
-        elif self.path == '/api/photos':
+        elif urllib.parse.urlsplit(self.path).path == '/api/photos':
             self.send_api_photos()
+        elif self.path == '/api/cache-stats':
+            self.send_api_cache_stats()
+        elif self.path == '/api/jobs' or self.path.startswith('/api/jobs/'):
+            self.send_api_jobs()
+        elif self.path.startswith('/api/has-hash/'):
+            self.send_api_has_hash()
+        elif urllib.parse.urlsplit(self.path).path == '/api/duplicates':
+            self.send_api_duplicates()
         elif self.path.startswith('/photos/'):
             self.serve_photo()
+        elif self.path.startswith('/thumbs/'):
+            self.serve_thumbnail()
         else:
             # Для статических файлов (CSS, JS)
             if self.path.startswith('/static/'):
@@ -57,11 +2310,14 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
     def serve_static(self):
         """Обслуживание статических файлов"""
         try:
-            filepath = self.path[1:]  # убираем первый слеш
-            if os.path.exists(filepath):
-                with open(filepath, 'rb') as f:
-                    file_data = f.read()
-                
+            relative = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)[len('/static/'):]
+            static_root = os.path.abspath(self.STATIC_DIR)
+            filepath = os.path.abspath(os.path.join(static_root, relative))
+            # Не выпускаем запрос за пределы папки static
+            if os.path.commonpath([static_root, filepath]) != static_root:
+                self.send_error(404)
+                return
+            if os.path.isfile(filepath):
                 # Определяем MIME тип
                 mime_type, _ = mimetypes.guess_type(filepath)
                 if not mime_type:
@@ -72,11 +2328,11 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
                     else:
                         mime_type = 'text/plain'
                 
-                self.send_response(200)
-                self.send_header('Content-type', mime_type)
-                self.send_header('Content-Length', str(len(file_data)))
-                self.end_headers()
-                self.wfile.write(file_data)
+                # Файлы с хэшем в имени никогда не меняются
+                cache_control = None
+                if self.FINGERPRINTED_NAME.search(filepath):
+                    cache_control = 'public, max-age=31536000, immutable'
+                self.send_file(filepath, mime_type, cache_control)
             else:
                 self.send_error(404)
         except Exception as e:
@@ -84,8 +2340,12 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
     
     def send_home_page(self):
         """Главная страница"""
+        validators = self.page_validators('home')
+        if self.check_not_modified(validators):
+            return
+        
         # Получаем последние 3 фото для превью
-        photos = self.get_photos_list()[:3]
+        photos = self.get_photos_list(limit=3)
         photos_html = self.generate_photos_html(photos, "latest-photos")
         
         html_content = f"""
@@ -95,9 +2355,7 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
             <meta charset="UTF-8">
             <meta name="viewport" content="width=device-width, initial-scale=1.0">
             <title>Главная - Нам Полгода</title>
-            <style>
-                {self.get_css_styles()}
-            </style>
+            {self.get_stylesheet_tag()}
         </head>
         <body>
             {self.get_navigation()}
@@ -130,7 +2388,7 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
                 
                 <section class="stats">
                     <div class="stat-card">
-                        <div class="stat-number">{len(self.get_photos_list())}</div>
+                        <div class="stat-number">{self.get_photo_count()}</div>
                         <div class="stat-label">Фотографий</div>
                     </div>
                     <div class="stat-card">
@@ -146,21 +2404,26 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
             
             {self.get_footer()}
             
-            <script>
-                {self.get_javascript()}
-            </script>
+            {self.get_script_tag()}
         </body>
         </html>
         """
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html; charset=utf-8')
-        self.end_headers()
-        self.wfile.write(html_content.encode('utf-8'))
+        self.send_html_response(html_content, validators=validators)
     
     def send_gallery_page(self):
         """Страница галереи"""
-        photos = self.get_photos_list()
-        photos_html = self.generate_photos_html(photos, "gallery-grid")
+        validators = self.page_validators('gallery')
+        if self.check_not_modified(validators):
+            return
+        
+        # Первая страница; остальные скрипт подгружает из /api/photos при прокрутке
+        photos, next_cursor = self.get_photos_page(self.GALLERY_PAGE_SIZE)
+        next_page = ''
+        if next_cursor is not None:
+            next_page = (f'<div id="gallerySentinel" class="gallery-sentinel" '
+                         f'data-cursor="{next_cursor}"></div>')
+        photos_html = self.generate_photos_html(photos, "gallery-grid",
+                                                collapse_bursts=self.collapse_bursts)
         
         html_content = f"""
         <!DOCTYPE html>
@@ -169,9 +2432,7 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
             <meta charset="UTF-8">
             <meta name="viewport" content="width=device-width, initial-scale=1.0">
             <title>Галерея - Наши фото</title>
-            <style>
-                {self.get_css_styles()}
-            </style>
+            {self.get_stylesheet_tag()}
         </head>
         <body>
             {self.get_navigation()}
@@ -179,11 +2440,11 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
             <div class="container">
                 <div class="gallery-header">
                     <h1>📸 Наша галерея</h1>
-                    <p>Всего фотографий: {len(photos)}</p>
+                    <p>Всего фотографий: {self.get_photo_count()}</p>
                     <a href="/upload" class="btn btn-primary">➕ Добавить фото</a>
                 </div>
                 
-                {photos_html if photos else '''
+                {photos_html + next_page if photos else '''
                 <div class="empty-gallery">
                     <div class="empty-icon">📷</div>
                     <h2>Пока нет фотографий</h2>
@@ -193,42 +2454,120 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
                 '''}
             </div>
             
-            <!-- Модальное окно для просмотра фото -->
+            <!-- Модальное окно для просмотра фото и видео -->
             <div id="photoModal" class="modal">
                 <span class="close">&times;</span>
                 <img class="modal-content" id="modalImage">
+                <video class="modal-content" id="modalVideo" controls playsinline
+                       style="display: none"></video>
                 <div class="modal-caption" id="modalCaption"></div>
                 <button class="modal-delete btn btn-danger" id="modalDelete">🗑️ Удалить</button>
             </div>
             
             {self.get_footer()}
             
+            {self.get_script_tag()}
             <script>
-                {self.get_javascript()}
-                
                 // Модальное окно для фотографий
                 const modal = document.getElementById('photoModal');
                 const modalImg = document.getElementById('modalImage');
+                const modalVideo = document.getElementById('modalVideo');
                 const modalCaption = document.getElementById('modalCaption');
                 const modalDelete = document.getElementById('modalDelete');
                 const closeBtn = document.querySelector('.close');
                 let currentPhotoName = '';
                 
-                // Открытие модального окна
+                // Открытие модального окна (фото или видео)
                 document.addEventListener('click', function(e) {{
-                    if (e.target.classList.contains('gallery-photo')) {{
-                        modal.style.display = 'block';
-                        modalImg.src = e.target.src;
-                        modalCaption.textContent = e.target.alt;
-                        currentPhotoName = e.target.dataset.name;
+                    const media = e.target;
+                    const isVideo = media.classList.contains('gallery-video');
+                    if (!isVideo && !media.classList.contains('gallery-photo')) {{
+                        return;
+                    }}
+                    modalImg.style.display = isVideo ? 'none' : 'block';
+                    modalVideo.style.display = isVideo ? 'block' : 'none';
+                    if (isVideo) {{
+                        // Видео играет в окне, а не в плитке
+                        media.pause();
+                        modalVideo.src = media.getAttribute('src');
+                        modalVideo.play();
+                        modalCaption.textContent = media.dataset.name;
+                    }} else {{
+                        modalImg.src = media.getAttribute('src');
+                        modalCaption.textContent = media.alt;
                     }}
+                    currentPhotoName = media.dataset.name;
+                    modal.style.display = 'block';
                 }});
                 
-                // Закрытие модального окна
-                closeBtn.onclick = function() {{
+                function closeModal() {{
                     modal.style.display = 'none';
+                    modalVideo.pause();
+                }}
+                
+                // Свернутая серия: показать или скрыть остальные кадры
+                document.addEventListener('click', function(e) {{
+                    if (e.target.classList.contains('burst-toggle')) {{
+                        const cover = e.target.dataset.burst;
+                        document.querySelectorAll('.photo-item[data-burst-of]').forEach(item => {{
+                            if (item.dataset.burstOf === cover) {{
+                                item.hidden = !item.hidden;
+                            }}
+                        }});
+                    }}
+                }});
+                
+                // Бесконечная прокрутка: следующие страницы по курсору
+                const grid = document.querySelector('.gallery-grid');
+                const sentinel = document.getElementById('gallerySentinel');
+                let nextCursor = sentinel ? sentinel.dataset.cursor : null;
+                let loadingPage = false;
+                
+                function sentinelNearby() {{
+                    return sentinel.getBoundingClientRect().top < window.innerHeight + 800;
+                }}
+                
+                function loadNextPage() {{
+                    if (!nextCursor || loadingPage) return;
+                    loadingPage = true;
+                    fetch('/api/photos?html=1&limit={self.GALLERY_PAGE_SIZE}&cursor=' +
+                          encodeURIComponent(nextCursor))
+                        .then(response => response.json())
+                        .then(data => {{
+                            const template = document.createElement('template');
+                            template.innerHTML = data.html || '';
+                            const page = template.content.firstElementChild;
+                            if (page) {{
+                                grid.append(...page.children);
+                            }}
+                            nextCursor = data.next_cursor;
+                            loadingPage = false;
+                            if (!nextCursor) {{
+                                pageObserver.disconnect();
+                                sentinel.remove();
+                            }} else if (sentinelNearby()) {{
+                                // Страница не заполнила экран - грузим следующую сразу
+                                loadNextPage();
+                            }}
+                        }})
+                        .catch(error => {{
+                            loadingPage = false;
+                            showNotification('Ошибка сети', 'error');
+                        }});
+                }}
+                
+                const pageObserver = new IntersectionObserver(entries => {{
+                    if (entries.some(entry => entry.isIntersecting)) {{
+                        loadNextPage();
+                    }}
+                }}, {{ rootMargin: '800px' }});
+                if (sentinel) {{
+                    pageObserver.observe(sentinel);
                 }}
                 
+                // Закрытие модального окна
+                closeBtn.onclick = closeModal;
+                
                 // Удаление фото
                 modalDelete.onclick = function() {{
                     if (confirm('Удалить эту фотографию?')) {{
@@ -237,7 +2576,7 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
                             .then(data => {{
                                 if (data.success) {{
                                     showNotification('Фото удалено!', 'success');
-                                    modal.style.display = 'none';
+                                    closeModal();
                                     setTimeout(() => location.reload(), 1000);
                                 }} else {{
                                     showNotification('Ошибка удаления: ' + data.error, 'error');
@@ -252,27 +2591,28 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
                 // Закрытие по клику вне изображения
                 window.onclick = function(event) {{
                     if (event.target == modal) {{
-                        modal.style.display = 'none';
+                        closeModal();
                     }}
                 }}
                 
                 // Закрытие по ESC
                 document.addEventListener('keydown', function(event) {{
                     if (event.key === 'Escape') {{
-                        modal.style.display = 'none';
+                        closeModal();
                     }}
                 }});
             </script>
         </body>
         </html>
         """
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html; charset=utf-8')
-        self.end_headers()
-        self.wfile.write(html_content.encode('utf-8'))
+        self.send_html_response(html_content, validators=validators)
     
     def send_upload_page(self):
         """Страница загрузки фото"""
+        validators = self.page_validators('upload', depends_on_photos=False)
+        if self.check_not_modified(validators):
+            return
+        
         html_content = f"""
         <!DOCTYPE html>
         <html lang="ru">
@@ -280,9 +2620,7 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
             <meta charset="UTF-8">
             <meta name="viewport" content="width=device-width, initial-scale=1.0">
             <title>Добавить фото</title>
-            <style>
-                {self.get_css_styles()}
-            </style>
+            {self.get_stylesheet_tag()}
         </head>
         <body>
             {self.get_navigation()}
@@ -293,9 +2631,9 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
                     
                     <div class="upload-area" id="uploadArea">
                         <div class="upload-icon">📷</div>
-                        <h3>Перетащите фото сюда</h3>
+                        <h3>Перетащите фото или видео сюда</h3>
                         <p>или</p>
-                        <input type="file" id="fileInput" accept="image/*" multiple style="display: none;">
+                        <input type="file" id="fileInput" accept="image/*,video/mp4" multiple style="display: none;">
                         <label for="fileInput" class="btn btn-primary">Выбрать файлы</label>
                     </div>
                     
@@ -312,9 +2650,8 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
             
             {self.get_footer()}
             
+            {self.get_script_tag()}
             <script>
-                {self.get_javascript()}
-                
                 const uploadArea = document.getElementById('uploadArea');
                 const fileInput = document.getElementById('fileInput');
                 const uploadPreview = document.getElementById('uploadPreview');
@@ -357,14 +2694,13 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
                     let uploadedCount = 0;
                     
                     Array.from(files).forEach((file, index) => {{
-                        if (file.type.startsWith('image/')) {{
-                            const reader = new FileReader();
-                            
-                            reader.onload = function(e) {{
+                        const isVideo = file.type === 'video/mp4';
+                        if (file.type.startsWith('image/') || isVideo) {{
+                            const addPreview = (media) => {{
                                 const preview = document.createElement('div');
                                 preview.className = 'photo-preview';
                                 preview.innerHTML = `
-                                    <img src="${{e.target.result}}" alt="${{file.name}}">
+                                    ${{media}}
                                     <div class="preview-info">
                                         <span>${{file.name}}</span>
                                         <span class="file-size">(${{Math.round(file.size/1024)}} KB)</span>
@@ -373,10 +2709,22 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
                                 uploadPreview.appendChild(preview);
                             }};
                             
-                            reader.readAsDataURL(file);
+                            if (isVideo) {{
+                                // Видео не читаем целиком - браузер покажет его по ссылке на файл
+                                addPreview(`<video src="${{URL.createObjectURL(file)}}" preload="metadata" muted></video>`);
+                            }} else {{
+                                const reader = new FileReader();
+                                reader.onload = function(e) {{
+                                    addPreview(`<img src="${{e.target.result}}" alt="${{file.name}}">`);
+                                }};
+                                reader.readAsDataURL(file);
+                            }}
                             
                             // Загрузка на сервер
-                            uploadFile(file, index, files.length).then(() => {{
+                            uploadFile(file, index, files.length).then(data => {{
+                                if (data.duplicate) {{
+                                    showNotification(file.name + ' уже есть в галерее', 'success');
+                                }}
                                 uploadedCount++;
                                 const progress = (uploadedCount / files.length) * 100;
                                 progressFill.style.width = progress + '%';
@@ -392,12 +2740,36 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
                                 showNotification('Ошибка загрузки: ' + file.name, 'error');
                             }});
                         }} else {{
-                            showNotification('Файл ' + file.name + ' не является изображением', 'error');
+                            showNotification('Файл ' + file.name + ' не является фото или видео MP4', 'error');
                         }}
                     }});
                 }}
                 
+                // SHA-256 файла в браузере (crypto.subtle есть только на HTTPS и localhost)
+                function hashFile(file) {{
+                    if (!window.crypto || !crypto.subtle) {{
+                        return Promise.resolve(null);
+                    }}
+                    return file.arrayBuffer()
+                        .then(buffer => crypto.subtle.digest('SHA-256', buffer))
+                        .then(digest => Array.from(new Uint8Array(digest))
+                            .map(byte => byte.toString(16).padStart(2, '0')).join(''))
+                        .catch(() => null);
+                }}
+                
+                // Фото, которое уже есть на сервере, повторно не передаем
                 function uploadFile(file) {{
+                    return hashFile(file)
+                        .then(hash => hash
+                            ? fetch('/api/has-hash/' + hash).then(response => response.json())
+                            : {{ exists: false }})
+                        .catch(() => ({{ exists: false }}))
+                        .then(known => known.exists
+                            ? {{ success: true, filename: known.filename, duplicate: true }}
+                            : sendFile(file));
+                }}
+                
+                function sendFile(file) {{
                     return new Promise((resolve, reject) => {{
                         const formData = new FormData();
                         formData.append('photo', file);
@@ -423,13 +2795,14 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
         </body>
         </html>
         """
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html; charset=utf-8')
-        self.end_headers()
-        self.wfile.write(html_content.encode('utf-8'))
+        self.send_html_response(html_content, validators=validators)
     
     def send_about_page(self):
         """Страница "О нас" """
+        validators = self.page_validators('about', depends_on_photos=False)
+        if self.check_not_modified(validators):
+            return
+        
         html_content = f"""
         <!DOCTYPE html>
         <html lang="ru">
@@ -437,9 +2810,7 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
             <meta charset="UTF-8">
             <meta name="viewport" content="width=device-width, initial-scale=1.0">
             <title>О нас - Нам полгода</title>
-            <style>
-                {self.get_css_styles()}
-            </style>
+            {self.get_stylesheet_tag()}
         </head>
         <body>
             {self.get_navigation()}
@@ -484,13 +2855,17 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
         </body>
         </html>
         """
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html; charset=utf-8')
-        self.end_headers()
-        self.wfile.write(html_content.encode('utf-8'))
+        self.send_html_response(html_content, validators=validators)
     
     def send_contact_page(self, message=None, message_type='success'):
         """Страница контактов"""
+        # Страница с результатом отправки формы не кэшируется
+        validators = None
+        if not message:
+            validators = self.page_validators('contact', depends_on_photos=False)
+            if self.check_not_modified(validators):
+                return
+        
         message_html = ""
         if message:
             message_class = "success" if message_type == 'success' else "error"
@@ -503,9 +2878,7 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
             <meta charset="UTF-8">
             <meta name="viewport" content="width=device-width, initial-scale=1.0">
             <title>Контакты - Нам полгода</title>
-            <style>
-                {self.get_css_styles()}
-            </style>
+            {self.get_stylesheet_tag()}
         </head>
         <body>
             {self.get_navigation()}
@@ -554,17 +2927,13 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
             {self.get_footer()}
         </body>
         </html>
-        """
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html; charset=utf-8')
-        self.end_headers()
-        self.wfile.write(html_content.encode('utf-8'))
+        """
+        self.send_html_response(html_content, validators=validators)
     
     def handle_contact_form(self):
         """Обработка формы обратной связи"""
         try:
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length).decode('utf-8')
+            post_data = self.read_request_body().decode('utf-8')
             params = urllib.parse.parse_qs(post_data)
             
             name = html.escape(params.get('name', [''])[0])
@@ -600,8 +2969,7 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
             os.makedirs(self.PHOTOS_DIR, exist_ok=True)
             
             # Читаем данные формы
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
+            post_data = self.read_request_body()
             
             # Простой парсинг multipart/form-data
             boundary = content_type.split("boundary=")[1].encode()
@@ -616,28 +2984,71 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
                         continue
                     filename = part[filename_start:filename_end].decode('utf-8', errors='ignore')
                     
-                    # Извлекаем данные файла
+                    # Извлекаем данные файла (часть заканчивается переводом
+                    # строки перед следующей границей)
                     file_data_start = part.find(b'\r\n\r\n') + 4
-                    file_data_end = part.find(b'\r\n--', file_data_start)
-                    if file_data_start == 3 or file_data_end == -1:
+                    file_data_end = part.rfind(b'\r\n')
+                    if file_data_start == 3 or file_data_end < file_data_start:
                         continue
                     file_data = part[file_data_start:file_data_end]
                     
                     # Проверяем тип файла
-                    if not any(filename.lower().endswith(ext) for ext in ['.jpg', '.jpeg', '.png', '.gif', '.webp']):
+                    if not filename.lower().endswith(self.PHOTO_EXTENSIONS + self.VIDEO_EXTENSIONS):
                         response = {'success': False, 'error': 'Invalid file type'}
                         self.send_json_response(response, 400)
                         return
                     
-                    # Сохраняем файл
-                    safe_filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{filename}"
-                    filepath = os.path.join(self.PHOTOS_DIR, safe_filename)
+                    # То же содержимое уже загружено - второй копии не делаем
+                    digest = hashlib.sha256(file_data).hexdigest()
+                    existing = self.find_photo_by_hash(digest)
+                    if existing is not None:
+                        self.send_json_response({'success': True, 'filename': existing,
+                                                 'duplicate': True})
+                        return
+                    
+                    # Сохраняем файл; O_EXCL не дает перезаписать файл с тем же
+                    # именем, загруженный в ту же секунду
+                    safe_filename, filepath = self.save_new_photo(
+                        f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{filename}", file_data)
+                    self.invalidate_cached_photo(filepath)
+                    
+                    # Файл уже сохранен, поэтому ошибки индекса и фоновой
+                    # обработки не делают загрузку неудачной: их исправят
+                    # сверка при запуске и --backfill
+                    if self.photo_index is not None:
+                        try:
+                            owner = self.photo_index.claim_hash(digest, safe_filename)
+                            if owner != safe_filename:
+                                # Тот же файл одновременно загрузили в другом запросе
+                                if os.path.exists(os.path.join(self.PHOTOS_DIR, owner)):
+                                    os.remove(filepath)
+                                    self.send_json_response({'success': True, 'filename': owner,
+                                                             'duplicate': True})
+                                    return
+                                self.photo_index.claim_hash(digest, safe_filename, replace=True)
+                            # В списке фото сразу, полные метаданные запишет фоновая
+                            # обработка (после оптимизации файла)
+                            metadata, _ = extract_metadata_safe(filepath)
+                            if metadata is not None:
+                                self.photo_records().update(safe_filename, metadata)
+                        except Exception as e:
+                            print(f"⚠️  Не удалось записать {safe_filename} в индекс: {e}",
+                                  flush=True)
                     
-                    with open(filepath, 'wb') as f:
-                        f.write(file_data)
+                    # Миниатюры, подготовка видео и т.п. - в фоне,
+                    # ответ не ждет обработки
+                    processors = []
+                    if self.processing is not None:
+                        try:
+                            processors = self.processing.submit(filepath)
+                        except Exception as e:
+                            print(f"⚠️  Не удалось поставить {safe_filename} в обработку: {e}",
+                                  flush=True)
                     
                     # Отправляем успешный ответ
-                    response = {'success': True, 'filename': safe_filename}
+                    response = {'success': True, 'filename': safe_filename,
+                                'processing': processors,
+                                'status_url': f'/api/jobs/{urllib.parse.quote(safe_filename)}'}
                     self.send_json_response(response)
                     return
             
@@ -648,6 +3059,53 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
             response = {'success': False, 'error': f'Upload error: {str(e)}'}
             self.send_json_response(response, 500)
     
+    @classmethod
+    def process_added_photos(cls, names):
+        """Фоновая обработка файлов, скопированных в папку в обход сайта"""
+        for name in names:
+            cls.processing.submit(os.path.join(cls.PHOTOS_DIR, name))
+    
+    @classmethod
+    def forget_removed_photos(cls, names):
+        """Задачи и производные файлы (миниатюры, форматы, архив) фото,
+        удаленных из папки в обход сайта"""
+        for name in names:
+            cls.processing.forget(name)
+    
+    def photo_records(self):
+        """Куда записывать изменения фото: список в памяти (он пишет и в
+        индекс) или сам индекс"""
+        return self.photo_listing if self.photo_listing is not None else self.photo_index
+    
+    def find_photo_by_hash(self, digest):
+        """Уже загруженное фото с таким SHA-256 или None"""
+        if self.photo_index is None:
+            return None
+        photo = self.photo_index.find_by_hash(digest)
+        if photo is not None and os.path.isfile(os.path.join(self.PHOTOS_DIR, photo)):
+            return photo
+        return None
+    
+    def save_new_photo(self, filename, data):
+        """Запись нового файла фото под свободным именем, возвращает (имя, путь)"""
+        base, extension = os.path.splitext(filename)
+        for attempt in range(1000):
+            candidate = f"{base}_{attempt}{extension}" if attempt else filename
+            filepath = os.path.join(self.PHOTOS_DIR, candidate)
+            try:
+                fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                continue
+            with open(fd, 'wb') as f:
+                f.write(data)
+            return candidate, filepath
+        raise OSError(f"нет свободного имени для {filename}")
+    
+    def invalidate_cached_photo(self, filepath):
+        """Сброс закэшированного содержимого фото"""
+        if self.photo_cache is not None:
+            self.photo_cache.invalidate(filepath)
+    
     def handle_photo_delete(self):
         """Удаление фото"""
         try:
@@ -655,7 +3113,18 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
             filepath = os.path.join(self.PHOTOS_DIR, filename)
             
             if os.path.exists(filepath) and os.path.isfile(filepath):
+                self.derivative_cache.remove(filepath)
                 os.remove(filepath)
+                self.invalidate_cached_photo(filepath)
+                # С фоновой обработкой запись в индексе убирает cleanup
+                # обработчика metadata
+                if self.processing is not None:
+                    self.processing.forget(os.path.basename(filepath))
+                else:
+                    if self.photo_index is not None:
+                        self.photo_records().remove(os.path.basename(filepath))
+                    remove_thumbnails(os.path.basename(filepath), self.THUMBS_DIR,
+                                      self.THUMBNAIL_WIDTHS)
                 response = {'success': True}
             else:
                 response = {'success': False, 'error': 'File not found'}
@@ -666,39 +3135,506 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
             response = {'success': False, 'error': f'Delete error: {str(e)}'}
             self.send_json_response(response, 500)
     
+    def serve_thumbnail(self):
+        """Отдача миниатюры фото"""
+        try:
+            filename = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path[len('/thumbs/'):])
+            filepath = os.path.join(self.THUMBS_DIR, filename)
+            if (os.path.basename(filename) == filename and THUMBNAIL_NAME.match(filename)
+                    and os.path.isfile(filepath)):
+                self.send_file(filepath, 'image/jpeg', 'max-age=3600', use_cache=True)
+            else:
+                self.send_error(404, "Thumbnail not found")
+        except Exception as e:
+            self.send_error(500, f"Thumbnail serve error: {str(e)}")
+    
     def serve_photo(self):
-        """Отдача фото"""
+        """Отдача фото; с ?w= (и ?q=) - уменьшенной копии
+        
+        Остальные параметры (например ?v= для сброса кэша браузера)
+        не учитываются.
+        """
         try:
-            filename = urllib.parse.unquote(self.path.split('/photos/')[1])
+            url = urllib.parse.urlsplit(self.path)
+            filename = urllib.parse.unquote(url.path[len('/photos/'):])
             filepath = os.path.join(self.PHOTOS_DIR, filename)
             
-            if os.path.exists(filepath) and os.path.isfile(filepath):
-                with open(filepath, 'rb') as f:
-                    file_data = f.read()
-                
+            if (os.path.basename(filename) == filename and os.path.exists(filepath)
+                    and os.path.isfile(filepath)):
                 # Определяем MIME тип
                 mime_type, _ = mimetypes.guess_type(filepath)
                 if not mime_type:
                     mime_type = 'image/jpeg'
                 
-                self.send_response(200)
-                self.send_header('Content-type', mime_type)
-                self.send_header('Content-Length', str(len(file_data)))
-                self.send_header('Cache-Control', 'max-age=3600')  # Кэшируем на 1 час
-                self.end_headers()
-                self.wfile.write(file_data)
+                if filepath.lower().endswith(self.MODERN_SOURCE_EXTENSIONS):
+                    self.vary = 'Accept'
+                params = urllib.parse.parse_qs(url.query)
+                if 'w' in params:
+                    resized = self.get_resized_photo(filepath, params)
+                    if resized is None:
+                        return
+                    filepath, mime_type = resized
+                else:
+                    filepath, mime_type = self.choose_photo_variant(filepath, mime_type)
+                
+                self.send_file(filepath, mime_type, 'max-age=3600',  # Кэшируем на 1 час
+                               use_cache=True)
             else:
                 self.send_error(404, "Photo not found")
                 
         except Exception as e:
             self.send_error(500, f"Photo serve error: {str(e)}")
     
-    def send_json_response(self, data, status=200):
+    def get_resized_photo(self, filepath, params):
+        """Путь к уменьшенной копии фото по параметрам запроса (parse_qs)
+        
+        Возвращает None, если уже отправлен ответ об ошибке. Без Pillow
+        и для форматов, которые не уменьшаем, отдается оригинал.
+        """
+        try:
+            width = int(params['w'][0])
+            quality = int(params.get('q', [self.DEFAULT_RESIZE_QUALITY])[0])
+        except (KeyError, ValueError):
+            self.send_error(400, "Expected ?w=<width>[&q=<quality>]")
+            return None
+        if width not in self.RESIZE_WIDTHS or quality not in self.RESIZE_QUALITIES:
+            self.send_error(400, f"Allowed widths: {', '.join(map(str, self.RESIZE_WIDTHS))}; "
+                                 f"qualities: {', '.join(map(str, self.RESIZE_QUALITIES))}")
+            return None
+        extension = os.path.splitext(filepath)[1].lower()
+        image_format = DERIVED_FORMATS.get(extension)
+        mime_type = mimetypes.guess_type(filepath)[0] or 'image/jpeg'
+        if Image is None or image_format is None:
+            return filepath, mime_type
+        if extension in self.MODERN_SOURCE_EXTENSIONS:
+            accepted = self.accepted_modern_formats()
+            if accepted:
+                extension = accepted[0]
+                image_format, mime_type, _ = MODERN_FORMATS[extension]
+        
+        def render(source, target):
+            # Уменьшение в процессе пула обработки (не держит GIL потоков
+            # сервера) без очереди за фоновыми задачами
+            if self.processing is not None:
+                self.processing.call(render_derivative, source, target,
+                                     width, quality, image_format)
+            else:
+                render_derivative(source, target, width, quality, image_format)
+        
+        return self.derivative_cache.get(filepath, width, quality, extension, render), mime_type
+    
+    def accepted_modern_formats(self):
+        """Современные форматы, которые клиент явно принимает, по предпочтению"""
+        accepted = set()
+        for item in self.headers.get('Accept', '').split(','):
+            media_type, _, params = item.partition(';')
+            quality = 1.0
+            for param in params.split(';'):
+                key, _, value = param.strip().partition('=')
+                if key == 'q':
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            if quality > 0:
+                accepted.add(media_type.strip().lower())
+        return [extension for extension in self.modern_formats
+                if MODERN_FORMATS[extension][1] in accepted]
+    
+    def choose_photo_variant(self, filepath, mime_type):
+        """Самая маленькая копия фото в формате, который принимает клиент
+        
+        Копии может не быть (еще не готова или оказалась больше оригинала),
+        копия старше оригинала не отдается - в этих случаях отдается оригинал.
+        """
+        if not filepath.lower().endswith(self.MODERN_SOURCE_EXTENSIONS):
+            return filepath, mime_type
+        best = None
+        source_mtime = None
+        for extension in self.accepted_modern_formats():
+            variant = os.path.join(self.FORMATS_DIR, os.path.basename(filepath) + extension)
+            try:
+                stat = os.stat(variant)
+                if source_mtime is None:
+                    source_mtime = os.stat(filepath).st_mtime_ns
+            except OSError:
+                continue
+            if stat.st_mtime_ns >= source_mtime and (best is None or stat.st_size < best[0]):
+                best = (stat.st_size, variant, MODERN_FORMATS[extension][1])
+        if best is None:
+            return filepath, mime_type
+        return best[1], best[2]
+    
+    def send_json_response(self, data, status=200, validators=None):
         """Утилита для отправки JSON ответов"""
+        self.send_body(json.dumps(data).encode('utf-8'), 'application/json', status,
+                       validators)
+    
+    def send_html_response(self, html_content, status=200, validators=None):
+        """Утилита для отправки HTML страниц"""
+        self.send_body(html_content.encode('utf-8'), 'text/html; charset=utf-8', status,
+                       validators)
+    
+    def send_file(self, filepath, mime_type, cache_control=None, use_cache=False):
+        """Отдача файла; с use_cache небольшие файлы берутся из photo_cache
+        
+        Текстовые файлы (CSS, JS и т.п.) при поддержке клиентом отдаются
+        сжатыми, сжатый вариант кэшируется по ETag файла.
+        """
+        if is_compressible(mime_type) and not self.headers.get('Range'):
+            stat = os.stat(filepath)
+            encoding = None
+            if stat.st_size <= self.MAX_COMPRESS_FILE_SIZE:
+                encoding = self.choose_encoding(mime_type, stat.st_size)
+            if encoding:
+                self.send_compressed_file(filepath, stat, mime_type, encoding, cache_control)
+                return
+        cache = self.photo_cache if use_cache else None
+        if cache is not None:
+            stat = os.stat(filepath)
+            # Файлы, которые кэш не примет, не считаются его промахами
+            if not cache.accepts(stat.st_size):
+                cache = None
+        if cache is not None:
+            data = cache.get(filepath, stat)
+            if data is not None:
+                self.send_file_content(data, stat, mime_type, cache_control)
+                return
+        with open(filepath, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            if cache is not None and cache.accepts(stat.st_size):
+                data = f.read()
+                if len(data) == stat.st_size:
+                    cache.put(filepath, stat, data)
+                    self.send_file_content(data, stat, mime_type, cache_control)
+                    return
+            self.send_file_content(f, stat, mime_type, cache_control)
+    
+    def send_compressed_file(self, filepath, stat, mime_type, encoding, cache_control=None):
+        """Отдача сжатого варианта текстового файла"""
+        etag = self.variant_etag('"%x-%x"' % (stat.st_mtime_ns, stat.st_size), encoding)
+        validators = (etag, stat.st_mtime)
+        if self.check_not_modified(validators, cache_control, compressible=True):
+            return
+        body = self.compression_cache.get((etag, encoding))
+        if body is None:
+            with open(filepath, 'rb') as f:
+                body = compress_body(f.read(), encoding, best=True)
+            self.compression_cache.put((etag, encoding), body)
+        self.send_response(200)
+        self.send_header('Content-type', mime_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Content-Encoding', encoding)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_validator_headers(validators, cache_control)
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def choose_encoding(self, content_type, size):
+        """Выбор кодировки сжатия по Accept-Encoding (brotli предпочтительнее gzip)"""
+        if not self.compress_responses or size < MIN_COMPRESS_SIZE \
+                or not is_compressible(content_type):
+            return None
+        accepted = {}
+        for item in (self.headers.get('Accept-Encoding') or '').split(','):
+            name, _, params = item.partition(';')
+            quality = 1.0
+            for param in params.split(';'):
+                key, _, value = param.strip().partition('=')
+                if key == 'q':
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            accepted[name.strip().lower()] = quality
+        for encoding in (('br', 'gzip') if brotli is not None else ('gzip',)):
+            if accepted.get(encoding, accepted.get('*', 0)) > 0:
+                return encoding
+        return None
+    
+    @staticmethod
+    def variant_etag(etag, encoding):
+        """ETag сжатого варианта: у разных представлений должны быть разные ETag"""
+        return f'{etag[:-1]}-{encoding}"' if encoding else etag
+    
+    def send_file_content(self, source, stat, mime_type, cache_control=None):
+        """Ответ с содержимым файла: валидаторы кэша и поддержка Range
+        
+        source - открытый файл или его содержимое в памяти. ETag строится
+        по размеру и времени изменения. Запрос с Range получает 206 с одним
+        диапазоном или multipart/byteranges с несколькими.
+        """
+        size = stat.st_size
+        validators = ('"%x-%x"' % (stat.st_mtime_ns, size), stat.st_mtime)
+        if self.check_not_modified(validators, cache_control,
+                                   compressible=is_compressible(mime_type)):
+            return
+        
+        ranges = None
+        if self.headers.get('Range') and self.if_range_matches(validators):
+            ranges = self.parse_byte_ranges(self.headers['Range'], size)
+        if ranges == []:
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{size}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        
+        if not ranges:
+            self.send_response(200)
+            self.send_header('Content-type', mime_type)
+            self.send_header('Content-Length', str(size))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_validator_headers(validators, cache_control)
+            self.end_headers()
+            self.send_file_body(source, 0, size)
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            self.send_response(206)
+            self.send_header('Content-type', mime_type)
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_validator_headers(validators, cache_control)
+            self.end_headers()
+            self.send_file_body(source, start, end - start + 1)
+        else:
+            self.send_multipart_ranges(source, ranges, size, mime_type, validators,
+                                       cache_control)
+    
+    def send_multipart_ranges(self, source, ranges, size, mime_type, validators,
+                              cache_control=None):
+        """Ответ multipart/byteranges на запрос нескольких диапазонов"""
+        boundary = base64.b32encode(os.urandom(10)).decode().lower()
+        part_headers = [
+            (f'--{boundary}\r\nContent-Type: {mime_type}\r\n'
+             f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n').encode('latin-1')
+            for start, end in ranges
+        ]
+        closing = f'--{boundary}--\r\n'.encode('latin-1')
+        length = sum(len(head) + end - start + 1 + 2
+                     for head, (start, end) in zip(part_headers, ranges)) + len(closing)
+        
+        self.send_response(206)
+        self.send_header('Content-type', f'multipart/byteranges; boundary={boundary}')
+        self.send_header('Content-Length', str(length))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_validator_headers(validators, cache_control)
+        self.end_headers()
+        for head, (start, end) in zip(part_headers, ranges):
+            self.wfile.write(head)
+            self.send_file_body(source, start, end - start + 1)
+            self.wfile.write(b'\r\n')
+        self.wfile.write(closing)
+    
+    def if_range_matches(self, validators):
+        """Проверка If-Range: диапазон применяется только к той же версии файла"""
+        if_range = self.headers.get('If-Range')
+        if not if_range:
+            return True
+        etag, last_modified = validators
+        if_range = if_range.strip()
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            # Для Range годится только сильное сравнение ETag
+            return if_range == etag
+        try:
+            since = email.utils.parsedate_to_datetime(if_range)
+            return int(last_modified) == int(since.timestamp())
+        except (TypeError, ValueError, OverflowError):
+            return False
+    
+    def parse_byte_ranges(self, header, size):
+        """Разбор заголовка Range
+        
+        Возвращает список диапазонов (начало, конец) включительно, пустой
+        список для невыполнимого запроса или None, если заголовок нужно
+        проигнорировать и отдать файл целиком.
+        """
+        unit, _, spec = header.partition('=')
+        if unit.strip().lower() != 'bytes' or not spec:
+            return None
+        ranges = []
+        for item in spec.split(','):
+            first, dash, last = item.strip().partition('-')
+            if not dash:
+                return None
+            try:
+                if first:
+                    start = int(first)
+                    end = int(last) if last else max(start, size - 1)
+                    if end < start:
+                        return None
+                else:
+                    suffix = int(last)
+                    if suffix <= 0:
+                        continue
+                    start, end = max(0, size - suffix), size - 1
+            except ValueError:
+                return None
+            if start < size:
+                ranges.append((start, min(end, size - 1)))
+        if len(ranges) > self.MAX_RANGES:
+            return None
+        # Пересекающиеся и соседние диапазоны склеиваем
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+    
+    def page_validators(self, page, depends_on_photos=True):
+        """Валидаторы кэша для страницы или API
+        
+        Страница меняется только вместе с кодом сайта, годом в подвале и
+        (если она показывает фото) набором фотографий, поэтому ETag
+        вычисляется без рендеринга.
+        """
+        parts = [page, SITE_VERSION, str(datetime.now().year)]
+        last_modified = SITE_MTIME
+        if depends_on_photos:
+            photos_version = self.get_photos_version()
+            parts.append(str(photos_version))
+            last_modified = max(last_modified, photos_version / 1e9)
+        etag = '"%s"' % hashlib.sha1(':'.join(parts).encode()).hexdigest()[:20]
+        return etag, last_modified
+    
+    def get_photos_version(self):
+        """Версия набора фото (одна на запрос)
+        
+        Время изменения папки меняется при добавлении и удалении файлов;
+        учитываем и папку миниатюр, от которой зависит srcset в галерее,
+        и завершение фоновой обработки.
+        """
+        return self.memoized('photos_version', self._compute_photos_version)
+    
+    def _compute_photos_version(self):
+        version = 0
+        for directory in (self.PHOTOS_DIR, self.THUMBS_DIR):
+            try:
+                version = max(version, os.stat(directory).st_mtime_ns)
+            except OSError:
+                pass
+        # Заглушки плиток берутся из результатов фоновой обработки
+        if self.processing is not None:
+            version = max(version, int(self.processing.store.last_update() * 1e9))
+        # Файл, скопированный в обход сайта, попадает в список чуть позже,
+        # чем меняется время изменения папки; время изменения индекса одно
+        # для всех процессов сервера
+        if self.photo_index is not None:
+            version = max(version, self.photo_index.changed())
+        return version
+    
+    def check_not_modified(self, validators, cache_control=None, compressible=True):
+        """Ответ 304, если у клиента актуальная копия
+        
+        If-None-Match важнее If-Modified-Since. Сжатые варианты той же
+        версии тоже считаются актуальными, в ответе возвращается ETag
+        варианта клиента. Возвращает True, если ответ уже отправлен.
+        """
+        etag, last_modified = validators
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            current = {etag}
+            if compressible:
+                current.update(self.variant_etag(etag, encoding) for encoding in ('gzip', 'br'))
+            tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+            matched = [tag for tag in tags if tag in current]
+            fresh = '*' in tags or bool(matched)
+            if matched:
+                validators = (matched[0], last_modified)
+        else:
+            fresh = False
+            if_modified_since = self.headers.get('If-Modified-Since')
+            if if_modified_since:
+                try:
+                    since = email.utils.parsedate_to_datetime(if_modified_since)
+                    fresh = int(last_modified) <= since.timestamp()
+                except (TypeError, ValueError, OverflowError):
+                    fresh = False
+        if not fresh:
+            return False
+        self.send_response(304)
+        self.send_validator_headers(validators, cache_control)
+        if compressible and self.compress_responses:
+            self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+        return True
+    
+    def send_validator_headers(self, validators, cache_control=None):
+        """Заголовки ETag, Last-Modified и Cache-Control"""
+        etag, last_modified = validators
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(last_modified))
+        # Без явного срока браузер перепроверяет копию при каждом запросе
+        self.send_header('Cache-Control', cache_control or 'no-cache')
+        # Содержимое выбрано по заголовку запроса (например, формат по Accept)
+        if getattr(self, 'vary', None):
+            self.send_header('Vary', self.vary)
+    
+    def send_file_body(self, source, offset, count):
+        """Отправка части файла без чтения его в память
+        
+        На настоящем сокете данные копирует ядро (sendfile), в остальных
+        случаях (например, в движке asyncio) файл копируется блоками.
+        Содержимое из кэша (bytes) отправляется без копирования.
+        """
+        try:
+            if isinstance(source, bytes):
+                self.wfile.write(memoryview(source)[offset:offset + count])
+                sent = count
+            elif self.use_sendfile and isinstance(self.connection, socket.socket):
+                self.wfile.flush()
+                sent = self.connection.sendfile(source, offset, count)
+            elif isinstance(self.wfile, AsyncResponse):
+                # Файл отправит цикл событий AsyncHTTPServer
+                self.wfile.write_file(source, offset, count)
+                sent = count
+            else:
+                source.seek(offset)
+                sent = 0
+                while sent < count:
+                    chunk = source.read(min(self.COPY_CHUNK_SIZE, count - sent))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    sent += len(chunk)
+        except (ConnectionError, socket.timeout):
+            sent = -1
+        if sent != count:
+            # Клиент отключился или файл укоротился - длина ответа уже неверна
+            self.close_connection = True
+    
+    def send_body(self, body, content_type, status=200, validators=None):
+        """Отправка ответа с известной длиной тела
+        
+        Тело сжимается, если клиент это поддерживает. Ответы с ETag
+        сжимаются один раз: сжатый вариант берется из compression_cache.
+        """
+        encoding = self.choose_encoding(content_type, len(body))
+        if encoding:
+            if validators:
+                etag = self.variant_etag(validators[0], encoding)
+                validators = (etag, validators[1])
+                compressed = self.compression_cache.get((etag, encoding))
+                if compressed is None:
+                    compressed = compress_body(body, encoding, best=True)
+                    self.compression_cache.put((etag, encoding), compressed)
+                body = compressed
+            else:
+                body = compress_body(body, encoding)
         self.send_response(status)
-        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        if self.compress_responses and is_compressible(content_type):
+            self.send_header('Vary', 'Accept-Encoding')
+        if validators:
+            self.send_validator_headers(validators)
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode('utf-8'))
+        self.wfile.write(body)
     
     def send_api_time(self):
         """API для получения времени"""
@@ -707,55 +3643,387 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
         self.send_json_response(response)
     
     def send_api_photos(self):
-        """API для получения списка фото"""
-        photos = self.get_photos_list()
-        response = {'photos': photos}
+        """API для получения списка фото постранично
+        
+        Параметры: limit - размер страницы, cursor - next_cursor предыдущей
+        страницы, html=1 - добавить готовые плитки галереи (для прокрутки).
+        Курсор указывает на место в порядке (время, имя), поэтому страницы
+        не сдвигаются, когда добавляют или удаляют фото.
+        """
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        try:
+            limit = int(query.get('limit', [self.API_PAGE_SIZE])[0])
+            after = self.decode_cursor(query['cursor'][0]) if 'cursor' in query else None
+        except ValueError:
+            limit = 0
+        if not 0 < limit <= self.MAX_PAGE_SIZE:
+            self.send_json_response(
+                {'error': f'Expected limit=1..{self.MAX_PAGE_SIZE} and a cursor from '
+                          f'next_cursor'}, 400)
+            return
+        validators = self.page_validators('api-photos?' + urllib.parse.urlsplit(self.path).query)
+        if self.check_not_modified(validators):
+            return
+        photos, next_cursor = self.get_photos_page(limit, after)
+        response = {'photos': photos, 'next_cursor': next_cursor}
+        if query.get('html') == ['1']:
+            response['html'] = self.generate_photos_html(photos, "gallery-grid",
+                                                         collapse_bursts=self.collapse_bursts)
+        self.send_json_response(response, validators=validators)
+    
+    def get_photos_page(self, limit, after=None):
+        """Страница фото и курсор следующей (None - страниц больше нет)
+        
+        Со сворачиванием серий страница не обрывается посреди серии:
+        иначе ее остаток начал бы следующую страницу со своей обложкой.
+        Поэтому такая страница бывает длиннее limit.
+        """
+        # Лишнее фото показывает, есть ли следующая страница
+        photos = self.get_photos_list(limit + 1, after)
+        if self.collapse_bursts:
+            while len(photos) > limit:
+                bursts = self.find_bursts(photos)
+                while limit < len(photos) and photos[limit]['name'] in bursts:
+                    limit += 1
+                if limit < len(photos):
+                    break
+                # Серия дошла до конца взятых фото: берем следующие
+                more = self.get_photos_list(self.GALLERY_PAGE_SIZE,
+                                            (photos[-1]['taken'], photos[-1]['name']))
+                if not more:
+                    break
+                photos = photos + more
+        if len(photos) <= limit:
+            return photos, None
+        return photos[:limit], self.encode_cursor(photos[limit - 1])
+    
+    @staticmethod
+    def encode_cursor(photo):
+        """Непрозрачный курсор страницы: ключ сортировки последнего фото"""
+        key = json.dumps([photo['taken'], photo['name']], ensure_ascii=False)
+        return base64.urlsafe_b64encode(key.encode()).decode('ascii').rstrip('=')
+    
+    @staticmethod
+    def decode_cursor(cursor):
+        """Ключ (taken, имя) из курсора, ValueError - если курсор испорчен"""
+        try:
+            taken, name = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        except (TypeError, ValueError):
+            raise ValueError(f"invalid cursor: {cursor}")
+        if not isinstance(taken, (int, float)) or not isinstance(name, str):
+            raise ValueError(f"invalid cursor: {cursor}")
+        return float(taken), name
+    
+    def send_api_cache_stats(self):
+        """API со счетчиками кэша фото (у каждого процесса свои)"""
+        if self.photo_cache is None:
+            response = {'enabled': False}
+        else:
+            response = {'enabled': True, 'pid': os.getpid(), **self.photo_cache.stats()}
+        response['derived_renders'] = self.derivative_cache.renders
         self.send_json_response(response)
     
-    def get_photos_list(self):
-        """Получение списка фото"""
+    def send_api_has_hash(self):
+        """API: есть ли уже фото с таким SHA-256 (чтобы не загружать его повторно)"""
+        digest = self.path[len('/api/has-hash/'):].lower()
+        if not re.fullmatch(r'[0-9a-f]{64}', digest):
+            self.send_json_response({'error': 'Expected SHA-256 in hex'}, 400)
+            return
+        photo = self.find_photo_by_hash(digest)
+        self.send_json_response({'exists': photo is not None, 'filename': photo})
+    
+    def send_api_duplicates(self):
+        """API похожих фото: группы похожих или похожие на одно фото (?photo=)
+        
+        Параметры: hash - phash или dhash, distance - порог расстояния Хэмминга.
+        """
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        kind = query.get('hash', ['phash'])[0]
         try:
-            if os.path.exists(self.PHOTOS_DIR):
-                photos = []
-                for filename in os.listdir(self.PHOTOS_DIR):
-                    filepath = os.path.join(self.PHOTOS_DIR, filename)
-                    if (os.path.isfile(filepath) and 
-                        filename.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp'))):
-                        photos.append({
-                            'name': filename,
-                            'url': f'/photos/{urllib.parse.quote(filename)}',
-                            'upload_time': os.path.getctime(filepath)
-                        })
-                # Сортируем по времени загрузки (новые сначала)
-                photos.sort(key=lambda x: x['upload_time'], reverse=True)
-                return photos
-            return []
+            distance = int(query.get('distance', [self.DUPLICATE_DISTANCE])[0])
+        except ValueError:
+            distance = -1
+        if kind not in PERCEPTUAL_HASHES or not 0 <= distance <= 32:
+            self.send_json_response({'error': 'Expected hash=phash|dhash and distance=0..32'},
+                                    400)
+            return
+        if self.photo_index is None:
+            self.send_json_response({'enabled': False})
+            return
+        index = self.get_hamming_index(kind)
+        if 'photo' in query:
+            photo = query['photo'][0]
+            if photo not in index.hashes:
+                self.send_json_response({'error': 'Photo is not hashed yet'}, 404)
+                return
+            similar = [{'photo': other, 'distance': other_distance}
+                       for other, other_distance in index.near(index.hashes[photo], distance)
+                       if other != photo]
+            self.send_json_response({'photo': photo, 'hash': kind, 'distance': distance,
+                                     'similar': similar})
+            return
+        clusters = self.get_duplicate_clusters(kind, distance)
+        self.send_json_response({
+            'hash': kind, 'distance': distance, 'hashed': len(index),
+            'clusters': [{'size': len(group), 'photos': group} for group in clusters]})
+    
+    def send_api_jobs(self):
+        """API состояния фоновой обработки: сводка или задачи одного фото"""
+        if self.processing is None:
+            self.send_json_response({'enabled': False})
+            return
+        path = urllib.parse.urlsplit(self.path).path
+        if path == '/api/jobs':
+            response = {'enabled': True, 'workers': self.processing.workers,
+                        'processors': list(self.processing.processors),
+                        **self.processing.store.summary()}
+            self.send_json_response(response)
+            return
+        photo = urllib.parse.unquote(path[len('/api/jobs/'):])
+        jobs = self.processing.store.status(photo)
+        if not jobs:
+            self.send_json_response({'error': 'No jobs for this photo'}, 404)
+            return
+        pending = any(job['status'] in ('pending', 'running') for job in jobs.values())
+        self.send_json_response({'photo': photo, 'done': not pending, 'jobs': jobs})
+    
+    def memoized(self, key, compute, *args):
+        """compute(*args), посчитанное не больше одного раза за запрос"""
+        if self.memo is None:
+            self.memo = {}
+        if key not in self.memo:
+            self.memo[key] = compute(*args)
+        return self.memo[key]
+    
+    def get_photos_list(self, limit=None, after=None):
+        """Получение списка фото (новые сначала, не больше limit)
+        
+        after - ключ (taken, имя) последнего фото предыдущей страницы.
+        Список берется из памяти (PhotoListing) или из индекса фото: он
+        пополняется при загрузке, чистится при удалении, сверяется с папкой
+        при запуске и следит за ней, поэтому папку на каждый запрос не читаем.
+        Повторный вызов с теми же параметрами в том же запросе берет
+        готовый список.
+        """
+        return self.memoized(('photos', limit, after), self._load_photos_list, limit, after)
+    
+    def _load_photos_list(self, limit, after):
+        try:
+            if self.photo_listing is not None:
+                return [self.photo_entry(*row)
+                        for row in self.photo_listing.latest(limit, after)]
+            if self.photo_index is not None:
+                return [self.photo_entry(*row)
+                        for row in self.photo_index.listing(limit, after)]
+            # Без индекса (обработчик запущен не через create_server) - по
+            # папке; первые limit выбираем кучей, не сортируя всю папку
+            keys = [key for key in self.scan_photos_dir() if after is None or key[:2] < after]
+            if limit is None:
+                keys.sort(reverse=True)
+            else:
+                keys = heapq.nlargest(limit, keys)
+            return [self.photo_entry(filename, upload_time, taken)
+                    for taken, filename, upload_time in keys]
         except Exception as e:
             print(f"Error getting photos list: {e}")
             return []
     
-    def generate_photos_html(self, photos, css_class):
-        """Генерация HTML для фотографий"""
+    def scan_photos_dir(self):
+        """Фото в папке: (taken, имя, время изменения); один обход за запрос"""
+        def scan():
+            if not os.path.exists(self.PHOTOS_DIR):
+                return []
+            keys = []
+            for filename in os.listdir(self.PHOTOS_DIR):
+                filepath = os.path.join(self.PHOTOS_DIR, filename)
+                if (not filename.lower().endswith(self.PHOTO_EXTENSIONS + self.VIDEO_EXTENSIONS)
+                        or not os.path.isfile(filepath)):
+                    continue
+                upload_time = os.path.getmtime(filepath)
+                keys.append((capture_time_from_name(filename) or upload_time, filename,
+                             upload_time))
+            return keys
+        return self.memoized('photos_scan', scan)
+    
+    def get_photo_count(self):
+        """Количество фото и видео в галерее"""
+        if self.photo_listing is not None:
+            return self.photo_listing.count()
+        if self.photo_index is not None:
+            return self.memoized('photo_count', self.photo_index.count)
+        return len(self.scan_photos_dir())
+    
+    def photo_entry(self, filename, upload_time, taken, width=None, height=None,
+                    orientation=None):
+        """Описание фото для списка и API"""
+        # Ориентации 5-8 поворачивают кадр на 90 градусов
+        if (orientation or 1) >= 5:
+            width, height = height, width
+        extension = os.path.splitext(filename)[1].lower()
+        return {
+            'name': filename,
+            'url': f'/photos/{urllib.parse.quote(filename)}',
+            'upload_time': upload_time,
+            'taken': taken,
+            'width': width,
+            'height': height,
+            'type': 'video' if extension in self.VIDEO_EXTENSIONS else 'photo'
+        }
+    
+    def generate_photos_html(self, photos, css_class, collapse_bursts=False):
+        """Генерация HTML для фотографий
+        
+        collapse_bursts - серии похожих кадров показываются одной плиткой
+        с кнопкой, раскрывающей остальные кадры.
+        """
         if not photos:
             return ""
         
+        names = [photo['name'] for photo in photos]
+        thumbnails = self.get_thumbnail_index(names)
+        placeholders = self.get_placeholders(names)
+        bursts = self.find_bursts(photos) if collapse_bursts else {}
+        burst_sizes = {}
+        for cover in bursts.values():
+            burst_sizes[cover] = burst_sizes.get(cover, 0) + 1
         photos_html = '<div class="' + css_class + '">'
         for photo in photos:
+            if photo.get('type') == 'video':
+                # Без постера: до загрузки метаданных виден легкий CSS-фон
+                photos_html += f"""
+            <div class="photo-item video-item">
+                <video src="{photo['url']}" 
+                       class="gallery-video"
+                       data-name="{photo['name']}"
+                       preload="metadata"
+                       controls
+                       playsinline></video>
+                <div class="photo-overlay">
+                    <span class="photo-date">{datetime.fromtimestamp(photo['taken']).strftime('%d.%m.%Y %H:%M')}</span>
+                </div>
+            </div>
+            """
+                continue
+            # Плитке хватает миниатюры, оригинал загружает только модальное окно.
+            # Время загрузки в URL не даёт браузеру показать миниатюру
+            # удалённого фото, если потом загрузят другое с тем же именем
+            srcset = ''
+            widths = thumbnails.get(photo['name'])
+            if widths:
+                version = int(photo['upload_time'])
+                candidates = ', '.join(
+                    f"/thumbs/{urllib.parse.quote(thumbnail_name(photo['name'], width))}"
+                    f"?v={version} {width}w"
+                    for width in widths)
+                srcset = f'srcset="{candidates}" sizes="{self.THUMBNAIL_SIZES}"'
+            # Размытая заглушка видна фоном, пока фото не загрузилось
+            placeholder = ''
+            if photo['name'] in placeholders:
+                placeholder = (f'style="background: center / cover '
+                               f'url({placeholders[photo["name"]]})"')
+            # Размеры из индекса: плитка сразу получает пропорции фото, и
+            # место под него известно до загрузки (без размеров плитка квадратная)
+            dimensions = tile_style = ''
+            if photo.get('width') and photo.get('height'):
+                dimensions = f'width="{photo["width"]}" height="{photo["height"]}"'
+                tile_style = f'style="aspect-ratio: {photo["width"]} / {photo["height"]}"'
+            # Кадры свернутой серии скрыты до нажатия на кнопку обложки
+            burst = toggle = ''
+            if photo['name'] in bursts:
+                burst = f'hidden data-burst-of="{html.escape(bursts[photo["name"]])}"'
+            elif photo['name'] in burst_sizes:
+                toggle = (f'<button class="burst-toggle" data-burst="{html.escape(photo["name"])}"'
+                          f'>📚 +{burst_sizes[photo["name"]]}</button>')
             photos_html += f"""
-            <div class="photo-item">
+            <div class="photo-item" {tile_style} {burst}>
+                {toggle}
                 <img src="{photo['url']}" 
+                     {srcset}
+                     {dimensions}
+                     {placeholder}
                      alt="Наше фото" 
                      class="gallery-photo"
                      data-name="{photo['name']}"
                      loading="lazy">
                 <div class="photo-overlay">
-                    <span class="photo-date">{datetime.fromtimestamp(photo['upload_time']).strftime('%d.%m.%Y %H:%M')}</span>
+                    <span class="photo-date">{datetime.fromtimestamp(photo['taken']).strftime('%d.%m.%Y %H:%M')}</span>
                 </div>
             </div>
             """
         photos_html += '</div>'
         return photos_html
     
+    def get_hamming_index(self, kind='phash'):
+        """Индекс перцептивных хэшей
+        
+        Пересобирается, только когда меняется таблица перцептивных хэшей
+        (в любом процессе сервера), а не при каждой фоновой задаче.
+        """
+        return self._cached_hamming_index(kind)[1]
+    
+    def get_duplicate_clusters(self, kind, distance):
+        """Кластеры похожих фото, большие сначала; кэшируются вместе с индексом"""
+        _, index, clusters = self._cached_hamming_index(kind)
+        found = clusters.get(distance)
+        if found is None:
+            # Считается без блокировки: запросы near не ждут кластеров
+            found = sorted(index.clusters(distance), key=len, reverse=True)
+            with self.hamming_lock:
+                found = clusters.setdefault(distance, found)
+        return found
+    
+    def _cached_hamming_index(self, kind):
+        changed = self.photo_index.changed('perceptual_hashes')
+        with self.hamming_lock:
+            cached = self.hamming_indexes.get(kind)
+            if cached is None or cached[0] != changed:
+                cached = (changed, HammingIndex(self.photo_index.perceptual_hashes(kind)), {})
+                self.hamming_indexes[kind] = cached
+            return cached
+    
+    def find_bursts(self, photos):
+        """Серии снимков в списке фото: имя кадра -> имя первого кадра серии
+        
+        Серия - идущие подряд фото, снятые с промежутком не больше
+        BURST_INTERVAL и похожие (pHash) на ее первый кадр.
+        """
+        if self.photo_index is None:
+            return {}
+        hashes = self.get_hamming_index().hashes
+        bursts = {}
+        cover = previous = None
+        for photo in photos:
+            value = hashes.get(photo['name'])
+            if (cover is not None and value is not None
+                    and abs(previous['taken'] - photo['taken']) <= self.BURST_INTERVAL
+                    and popcount(value ^ hashes[cover['name']]) <= self.DUPLICATE_DISTANCE):
+                bursts[photo['name']] = cover['name']
+            else:
+                cover = photo if value is not None else None
+            previous = photo
+        return bursts
+    
+    def get_placeholders(self, names):
+        """Заглушки плиток, посчитанные при загрузке: имя фото -> data URI"""
+        if self.processing is None or 'placeholder' not in self.processing.processors:
+            return {}
+        return {photo: result['placeholder']
+                for photo, result in self.processing.store.results('placeholder', names).items()}
+    
+    def get_thumbnail_index(self, names):
+        """Доступные миниатюры фото names: имя фото -> список ширин
+        
+        Проверяются только показываемые фото, поэтому цена не зависит от
+        размера галереи.
+        """
+        index = {}
+        for name in names:
+            widths = [width for width in self.THUMBNAIL_WIDTHS
+                      if os.path.exists(os.path.join(self.THUMBS_DIR, thumbnail_name(name, width)))]
+            if widths:
+                index[name] = widths
+        return index
+    
     def get_navigation(self):
         """Навигационное меню"""
         return """
@@ -785,7 +4053,41 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
         </footer>
         """
     
-    def get_css_styles(self):
+    @classmethod
+    def build_static_assets(cls):
+        """Сборка общих CSS и JS в static/ под именами с хэшем содержимого
+        
+        Вызывается один раз при запуске. Имя файла меняется вместе с
+        содержимым, поэтому браузер может кэшировать его навсегда.
+        """
+        os.makedirs(cls.STATIC_DIR, exist_ok=True)
+        assets = {}
+        for kind, content in (('css', cls.get_css_styles()), ('js', cls.get_javascript())):
+            data = content.encode('utf-8')
+            filename = f"site.{hashlib.sha256(data).hexdigest()[:12]}.{kind}"
+            filepath = os.path.join(cls.STATIC_DIR, filename)
+            if not os.path.exists(filepath):
+                tmp_path = f"{filepath}.{os.getpid()}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, filepath)
+            assets[kind] = f'/static/{filename}'
+        cls.static_assets = assets
+    
+    def get_stylesheet_tag(self):
+        """Подключение общих стилей (встраиваются, если файлы не собраны)"""
+        if 'css' in self.static_assets:
+            return f'<link rel="stylesheet" href="{self.static_assets["css"]}">'
+        return f'<style>{self.get_css_styles()}</style>'
+    
+    def get_script_tag(self):
+        """Подключение общего JavaScript (встраивается, если файлы не собраны)"""
+        if 'js' in self.static_assets:
+            return f'<script src="{self.static_assets["js"]}"></script>'
+        return f'<script>{self.get_javascript()}</script>'
+    
+    @staticmethod
+    def get_css_styles():
         """CSS стили"""
         return """
         * {
@@ -995,6 +4297,7 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
         .latest-photos, .gallery-grid {
             display: grid;
             grid-template-columns: repeat(auto-fill, minmax(280px, 1fr));
+            align-items: start;
             gap: 1.5rem;
             margin: 2rem 0;
         }
@@ -1026,6 +4329,33 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
             transform: scale(1.1);
         }
         
+        /* Видео: фон вместо постера, пока не загружены метаданные */
+        .video-item {
+            background: linear-gradient(135deg, #f8bbd0, #ce93d8);
+        }
+        
+        .video-item::before {
+            content: '▶';
+            position: absolute;
+            top: 50%;
+            left: 50%;
+            transform: translate(-50%, -50%);
+            font-size: 3rem;
+            color: rgba(255, 255, 255, 0.8);
+        }
+        
+        .gallery-video {
+            position: relative;
+            width: 100%;
+            height: 100%;
+            object-fit: cover;
+            display: block;
+        }
+        
+        .video-item .photo-overlay {
+            pointer-events: none;
+        }
+        
         .photo-overlay {
             position: absolute;
             bottom: 0;
@@ -1047,6 +4377,26 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
             opacity: 0.9;
         }
         
+        /* Метка конца загруженной части галереи для бесконечной прокрутки */
+        .gallery-sentinel {
+            height: 1px;
+        }
+        
+        /* Свернутая серия снимков: кнопка раскрывает остальные кадры */
+        .burst-toggle {
+            position: absolute;
+            top: 10px;
+            right: 10px;
+            z-index: 1;
+            border: none;
+            border-radius: 12px;
+            padding: 0.3rem 0.7rem;
+            background: rgba(0,0,0,0.6);
+            color: white;
+            font-size: 0.85rem;
+            cursor: pointer;
+        }
+        
         /* Пустая галерея */
         .empty-gallery {
             text-align: center;
@@ -1104,7 +4454,7 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
             box-shadow: 0 5px 15px rgba(0,0,0,0.1);
         }
         
-        .photo-preview img {
+        .photo-preview img, .photo-preview video {
             width: 100%;
             height: 150px;
             object-fit: cover;
@@ -1399,7 +4749,8 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
         }
         """
     
-    def get_javascript(self):
+    @staticmethod
+    def get_javascript():
         """JavaScript код"""
         return """
         function showNotification(message, type = 'success') {
@@ -1479,15 +4830,740 @@ class WebsiteHandler(SimpleHTTPRequestHandler):
         """Переопределяем метод логирования для тишины"""
         pass
 
-def main():
+class IdleConnections:
+    """Простаивающие keep-alive соединения в одном потоке с селектором
+
+    Соединение ждет следующего запроса здесь, а не в рабочем потоке.
+    Когда клиент что-то прислал, вызывается on_ready(соединение, адрес,
+    число обслуженных запросов), а по истечении timeout - on_expired.
+    """
+
+    def __init__(self, on_ready, on_expired):
+        self.on_ready = on_ready
+        self.on_expired = on_expired
+        self._selector = selectors.DefaultSelector()
+        # Новые соединения добавляет поток селектора, его будит запись в пару сокетов
+        self._wakeup, self._wakeup_writer = socket.socketpair()
+        self._wakeup.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+        self._selector.register(self._wakeup, selectors.EVENT_READ)
+        self._lock = threading.Lock()
+        self._added = []
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='http-idle', daemon=True)
+        self._thread.start()
+
+    def add(self, request, client_address, timeout, handled):
+        """Соединение ждет следующего запроса не дольше timeout секунд"""
+        with self._lock:
+            self._added.append((request, client_address, time.monotonic() + timeout, handled))
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wakeup_writer.send(b'\0')
+        except OSError:
+            pass  # буфер полон - поток и так проснется
+
+    def _run(self):
+        waiting = {}  # соединение -> (адрес, срок, обслужено запросов)
+        while True:
+            with self._lock:
+                added, self._added = self._added, []
+                stopping = self._stopping
+            if stopping:
+                for request in waiting:
+                    self.on_expired(request)
+                for request, *_ in added:
+                    self.on_expired(request)
+                return
+            for request, client_address, deadline, handled in added:
+                try:
+                    self._selector.register(request, selectors.EVENT_READ)
+                except (OSError, ValueError):
+                    self.on_expired(request)
+                    continue
+                waiting[request] = (client_address, deadline, handled)
+            timeout = None
+            if waiting:
+                timeout = max(0, min(deadline for _, deadline, _ in waiting.values())
+                              - time.monotonic())
+            for key, _ in self._selector.select(timeout):
+                if key.fileobj is self._wakeup:
+                    try:
+                        while self._wakeup.recv(4096):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                client_address, _, handled = waiting.pop(key.fileobj)
+                self._selector.unregister(key.fileobj)
+                self.on_ready(key.fileobj, client_address, handled)
+            now = time.monotonic()
+            for request in [request for request, (_, deadline, _) in waiting.items()
+                            if deadline <= now]:
+                del waiting[request]
+                self._selector.unregister(request)
+                self.on_expired(request)
+
+    def close(self):
+        """Остановка потока; простаивающие соединения закрываются"""
+        with self._lock:
+            self._stopping = True
+        self._wake()
+        self._thread.join(timeout=1)
+        self._selector.close()
+        self._wakeup.close()
+        self._wakeup_writer.close()
+
+
+class PooledHTTPServer(HTTPServer):
+    """HTTP-сервер с ограниченным пулом рабочих потоков
+
+    Принятые соединения складываются в очередь фиксированной длины и
+    обрабатываются заранее запущенными потоками. Если очередь заполнена,
+    клиент сразу получает 503, а не ждет, пока освободится сервер.
+    Keep-alive соединение между запросами ждет в IdleConnections и не
+    занимает рабочий поток, поэтому простаивающие браузеры не мешают
+    остальным посетителям.
+    """
+
+    # Обработчик отдает простаивающее соединение серверу (handler.idle)
+    parks_idle_connections = True
+
+    BUSY_RESPONSE = (b"HTTP/1.0 503 Service Unavailable\r\n"
+                     b"Retry-After: 1\r\n"
+                     b"Content-Length: 0\r\n"
+                     b"Connection: close\r\n\r\n")
+
+    def __init__(self, server_address, handler_class,
+                 workers=DEFAULT_WORKERS, queue_size=DEFAULT_QUEUE_SIZE,
+                 bind_and_activate=True):
+        super().__init__(server_address, handler_class, bind_and_activate)
+        self._requests = queue.Queue(maxsize=queue_size)
+        # Соединение, вернувшееся из простоя -> сколько запросов оно уже обслужило
+        self._resumed = {}
+        self._idle = IdleConnections(self._resume_request, self.shutdown_request)
+        self._workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self._worker_loop,
+                                      name=f"http-worker-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def process_request(self, request, client_address):
+        """Передаем соединение в пул вместо обработки в главном потоке"""
+        try:
+            self._requests.put_nowait((request, client_address))
+        except queue.Full:
+            self._reject_request(request)
+
+    def _resume_request(self, request, client_address, handled):
+        """Клиент простаивающего соединения прислал следующий запрос"""
+        self._resumed[request] = handled
+        try:
+            self._requests.put_nowait((request, client_address))
+        except queue.Full:
+            self._resumed.pop(request, None)
+            self._reject_request(request)
+
+    def resume_count(self, request):
+        """Сколько запросов соединение обслужило до простоя (0 - новое)"""
+        return self._resumed.pop(request, 0)
+
+    def finish_request(self, request, client_address):
+        """Обработка соединения, возвращает обработчик"""
+        return self.RequestHandlerClass(request, client_address, self)
+
+    def _reject_request(self, request):
+        """Ответ 503 при переполненной очереди"""
+        try:
+            request.settimeout(1)
+            request.sendall(self.BUSY_RESPONSE)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def _worker_loop(self):
+        """Цикл рабочего потока"""
+        while True:
+            item = self._requests.get()
+            if item is None:
+                break
+            request, client_address = item
+            handler = None
+            try:
+                handler = self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                if getattr(handler, 'idle', False):
+                    self._idle.add(request, client_address, handler.keepalive_timeout,
+                                   handler.requests_handled)
+                else:
+                    self.shutdown_request(request)
+
+    def server_close(self):
+        """Останавливаем рабочие потоки вместе с сервером"""
+        super().server_close()
+        self._idle.close()
+        for _ in self._workers:
+            self._requests.put(None)
+        for worker in self._workers:
+            worker.join(timeout=1)
+
+
+class AsyncResponse:
+    """Ответ WebsiteHandler для AsyncHTTPServer (подставляется вместо wfile)
+
+    Заголовки и сформированные тела копятся в памяти, а содержимое файлов
+    не читается: запоминается копия дескриптора и диапазон, и данные
+    отправляет цикл событий. Части - bytes-объекты или кортежи
+    (файл, смещение, длина).
+    """
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def write_file(self, source, offset, count):
+        """Часть файла; исходный файл обработчик закроет сам, поэтому
+        сохраняется копия дескриптора"""
+        copy = os.fdopen(os.dup(source.fileno()), 'rb')
+        self.parts.append((copy, offset, count))
+
+    def close(self):
+        """Закрытие неотправленных файлов"""
+        for part in self.parts:
+            if isinstance(part, tuple):
+                part[0].close()
+        self.parts = []
+
+
+class AsyncHTTPServer:
+    """Сервер на asyncio, выполняющий маршруты WebsiteHandler
+
+    Соединения обслуживаются корутинами, поэтому простаивающий клиент
+    стоит лишь буфера чтения. Полностью прочитанный запрос передается
+    обычному WebsiteHandler в пуле потоков (там же происходит работа с
+    файлами), а ответ отправляется обратно из цикла событий: файлы -
+    через loop.sendfile, без чтения в память (см. AsyncResponse).
+    Ответы побайтно совпадают с ответами HTTPServer.
+    """
+
+    MAX_HEADER_SIZE = 64 * 1024
+
+    def __init__(self, server_address, handler_class,
+                 workers=DEFAULT_WORKERS, timeout=DEFAULT_TIMEOUT,
+                 backlog=DEFAULT_BACKLOG, sock=None):
+        self.server_address = server_address
+        self.RequestHandlerClass = handler_class
+        self.timeout = timeout or None
+        self.backlog = backlog
+        self.socket = sock
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='http-io')
+
+    def serve_forever(self):
+        """Запуск цикла событий до остановки процесса"""
+        try:
+            asyncio.run(self._serve())
+        finally:
+            self.executor.shutdown(wait=False)
+
+    async def _serve(self):
+        if self.socket is not None:
+            server = await asyncio.start_server(self._handle_connection, sock=self.socket,
+                                                limit=self.MAX_HEADER_SIZE)
+        else:
+            host, port = self.server_address
+            server = await asyncio.start_server(self._handle_connection, host or None,
+                                                port, limit=self.MAX_HEADER_SIZE,
+                                                backlog=self.backlog)
+        async with server:
+            await server.serve_forever()
+
+    async def _handle_connection(self, reader, writer):
+        """Обработка одного соединения"""
+        loop = asyncio.get_running_loop()
+        client_address = writer.get_extra_info('peername')
+        handled = 0
+        try:
+            while True:
+                # Между запросами ждем не дольше keepalive_timeout
+                wait = self.timeout if not handled else self.RequestHandlerClass.keepalive_timeout
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), wait)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                        asyncio.TimeoutError, ConnectionError):
+                    break
+                headers = self._parse_headers(head)
+                if headers.get('expect', '').lower() == '100-continue':
+                    writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+                    head = self._strip_header(head, b'expect')
+                body = b''
+                length = self._content_length(headers)
+                if length:
+                    try:
+                        body = await asyncio.wait_for(reader.readexactly(length),
+                                                      self.timeout)
+                    except (asyncio.IncompleteReadError, asyncio.TimeoutError,
+                            ConnectionError):
+                        break
+                handled += 1
+                response, close = await loop.run_in_executor(
+                    self.executor, self._run_handler, head + body, client_address, handled)
+                if not await self._send_response(loop, writer, response):
+                    break
+                if close:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _parse_headers(head):
+        """Заголовки запроса в виде словаря с ключами в нижнем регистре"""
+        headers = {}
+        for line in head.split(b'\r\n')[1:]:
+            name, sep, value = line.partition(b':')
+            if sep:
+                headers[name.strip().lower().decode('latin-1')] = value.strip().decode('latin-1')
+        return headers
+
+    @staticmethod
+    def _strip_header(head, name):
+        """Удаление заголовка из сырого запроса"""
+        lines = head.split(b'\r\n')
+        kept = [line for line in lines[1:]
+                if line.partition(b':')[0].strip().lower() != name]
+        return b'\r\n'.join(lines[:1] + kept)
+
+    @staticmethod
+    def _content_length(headers):
+        """Длина тела запроса"""
+        try:
+            return max(0, int(headers.get('content-length', 0)))
+        except ValueError:
+            return 0
+
+    def _run_handler(self, raw_request, client_address, requests_handled=1):
+        """Выполнение WebsiteHandler над буферизованным запросом (в пуле потоков)"""
+        handler_class = self.RequestHandlerClass
+        handler = handler_class.__new__(handler_class)
+        handler.request = None
+        handler.connection = None
+        handler.client_address = client_address
+        handler.server = self
+        handler.directory = os.getcwd()
+        handler.rfile = io.BytesIO(raw_request)
+        handler.wfile = AsyncResponse()
+        handler.close_connection = True
+        handler.requests_handled = requests_handled
+        handler.headers = None
+        handler.body_consumed = False
+        handler.vary = None
+        handler.memo = {}
+        try:
+            handler.handle_one_request()
+        except Exception as e:
+            print(f"Async handler error: {e}")
+            handler.close_connection = True
+        return handler.wfile, handler.close_connection
+
+    @staticmethod
+    async def _send_response(loop, writer, response):
+        """Отправка частей AsyncResponse; False - ответ отправлен не целиком"""
+        try:
+            pending = []
+            for part in response.parts:
+                if not isinstance(part, tuple):
+                    pending.append(part)
+                    continue
+                if pending:
+                    writer.writelines(pending)
+                    pending = []
+                source, offset, count = part
+                if not count:
+                    continue
+                # sendfile сам дожидается отправки уже записанных данных
+                sent = await loop.sendfile(writer.transport, source, offset, count)
+                if sent != count:
+                    # Файл укоротился - длина ответа уже неверна
+                    return False
+            if pending:
+                writer.writelines(pending)
+            await writer.drain()
+            return True
+        except (ConnectionError, RuntimeError):
+            return False
+        finally:
+            response.close()
+
+
+class PreforkServer:
+    """Несколько процессов-обработчиков на одном порту
+
+    Родительский процесс открывает слушающий сокет, запускает обработчики
+    через fork и перезапускает упавшие. С reuse_port каждый обработчик
+    открывает собственный сокет с SO_REUSEPORT, и соединения между ними
+    распределяет ядро.
+
+    Обработчики не разделяют память: фотографии и сообщения хранятся
+    на диске, поэтому загрузка или удаление в одном процессе сразу видны
+    всем остальным.
+    """
+
+    # Пауза перед перезапуском обработчика, упавшего сразу после старта
+    RESTART_DELAY = 1
+
+    def __init__(self, server_address, args):
+        self.server_address = server_address
+        self.args = args
+        self.socket = None
+        self.children = {}
+        self.stopping = False
+
+    def serve_forever(self):
+        """Запуск обработчиков и наблюдение за ними"""
+        if not self.args.reuse_port:
+            self.socket = create_listening_socket(self.server_address, self.args.backlog)
+        previous_handler = signal.signal(signal.SIGTERM, self._handle_sigterm)
+        try:
+            for index in range(self.args.processes):
+                self._spawn(index)
+            while self.children:
+                pid, status = os.wait()
+                index, started = self.children.pop(pid, (None, 0))
+                if index is None or self.stopping:
+                    continue
+                print(f"⚠️  Обработчик {pid} завершился (код {os.waitstatus_to_exitcode(status)}), "
+                      f"перезапуск", flush=True)
+                self._requeue_jobs(pid)
+                if time.monotonic() - started < self.RESTART_DELAY:
+                    time.sleep(self.RESTART_DELAY)
+                self._spawn(index)
+        finally:
+            self.stopping = True
+            signal.signal(signal.SIGTERM, previous_handler)
+            self._stop_children()
+            if self.socket is not None:
+                self.socket.close()
+
+    def _handle_sigterm(self, signum, frame):
+        self.stopping = True
+        raise SystemExit(0)
+
+    def _requeue_jobs(self, pid):
+        """Задачи фоновой обработки упавшего обработчика - обратно в очередь;
+        их заберет resume нового обработчика"""
+        store = None
+        try:
+            store = JobStore(WebsiteHandler.DATABASE_PATH)
+            requeued = store.requeue_running(pid)
+        except sqlite3.Error as e:
+            print(f"⚠️  Не удалось вернуть задачи обработчика {pid} в очередь: {e}", flush=True)
+            return
+        finally:
+            # Соединение не должно перейти в процесс, запущенный через fork
+            if store is not None:
+                store.close()
+        if requeued:
+            print(f"🔁 Задач обработчика {pid} возвращено в очередь: {requeued}", flush=True)
+
+    def _spawn(self, index):
+        """Запуск одного обработчика"""
+        pid = os.fork()
+        if pid:
+            self.children[pid] = (index, time.monotonic())
+            return
+        exit_code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            sock = self.socket
+            if sock is None:
+                sock = create_listening_socket(self.server_address, self.args.backlog,
+                                               reuse_port=True)
+            create_server(self.server_address, self.args, sock=sock).serve_forever()
+        except KeyboardInterrupt:
+            pass
+        except BaseException as e:
+            print(f"❌ Ошибка обработчика {os.getpid()}: {e}", flush=True)
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    def _stop_children(self):
+        """Остановка всех обработчиков"""
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                self.children.pop(pid, None)
+        for pid in list(self.children):
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+            self.children.pop(pid, None)
+
+
+def create_listening_socket(server_address, backlog, reuse_port=False):
+    """Слушающий сокет с заданной длиной очереди соединений"""
+    return socket.create_server(server_address, backlog=backlog, reuse_port=reuse_port)
+
+
+def create_server(server_address, args, sock=None):
+    """Создание сервера в выбранном режиме
+
+    Если передан sock, сервер обслуживает уже открытый слушающий сокет.
+    """
+    WebsiteHandler.timeout = args.timeout or None
+    WebsiteHandler.keepalive_timeout = args.keepalive_timeout
+    WebsiteHandler.max_keepalive_requests = args.max_keepalive_requests
+    WebsiteHandler.compress_responses = not args.no_compression
+    WebsiteHandler.RESIZE_WIDTHS = args.resize_widths
+    WebsiteHandler.collapse_bursts = args.collapse_bursts
+    if args.photo_cache_mb > 0:
+        WebsiteHandler.photo_cache = FileCache(int(args.photo_cache_mb * 1024 * 1024),
+                                               int(args.photo_cache_max_file_kb * 1024))
+    # В pre-fork ядра делят между собой пулы всех обработчиков
+    workers = args.processing_workers
+    if workers > 0 and args.processes > 1:
+        workers = max(1, workers // args.processes)
+    WebsiteHandler.photo_index = PhotoIndex(WebsiteHandler.DATABASE_PATH)
+    # Файлы, добавленные и удаленные в обход сайта, проходят ту же
+    # обработку, что загруженные и удаленные через сайт
+    WebsiteHandler.photo_listing = PhotoListing(
+        WebsiteHandler.photo_index, WebsiteHandler.PHOTOS_DIR,
+        WebsiteHandler.PHOTO_EXTENSIONS + WebsiteHandler.VIDEO_EXTENSIONS,
+        on_added=WebsiteHandler.process_added_photos,
+        on_removed=WebsiteHandler.forget_removed_photos)
+    WebsiteHandler.photo_listing.start_sync()
+    WebsiteHandler.processing = create_processing_stage(WebsiteHandler, workers)
+    WebsiteHandler.processing.resume()
+    # Наблюдение - после создания обработки, которой оно передает файлы
+    WebsiteHandler.photos_watch = args.photos_watch
+    watch_directory_once(WebsiteHandler.PHOTOS_DIR, WebsiteHandler.photo_listing.refresh,
+                         WebsiteHandler.photos_watch, WebsiteHandler.PHOTOS_WATCH_LOCK)
+    if args.mode == 'async':
+        return AsyncHTTPServer(server_address, WebsiteHandler,
+                               workers=args.workers, timeout=args.timeout,
+                               backlog=args.backlog, sock=sock)
+    if args.mode == 'single':
+        server = HTTPServer(server_address, WebsiteHandler, bind_and_activate=False)
+    else:
+        server = PooledHTTPServer(server_address, WebsiteHandler,
+                                  workers=args.workers, queue_size=args.queue_size,
+                                  bind_and_activate=False)
+    server.request_queue_size = args.backlog
+    if sock is None:
+        try:
+            server.server_bind()
+            server.server_activate()
+        except BaseException:
+            server.server_close()
+            raise
+    else:
+        server.socket.close()
+        server.socket = sock
+        server.server_address = sock.getsockname()
+    return server
+
+
+def create_processing_stage(handler_class, workers):
+    """Пул фоновой обработки со всеми обработчиками загруженных файлов"""
+    stage = ProcessingStage(JobStore(handler_class.DATABASE_PATH),
+                            handler_class.PHOTOS_DIR, workers)
+    stage.register('optimize',
+                   partial(optimize_jpeg, archive_dir=handler_class.ARCHIVE_DIR),
+                   ('.jpg', '.jpeg'),
+                   cleanup=partial(remove_archived, archive_dir=handler_class.ARCHIVE_DIR),
+                   first=True)
+    if handler_class.photo_index is not None:
+        # Хэш файла после оптимизации тоже ведет к этому фото
+        stage.register('content_hash', file_sha256,
+                       handler_class.PHOTO_EXTENSIONS + handler_class.VIDEO_EXTENSIONS,
+                       on_result=lambda photo, digest:
+                           handler_class.photo_index.claim_hash(digest, photo))
+        # Список в памяти (если он есть) записывает и в индекс
+        records = handler_class.photo_listing or handler_class.photo_index
+        stage.register('metadata', extract_metadata,
+                       handler_class.PHOTO_EXTENSIONS + handler_class.VIDEO_EXTENSIONS,
+                       cleanup=records.remove, on_result=records.update)
+        if Image is not None:
+            stage.register('perceptual_hash', perceptual_hashes,
+                           handler_class.PHOTO_EXTENSIONS,
+                           on_result=handler_class.photo_index.set_perceptual_hashes)
+    stage.register('faststart', make_mp4_faststart, handler_class.VIDEO_EXTENSIONS)
+    if Image is not None:
+        stage.register('thumbnails',
+                       partial(generate_thumbnails, thumbs_dir=handler_class.THUMBS_DIR,
+                               widths=handler_class.THUMBNAIL_WIDTHS),
+                       handler_class.PHOTO_EXTENSIONS,
+                       cleanup=partial(remove_thumbnails, thumbs_dir=handler_class.THUMBS_DIR,
+                                       widths=handler_class.THUMBNAIL_WIDTHS))
+    if Image is not None:
+        stage.register('placeholder', generate_placeholder, handler_class.PHOTO_EXTENSIONS)
+    if handler_class.modern_formats:
+        stage.register('modern_formats',
+                       partial(generate_modern_formats, formats_dir=handler_class.FORMATS_DIR,
+                               extensions=handler_class.modern_formats),
+                       handler_class.MODERN_SOURCE_EXTENSIONS,
+                       cleanup=partial(remove_modern_formats,
+                                       formats_dir=handler_class.FORMATS_DIR))
+    return stage
+
+
+def prepare_existing_videos(photos_dir):
+    """Fast start для видео, попавших в папку в обход загрузки"""
+    for filename in sorted(os.listdir(photos_dir)):
+        if not filename.lower().endswith('.mp4'):
+            continue
+        try:
+            changed = make_mp4_faststart(os.path.join(photos_dir, filename))
+            print(f"{'🎬' if changed else '✔️ '} {filename}: "
+                  f"{'moov перенесен в начало' if changed else 'уже готово'}")
+        except (OSError, ValueError, struct.error) as e:
+            print(f"❌ {filename}: {e}")
+
+
+def reindex_photos(handler_class, workers):
+    """Пересборка индекса метаданных по всей папке фото в несколько процессов"""
+    extensions = handler_class.PHOTO_EXTENSIONS + handler_class.VIDEO_EXTENSIONS
+    names = [name for name in sorted(os.listdir(handler_class.PHOTOS_DIR))
+             if name.lower().endswith(extensions)]
+    paths = [os.path.join(handler_class.PHOTOS_DIR, name) for name in names]
+    index = PhotoIndex(handler_class.DATABASE_PATH)
+    started = time.perf_counter()
+    indexed = []
+    with ProcessPoolExecutor(max(1, workers)) as pool:
+        for name, (metadata, error) in zip(names, pool.map(extract_metadata_safe, paths,
+                                                            chunksize=32)):
+            if error:
+                print(f"❌ {name}: {error}")
+            else:
+                indexed.append((name, metadata))
+    index.update_many(indexed)
+    removed = index.prune(set(names))
+    index.close()
+    print(f"🗂️  Проиндексировано файлов: {len(indexed)} из {len(names)} за "
+          f"{time.perf_counter() - started:.2f} с ({max(1, workers)} процессов), "
+          f"удалено устаревших записей: {removed}")
+
+
+def reconcile_photo_index(handler_class):
+    """Сверка индекса фото с папкой: файлы, добавленные и удаленные в обход
+    сайта (пока сервер не работал), возвращает (добавлено, удалено)"""
+    extensions = handler_class.PHOTO_EXTENSIONS + handler_class.VIDEO_EXTENSIONS
+    names = {name for name in os.listdir(handler_class.PHOTOS_DIR)
+             if name.lower().endswith(extensions)
+             and os.path.isfile(os.path.join(handler_class.PHOTOS_DIR, name))}
+    index = PhotoIndex(handler_class.DATABASE_PATH)
+    try:
+        added = []
+        for name in sorted(names - index.names()):
+            metadata, error = extract_metadata_safe(os.path.join(handler_class.PHOTOS_DIR, name))
+            if error:
+                print(f"❌ {name}: {error}")
+            else:
+                added.append((name, metadata))
+        index.update_many(added)
+        return len(added), index.prune(names)
+    finally:
+        index.close()
+
+
+def parse_widths(value):
+    """Список ширин через запятую для argparse"""
+    try:
+        widths = tuple(sorted({int(width) for width in value.split(',') if width.strip()}))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"ожидались числа через запятую: {value}")
+    if not widths or widths[0] <= 0:
+        raise argparse.ArgumentTypeError(f"ширины должны быть положительными: {value}")
+    return widths
+
+
+def parse_args(argv=None):
+    """Разбор параметров командной строки"""
+    parser = argparse.ArgumentParser(description="Сайт 'Нам полгода'")
+    parser.add_argument('--port', type=int, default=8000,
+                        help="порт сервера (по умолчанию 8000)")
+    parser.add_argument('--prepare-videos', action='store_true',
+                        help="перенести moov в начало всех MP4 в photos/ и выйти")
+    parser.add_argument('--reindex', action='store_true',
+                        help="пересобрать индекс метаданных (время съемки и т.д.) и выйти")
+    parser.add_argument('--backfill', action='store_true',
+                        help="поставить в фоновую обработку фото, загруженные раньше "
+                             "(миниатюры, WebP/AVIF и т.д.)")
+    parser.add_argument('--mode', choices=['single', 'threaded', 'async'],
+                        default='threaded',
+                        help="single - один запрос за раз, threaded - пул потоков, "
+                             "async - цикл событий asyncio")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help="количество рабочих потоков (threaded и async)")
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE,
+                        help="длина очереди соединений, ожидающих обработчика")
+    parser.add_argument('--processes', type=int, default=1,
+                        help="количество процессов-обработчиков (больше 1 - режим pre-fork)")
+    parser.add_argument('--reuse-port', action='store_true',
+                        help="в режиме pre-fork каждый процесс слушает порт сам (SO_REUSEPORT)")
+    parser.add_argument('--backlog', type=int, default=DEFAULT_BACKLOG,
+                        help="длина очереди непринятых соединений в ядре")
+    parser.add_argument('--photo-cache-mb', type=float, default=0,
+                        help="объем кэша фото в памяти, МБ (0 - кэш выключен)")
+    parser.add_argument('--photo-cache-max-file-kb', type=float, default=1024,
+                        help="файлы больше этого размера (КБ) не кэшируются")
+    parser.add_argument('--resize-widths', type=parse_widths,
+                        default=WebsiteHandler.RESIZE_WIDTHS,
+                        help="разрешенные ширины для /photos/<имя>?w= через запятую")
+    parser.add_argument('--collapse-bursts', action='store_true',
+                        help="сворачивать в галерее серии похожих снимков в одну плитку")
+    parser.add_argument('--photos-watch', choices=['auto', 'inotify', 'poll'],
+                        default=WebsiteHandler.photos_watch,
+                        help="как замечать файлы, скопированные в photos/ в обход сайта: "
+                             "inotify или опрос времени изменения папки (auto - inotify, "
+                             "где он есть)")
+    parser.add_argument('--processing-workers', type=int, default=os.cpu_count() or 1,
+                        help="процессов фоновой обработки загрузок "
+                             "(0 - обрабатывать сразу при загрузке)")
+    parser.add_argument('--no-compression', action='store_true',
+                        help="не сжимать ответы gzip/brotli")
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help="таймаут чтения сокета в секундах (0 - без таймаута)")
+    parser.add_argument('--keepalive-timeout', type=float, default=DEFAULT_KEEPALIVE_TIMEOUT,
+                        help="сколько секунд держать простаивающее соединение открытым")
+    parser.add_argument('--max-keepalive-requests', type=int,
+                        default=DEFAULT_MAX_KEEPALIVE_REQUESTS,
+                        help="максимум запросов на одном соединении (1 - без keep-alive)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
     """Запуск веб-сервера"""
-    port = 8000
+    args = parse_args(argv)
+    port = args.port
     server_address = ('', port)
     
     # Создаем необходимые папки
     os.makedirs('photos', exist_ok=True)
     os.makedirs('messages', exist_ok=True)
     
+    if args.prepare_videos:
+        prepare_existing_videos(WebsiteHandler.PHOTOS_DIR)
+        return
+    if args.reindex:
+        reindex_photos(WebsiteHandler, args.processing_workers)
+        return
+    
     print("🎉 Запуск сайта 'Нам полгода'")
     print(f"🌐 Сервер доступен по адресу: http://localhost:{port}")
     print("💕 Сайт создан с любовью!")
@@ -1496,10 +5572,41 @@ def main():
     print("📁 Структура:")
     print("   📸 photos/ - папка для фотографий")
     print("   💌 messages/ - папка для сообщений")
+    print("   🗄️  archive/ - оригиналы оптимизированных фото")
+    print("   🎨 static/ - собранные CSS и JS")
+    print("   🗂️  cache/ - миниатюры и состояние обработки")
     print()
     
     try:
-        httpd = HTTPServer(server_address, WebsiteHandler)
+        WebsiteHandler.build_static_assets()
+    except OSError as e:
+        print(f"⚠️  Не удалось собрать static/, стили будут встроены в страницы: {e}")
+    # Задачи, прерванные остановкой сервера, запускаем заново (до fork,
+    # чтобы обработчики pre-fork не сбросили задачи друг друга)
+    store = JobStore(WebsiteHandler.DATABASE_PATH)
+    requeued = store.requeue_running()
+    store.close()
+    if requeued:
+        print(f"🔁 Незавершенных задач обработки: {requeued}")
+    added, removed = reconcile_photo_index(WebsiteHandler)
+    if added or removed:
+        print(f"🗂️  Индекс фото сверен с папкой: добавлено {added}, удалено {removed}")
+    if args.backfill:
+        WebsiteHandler.photo_index = PhotoIndex(WebsiteHandler.DATABASE_PATH)
+        stage = create_processing_stage(WebsiteHandler, 0)
+        print(f"🗂️  Поставлено в обработку задач: {stage.enqueue_existing()}")
+        stage.store.close()
+        # Соединения с базой не должны переходить в процессы pre-fork
+        WebsiteHandler.photo_index.close()
+        WebsiteHandler.photo_index = None
+    
+    try:
+        if args.processes > 1:
+            if not hasattr(os, 'fork'):
+                raise RuntimeError("режим pre-fork доступен только на Unix")
+            httpd = PreforkServer(server_address, args)
+        else:
+            httpd = create_server(server_address, args)
         httpd.serve_forever()
     except KeyboardInterrupt:
         print("\n🛑 Сервер остановлен")
@@ -1507,4 +5614,4 @@ def main():
         print(f"\n❌ Ошибка: {e}")
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()